@@ -0,0 +1,383 @@
+"""
+Benchmarks of the download/decode/resize/encode pipeline.
+
+Synthetic, photo-like sources are generated for every format at several resolutions and served from a local HTTP
+server and a stubbed S3 client, so the benchmark runs offline. Every case is a request processed by the handler, timed
+by its own stage instrumentation (see `metrics.record_stages`): wall time, peak RSS and output bytes are recorded per
+stage (including the base64 encoding of the lambda response) and written as JSON, with the import time of the
+handler, to `benchmarks/results/<commit>.json`, which `--compare` diffs against an earlier run.
+
+    python benchmarks/bench.py --quick
+    python benchmarks/bench.py --formats JPEG,WEBP --megapixels 12 --compare benchmarks/results/abc1234.json
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from unittest.mock import patch
+
+import botocore.session
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+import PIL
+from PIL import Image, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from imaginex_lambda import handler  # noqa: E402
+from imaginex_lambda.lib import metrics, resize  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCES_DIR = os.path.join(BENCH_DIR, '.sources')
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+# The formats of the test parametrization in `test/test_formats.py`.
+FORMATS = ['PNG', 'JPEG', 'JPEG2000', 'ICO', 'MPO', 'WEBP', 'GIF', 'TIFF', 'BMP']
+EXTENSIONS = {'JPEG2000': 'jp2', 'MPO': 'mpo', 'ICO': 'ico'}
+MEGAPIXELS = [0.5, 12, 50]
+WIDTHS = [640, 1920]
+QUALITIES = [60, 85]
+# The stages recorded by the handler, in the order they run. Only those a request goes through are reported.
+STAGES = ['fetch', 'sniff', 'decode', 'animation', 'resize', 'metadata', 'encode', 'base64', 'total']
+BUCKET_NAME = 'bench'
+
+
+class RSSSampler:
+    """
+    Samples the resident set size of the process on a background thread, to find the peak of a single stage.
+    `ru_maxrss` only ever grows, so it cannot tell the stages apart.
+    """
+
+    def __init__(self, interval: float = 0.002) -> None:
+        self.interval = interval
+        self.samples: List[Tuple[float, int]] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> 'RSSSampler':
+        self.samples.append((time.perf_counter(), current_rss()))
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.samples.append((time.perf_counter(), current_rss()))
+
+    def window(self, start: float, end: float) -> Tuple[int, int]:
+        """
+        Returns the RSS at `start` and its peak until `end` (`time.perf_counter` values), in bytes.
+        """
+        samples = list(self.samples)
+        before = [rss for t, rss in samples if t <= start] or [samples[0][1]]
+        during = [rss for t, rss in samples if start < t <= end]
+        return before[-1], max(during + [before[-1], current_rss()])
+
+
+class SampledStageRecorder(metrics.StageRecorder):
+    """
+    Records the RSS of every stage along with the rest of the stage, read from the samples of an `RSSSampler`.
+    """
+
+    def __init__(self, sampler: RSSSampler) -> None:
+        super().__init__()
+        self.sampler = sampler
+
+    def add(self, name: str, duration: float, bytes_in: Optional[int], bytes_out: Optional[int]) -> None:
+        super().add(name, duration, bytes_in, bytes_out)
+        end = time.perf_counter()
+        start_rss, peak_rss = self.sampler.window(end - duration / 1000, end)
+        self.stages[-1].update(start_rss=start_rss, peak_rss=peak_rss)
+
+
+def current_rss() -> int:
+    """
+    Returns the resident set size of the process in bytes, falling back to the peak RSS where /proc is missing.
+    """
+    try:
+        with open('/proc/self/statm') as fin:
+            return int(fin.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def photo_like(size: Tuple[int, int]) -> Image.Image:
+    """
+    Generates a deterministic image that compresses like a photo: smooth gradients, fine detail and sharp edges.
+    Pure noise would penalize every codec alike and flat colors would flatter them.
+    """
+    gradient = Image.linear_gradient('L').resize(size).convert('RGB')
+    noise = Image.effect_noise(size, 48).filter(ImageFilter.GaussianBlur(2)).convert('RGB')
+    detail = Image.effect_mandelbrot(size, (-2.2, -1.2, 1.0, 1.2), 64).convert('RGB')
+    return Image.blend(Image.blend(gradient, noise, 0.4), detail, 0.3)
+
+
+def source_path(directory: str, fmt: str, megapixels: float) -> str:
+    """
+    Returns the path of a synthetic source, generating it on first use. Sources are kept between runs, since the
+    large ones take a while to encode.
+    """
+    name = f'{fmt.lower()}-{megapixels:g}mp.{EXTENSIONS.get(fmt, fmt.lower())}'
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        width = int((megapixels * 1e6 * 3 / 2) ** 0.5)
+        img = photo_like((width, int(width * 2 / 3)))
+        if fmt == 'GIF':
+            img = img.quantize(256)
+        options = {}
+        if fmt == 'ICO':
+            # ICO files are capped at 256x256px by the format itself.
+            img.thumbnail((256, 256))
+            options['sizes'] = [img.size]
+        img.save(f'{path}.tmp', format=fmt, **options)
+        os.replace(f'{path}.tmp', path)
+    return path
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args) -> None:
+        pass
+
+
+@contextmanager
+def http_source_server(directory: str) -> Iterator[str]:
+    """
+    Serves the sources from a local HTTP server, yielding its base URL.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextmanager
+def stubbed_s3(key: str, data: bytes, calls: int = 1) -> Iterator[None]:
+    """
+    Replaces the S3 client with a stub answering `calls` requests to `get_object` of `key` with `data`.
+    """
+    client = botocore.session.get_session().create_client('s3', region_name='us-east-1', aws_access_key_id='bench',
+                                                          aws_secret_access_key='bench')
+    stubber = Stubber(client)
+    for _ in range(calls):
+        stubber.add_response('get_object', {
+            'Body': StreamingBody(BytesIO(data), len(data)),
+            'ContentType': 'application/octet-stream',
+            'ContentLength': len(data),
+        }, {'Bucket': BUCKET_NAME, 'Key': key})
+    with stubber, patch('imaginex_lambda.lib.img_lib.s3_client', client):
+        yield
+
+
+def add_stage(stages: Dict[str, Dict[str, float]], name: str, seconds: float, start_rss: int, peak_rss: int,
+              size: int) -> None:
+    """
+    Adds a stage to the results of a case, summing the wall time of stages a request goes through more than once.
+    """
+    result = stages.setdefault(name, {'seconds': 0.0, 'peak_rss_mb': 0.0, 'rss_growth_mb': 0.0, 'bytes': 0})
+    result['seconds'] += seconds
+    result['peak_rss_mb'] = max(result['peak_rss_mb'], peak_rss / 2 ** 20)
+    result['rss_growth_mb'] = max(result['rss_growth_mb'], (peak_rss - start_rss) / 2 ** 20)
+    result['bytes'] = size
+
+
+def run_case(base_url: str, path: str, source: str, width: int, quality: int,
+             accept: Optional[str]) -> Dict[str, Dict[str, float]]:
+    """
+    Processes a request for the source through the handler, with the caches disabled, and returns the stages it
+    recorded along with the whole request as `total`.
+    """
+    name = os.path.basename(path)
+    url, bucket_name = (name, BUCKET_NAME) if source == 's3' else (f'{base_url}/{name}', None)
+    event = {'queryStringParameters': {'url': url, 'w': str(width), 'q': str(quality)},
+             'headers': {'accept': accept} if accept else {}}
+    stages = {}
+
+    with ExitStack() as stack:
+        if source == 's3':
+            with open(path, 'rb') as fin:
+                stack.enter_context(stubbed_s3(name, fin.read()))
+        for attribute, value in (('S3_BUCKET_NAME', bucket_name), ('DERIVATIVE_STORE', None),
+                                 ('MEMORY_CACHE', None), ('SPILLOVER_BUCKET', None)):
+            stack.enter_context(patch.object(handler, attribute, value))
+        sampler = stack.enter_context(RSSSampler())
+        stack.enter_context(patch.object(metrics, 'StageRecorder', partial(SampledStageRecorder, sampler)))
+
+        with metrics.record_stages(True) as recorder:
+            start = time.perf_counter()
+            response = handler.process_event(event, False)
+            end = time.perf_counter()
+        if response['statusCode'] != 200:
+            raise RuntimeError(f"{name}: {response['body']}")
+
+        for recorded in recorder.stages:
+            size = recorded['bytes_out'] if recorded['bytes_out'] is not None else recorded['bytes_in'] or 0
+            add_stage(stages, recorded['name'], recorded['duration'] / 1000, recorded['start_rss'],
+                      recorded['peak_rss'], size)
+        add_stage(stages, 'total', end - start, *sampler.window(start, end), len(base64.b64decode(response['body'])))
+    return stages
+
+
+def handler_import_time(runs: int) -> float:
+    """
+    Measures the cumulative import time of the handler in a fresh interpreter (`-X importtime`), the cold start cost
+    paid before the first request, in milliseconds, as the best of `runs` imports.
+    """
+    root = os.path.dirname(BENCH_DIR)
+    durations = []
+    for _ in range(runs):
+        stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import imaginex_lambda.handler'], cwd=root,
+                                capture_output=True, text=True, check=True).stderr
+        match = re.search(r'import time:\s+\d+ \|\s+(\d+) \|\s+imaginex_lambda\.handler$', stderr, re.MULTILINE)
+        durations.append(int(match.group(1)) / 1000)
+    return min(durations)
+
+
+def summarize(runs: List[Dict[str, Dict[str, float]]]) -> Dict[str, Dict[str, float]]:
+    """
+    Reduces repeated runs of a case to the median wall time and the highest peak RSS of every stage.
+    """
+    names = {name for run in runs for name in run}
+    order = [name for name in STAGES if name in names] + sorted(names - set(STAGES))
+    return {stage: {'seconds': statistics.median(run[stage]['seconds'] for run in runs),
+                    'peak_rss_mb': max(run[stage]['peak_rss_mb'] for run in runs),
+                    'rss_growth_mb': max(run[stage]['rss_growth_mb'] for run in runs),
+                    'bytes': runs[-1][stage]['bytes']}
+            for stage in order}
+
+
+def case_key(case: Dict[str, Any]) -> Tuple:
+    return case['format'], case['megapixels'], case['width'], case['quality'], case['source']
+
+
+def compare(results: Dict[str, Any], baseline_path: str) -> None:
+    """
+    Prints the change of the handler import time, and of total wall time, peak RSS and output bytes of every case also
+    present in the baseline.
+    """
+    with open(baseline_path) as fin:
+        baseline_results = json.load(fin)
+    baseline = {case_key(case): case for case in baseline_results['cases']}
+
+    print(f"\nCompared to {baseline_path}:")
+    if baseline_results.get('handler_import_ms'):
+        print(f"handler import {results['handler_import_ms'] - baseline_results['handler_import_ms']:+.1f}ms")
+    matched = 0
+    for case in results['cases']:
+        base = baseline.get(case_key(case))
+        if base is None:
+            continue
+        matched += 1
+        new, old = case['stages']['total'], base['stages']['total']
+        print(f"{case['format']:>8} {case['megapixels']:>4g}MP w={case['width']:<5} q={case['quality']:<3} "
+              f"time {new['seconds'] / old['seconds'] - 1:+7.1%}  "
+              f"rss {new['peak_rss_mb'] - old['peak_rss_mb']:+8.1f}MB  "
+              f"bytes {new['bytes'] - old['bytes']:+9d}")
+    if not matched:
+        print("No cases in common")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def parse_list(value: str, cast: Callable[[str], Any] = str) -> List[Any]:
+    return [cast(item.strip()) for item in value.split(',') if item.strip()]
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--formats', type=parse_list, default=FORMATS)
+    parser.add_argument('--megapixels', type=partial(parse_list, cast=float), default=MEGAPIXELS)
+    parser.add_argument('--widths', type=partial(parse_list, cast=int), default=WIDTHS)
+    parser.add_argument('--qualities', type=partial(parse_list, cast=int), default=QUALITIES)
+    parser.add_argument('--source', choices=('http', 's3'), default='http')
+    parser.add_argument('--accept', default=None, help='Accept header to negotiate the output format with')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true', help='0.5MP JPEG, PNG and WEBP only, a single run')
+    parser.add_argument('--sources', default=SOURCES_DIR, help='directory the synthetic sources are kept in')
+    parser.add_argument('--output', default=None, help='results file, defaults to results/<commit>.json')
+    parser.add_argument('--compare', default=None, help='results file of an earlier run to compare to')
+    parser.add_argument('--filter', choices=sorted(resize.FILTERS), default=resize.RESIZE_FILTER,
+                        help='resampling filter, see RESIZE_FILTER')
+    parser.add_argument('--reducing-gap', type=float, default=resize.RESIZE_REDUCING_GAP,
+                        help='see RESIZE_REDUCING_GAP, 0 resamples from the full image')
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        args.formats, args.megapixels, args.repeat = ['JPEG', 'PNG', 'WEBP'], [0.5], 1
+
+    commit = git_commit()
+    results = {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'filter': args.filter,
+        'reducing_gap': args.reducing_gap,
+        'handler_import_ms': handler_import_time(args.repeat),
+        'cases': [],
+    }
+    print(f"handler import {results['handler_import_ms']:.1f}ms")
+
+    # The pipeline logs every step, which would dominate the timings of small images.
+    logging.getLogger('imaginex_lambda.lib.utils').setLevel(logging.WARNING)
+
+    os.makedirs(args.sources, exist_ok=True)
+    with http_source_server(args.sources) as base_url, \
+            patch.object(resize, 'RESIZE_FILTER', args.filter), \
+            patch.object(resize, 'RESIZE_REDUCING_GAP', args.reducing_gap):
+        for fmt in args.formats:
+            for megapixels in args.megapixels:
+                path = source_path(args.sources, fmt, megapixels)
+                for width in args.widths:
+                    for quality in args.qualities:
+                        runs = [run_case(base_url, path, args.source, width, quality, args.accept)
+                                for _ in range(args.repeat)]
+                        case = {'format': fmt, 'megapixels': megapixels, 'width': width, 'quality': quality,
+                                'source': args.source, 'source_bytes': os.path.getsize(path),
+                                'stages': summarize(runs)}
+                        results['cases'].append(case)
+                        total = case['stages']['total']
+                        print(f"{fmt:>8} {megapixels:>4g}MP w={width:<5} q={quality:<3} "
+                              f"{total['seconds'] * 1000:9.1f}ms {total['peak_rss_mb']:8.1f}MB "
+                              f"{case['source_bytes']:>10d} -> {total['bytes']:>9d} bytes")
+
+    output = args.output or os.path.join(RESULTS_DIR, f'{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as fout:
+        json.dump(results, fout, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+    return results
+
+
+if __name__ == '__main__':
+    main()
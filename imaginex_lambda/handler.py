@@ -1,58 +1,278 @@
+import base64
 import os
-from typing import Dict, Optional
+from typing import Dict, Optional, List, Any, Tuple
 
 from PIL import Image
 
-from imaginex_lambda.lib.exceptions import HandlerError, error
-from imaginex_lambda.lib.img_lib import download_and_optimize
-from imaginex_lambda.lib.utils import success, logger, cast_to_int
+from imaginex_lambda.lib.cache import create_derivative_store
+from imaginex_lambda.lib.coalesce import create_single_flight
+from imaginex_lambda.lib.exceptions import HandlerError, NotModified, error
+from imaginex_lambda.lib.executor import create_executor
+from imaginex_lambda.lib.img_lib import download_and_optimize, download_and_optimize_variants, image_info, \
+    get_s3_client
+from imaginex_lambda.lib.lru import create_memory_cache
+from imaginex_lambda.lib.metrics import record_stages, stage
+from imaginex_lambda.lib.spillover import spill_to_s3, base64_size
+from imaginex_lambda.lib.utils import success, success_json, not_modified, redirect, logger, cast_to_int, \
+    get_header
 
 # @TODO: Add placeholder image for errors.
 
-DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', 1024))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', 64 * 1024))
+DOWNLOAD_MODE = os.getenv('DOWNLOAD_MODE', 'memory')
 DEFAULT_QUALITY_PERC = 70
 S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME', None)
+DERIVATIVE_CACHE_BUCKET = os.getenv('DERIVATIVE_CACHE_BUCKET', None)
+DERIVATIVE_CACHE_PREFIX = os.getenv('DERIVATIVE_CACHE_PREFIX', 'derivatives/')
+DERIVATIVE_CACHE_DIR = os.getenv('DERIVATIVE_CACHE_DIR', None)
+# Lock derivatives in the store while they are produced, so other instances wait for them instead of producing them too.
+DERIVATIVE_CACHE_LOCK = os.getenv('DERIVATIVE_CACHE_LOCK', '0') not in ('0', 'false', 'False', '')
+MEMORY_CACHE_MB = float(os.getenv('MEMORY_CACHE_MB', 0))
+MEMORY_CACHE_TTL = float(os.getenv('MEMORY_CACHE_TTL', 300))
+WORKER_THREADS = cast_to_int(os.getenv('WORKER_THREADS', None))
+PROBE_BYTES = int(os.getenv('PROBE_BYTES', 0))
+# Concurrent identical requests (in multi-threaded servers) share a single download and optimization, `0` disables it.
+COALESCE_REQUESTS = os.getenv('COALESCE_REQUESTS', '1') not in ('0', 'false', 'False', '')
+SPILLOVER_BUCKET = os.getenv('SPILLOVER_BUCKET', None)
+SPILLOVER_PREFIX = os.getenv('SPILLOVER_PREFIX', 'spillover/')
+SPILLOVER_URL = os.getenv('SPILLOVER_URL', None)
+SPILLOVER_EXPIRES = int(os.getenv('SPILLOVER_EXPIRES', 3600))
+# Lambda responses are limited to 6 MB, base64 encoded bodies above this size are spilled over to S3 instead.
+SPILLOVER_THRESHOLD = int(os.getenv('SPILLOVER_THRESHOLD', 5 * 1024 * 1024))
+# Per-stage timings in a Server-Timing header and an EMF log line per request, `0` disables them.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') not in ('0', 'false', 'False', '')
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'Imaginex')
+CACHE_CONTROL = os.getenv('CACHE_CONTROL', 'public, max-age=3600, stale-while-revalidate=86400')
 
+DERIVATIVE_STORE = create_derivative_store(DERIVATIVE_CACHE_BUCKET,
+                                           DERIVATIVE_CACHE_PREFIX,
+                                           DERIVATIVE_CACHE_DIR,
+                                           get_s3_client() if DERIVATIVE_CACHE_BUCKET else None)
+MEMORY_CACHE = create_memory_cache(MEMORY_CACHE_MB, MEMORY_CACHE_TTL)
+EXECUTOR = create_executor(WORKER_THREADS)
+SINGLE_FLIGHT = create_single_flight(COALESCE_REQUESTS)
 
-def handler(event: Dict, context: Optional[Dict]):
+
+def parse_quality(value: Any) -> Optional[int]:
+    """
+    Parses the `q` parameter, `auto` (None) lets the quality be picked per image.
+    """
+    if str(value).lower() == 'auto':
+        return None
+    return int(value)
+
+
+def parse_variants(event: Dict, qs: Dict) -> Optional[List[Dict[str, Any]]]:
+    """
+    Parses the variants of a batch request, either listed in the event (`variants`, each with optional `w`, `h`, `q`,
+    `f`, `maxbytes`, `fit` and `url`) or given as comma-separated `w` or `h` query parameters (e.g. `w=640,750,828`).
+
+    Returns:
+        Optional[List[Dict[str, Any]]]: The variants or None if this is not a batch request.
+    """
+    quality = qs.get('q', DEFAULT_QUALITY_PERC)
+    output_format = qs.get('f', None)
+    max_bytes = cast_to_int(qs.get('maxbytes', None))
+    fit = qs.get('fit', None)
+
+    if event.get('variants') is not None:
+        return [{
+            'width': cast_to_int(variant.get('w', None)),
+            'height': cast_to_int(variant.get('h', None)),
+            'quality': parse_quality(variant.get('q', quality)),
+            'format': variant.get('f', output_format),
+            'max_bytes': cast_to_int(variant.get('maxbytes', max_bytes)),
+            'fit': variant.get('fit', fit),
+            'url': variant.get('url', None),
+        } for variant in event['variants']]
+
+    for param, dimension in (('w', 'width'), ('h', 'height')):
+        values = str(qs.get(param) or '')
+        if ',' in values:
+            return [{'width': None, 'height': None, dimension: cast_to_int(value), 'quality': parse_quality(quality),
+                     'format': output_format, 'max_bytes': max_bytes, 'fit': fit} for value in values.split(',')]
+
+    return None
+
+
+def cache_headers(details: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Builds the HTTP caching headers (Cache-Control and the ETag/Last-Modified validators) of a response.
+    """
+    headers = {'Vary': 'Accept', 'Cache-Control': CACHE_CONTROL}
+    if details.get('etag'):
+        headers['ETag'] = details['etag']
+    if details.get('last_modified'):
+        headers['Last-Modified'] = details['last_modified']
+    return headers
+
+
+def variant_bodies(results: List[Tuple[bytes, str, float]], binary: bool) -> List[Dict[str, str]]:
+    """
+    Returns the base64 encoded `body` of every variant of a batch response. When they add up to more than
+    `SPILLOVER_THRESHOLD`, the largest ones are spilled over to `SPILLOVER_BUCKET` and their `location` is returned
+    instead, like for single images, so the response stays within the lambda limit.
+
+    Raises:
+        HandlerError: If the bodies are over the threshold and no spillover bucket is configured.
+    """
+    sizes = [base64_size(len(image_data)) for image_data, _, _ in results]
+    spilled = set()
+    total = sum(sizes)
+    if not binary:
+        for index in sorted(range(len(results)), key=lambda i: sizes[i], reverse=True):
+            if total <= SPILLOVER_THRESHOLD:
+                break
+            spilled.add(index)
+            total -= sizes[index]
+    if spilled and not SPILLOVER_BUCKET:
+        raise HandlerError(f'Variants too large for a response: {sum(sizes)} bytes encoded, the limit is '
+                           f'{SPILLOVER_THRESHOLD} bytes', code=413)
+
+    bodies = []
+    for index, (image_data, content_type, _) in enumerate(results):
+        if index in spilled:
+            bodies.append({'location': spill_to_s3(image_data, content_type, get_s3_client(), SPILLOVER_BUCKET,
+                                                   SPILLOVER_PREFIX, SPILLOVER_URL, SPILLOVER_EXPIRES)})
+        else:
+            bodies.append({'body': base64.b64encode(image_data).decode()})
+    return bodies
+
+
+def handler(event: Dict, context: Optional[Dict], binary: bool = False):
     """
     Lambda function handler.
 
     Its sole responsibility is to parse the context and generate a formatted response, including error responses.
     Any image processing logic should be performed by other functions, to make unit testing easier.
+
+    Callers other than the lambda runtime can set `binary` to get the raw image bytes in the body instead of base64.
+    """
+    with record_stages(METRICS_ENABLED) as recorder:
+        response = process_event(event, binary)
+        if recorder is not None:
+            headers = response.setdefault('headers', {})
+            headers['Server-Timing'] = recorder.server_timing()
+            qs = event.get('queryStringParameters') or {}
+            recorder.emit(METRICS_NAMESPACE, {'content_type': headers.get('Content-Type'),
+                                              'status': response['statusCode'], 'url': qs.get('url'),
+                                              'width': qs.get('w'), 'height': qs.get('h'), 'quality': qs.get('q')})
+        return response
+
+
+def process_event(event: Dict, binary: bool) -> Dict[str, Any]:
+    """
+    Processes a single request and formats its response, see `handler`.
     """
     try:
         logger.info("Lambda function started")
 
-        qs = event['queryStringParameters']
+        qs = event.get('queryStringParameters') or {}
         url = qs.get('url', None)
+        accept = get_header(event, 'accept')
+
+        if qs.get('info'):
+            logger.info(f"url={url}, info")
+            return success_json(image_info(url, S3_BUCKET_NAME, PROBE_BYTES or 64 * 1024))
+
+        variants = parse_variants(event, qs)
+        if variants is not None:
+            logger.info(f"url={url}, variants={variants}")
+            results = download_and_optimize_variants(url,
+                                                     variants,
+                                                     S3_BUCKET_NAME,
+                                                     DOWNLOAD_CHUNK_SIZE,
+                                                     store=DERIVATIVE_STORE,
+                                                     memory_cache=MEMORY_CACHE,
+                                                     download_mode=DOWNLOAD_MODE,
+                                                     accept=accept,
+                                                     executor=EXECUTOR)
+            include_body = not (event.get('prewarm') or qs.get('prewarm'))
+            bodies = variant_bodies(results, binary) if include_body else [{} for _ in results]
+            logger.info("Returning variants response")
+            return success_json({'variants': [{
+                'width': variant['width'],
+                'height': variant['height'],
+                'quality': variant['quality'],
+                'content_type': content_type,
+                'size': len(image_data),
+                'ratio': round(ratio, 4),
+                **body,
+            } for variant, (image_data, content_type, ratio), body in zip(variants, results, bodies)]},
+                {'Vary': 'Accept'})
+
         width = cast_to_int(qs.get('w', None))
         height = cast_to_int(qs.get('h', None))
-        quality = int(qs.get('q', DEFAULT_QUALITY_PERC))
+        quality = parse_quality(qs.get('q', DEFAULT_QUALITY_PERC))
+        max_bytes = cast_to_int(qs.get('maxbytes', None))
+        output_format = qs.get('f', None)
+        fit = qs.get('fit', None)
+        if_none_match = get_header(event, 'if-none-match')
+        if_modified_since = get_header(event, 'if-modified-since')
 
-        logger.info(f"url={url}, width={width}, height={height} quality={quality}")
+        logger.info(f"url={url}, width={width}, height={height} quality={quality} format={output_format} "
+                    f"max_bytes={max_bytes} fit={fit}")
 
+        details = {}
         image_data, content_type, optimization_ratio = download_and_optimize(url,
                                                                              quality,
                                                                              width,
                                                                              height,
                                                                              S3_BUCKET_NAME,
-                                                                             DOWNLOAD_CHUNK_SIZE)
-        logger.info("Returning success response")
-        return success(image_data, {
-            'Vary': 'Accept',
+                                                                             DOWNLOAD_CHUNK_SIZE,
+                                                                             store=DERIVATIVE_STORE,
+                                                                             details=details,
+                                                                             memory_cache=MEMORY_CACHE,
+                                                                             download_mode=DOWNLOAD_MODE,
+                                                                             accept=accept,
+                                                                             output_format=output_format,
+                                                                             if_none_match=if_none_match,
+                                                                             if_modified_since=if_modified_since,
+                                                                             probe_size=PROBE_BYTES,
+                                                                             max_bytes=max_bytes,
+                                                                             coalescer=SINGLE_FLIGHT,
+                                                                             store_lock=DERIVATIVE_CACHE_LOCK,
+                                                                             fit=fit)
+        headers = {
+            **cache_headers(details),
             'Content-Type': content_type,
             'X-Optimization-Ratio': f'{optimization_ratio:.4f}',
-        })
+        }
+        if 'memory_cache' in details:
+            headers['X-Memory-Cache'] = details['memory_cache']
+        if 'cache' in details:
+            headers['X-Cache'] = details['cache']
+        if 'coalesced' in details:
+            headers['X-Coalesced'] = details['coalesced']
+        if 'cache_hits' in details:
+            headers['X-Cache-Hits'] = str(details['cache_hits'])
+            headers['X-Cache-Misses'] = str(details['cache_misses'])
+
+        if not binary and SPILLOVER_BUCKET and base64_size(len(image_data)) > SPILLOVER_THRESHOLD:
+            location = spill_to_s3(image_data, content_type, get_s3_client(), SPILLOVER_BUCKET, SPILLOVER_PREFIX,
+                                   SPILLOVER_URL, SPILLOVER_EXPIRES)
+            logger.info("Returning redirect response")
+            return redirect(location, {'Vary': 'Accept', 'Cache-Control': 'no-store' if not SPILLOVER_URL
+                                       else CACHE_CONTROL})
+
+        logger.info("Returning success response")
+        with stage('base64' if not binary else 'response', bytes_in=len(image_data)) as response_stage:
+            response = success(image_data, headers, binary=binary)
+            response_stage.bytes_out = len(response['body'])
+        return response
+    except NotModified as exc:
+        logger.info("Returning not modified response")
+        return not_modified(cache_headers(exc.validators))
     except HandlerError as exc:
         return error(str(exc), code=exc.code)
+    except Image.DecompressionBombError as exc:
+        return error(str(exc), code=413)
     except Exception as exc:
         return error(str(exc), code=500)
 
 
 if __name__ == '__main__':
     from io import BytesIO
-    import base64
 
     logger.info("Running test...")
     test_context = {
@@ -0,0 +1,314 @@
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional, Tuple
+
+from imaginex_lambda.lib.utils import logger
+
+CachedDerivative = Tuple[bytes, str, float]
+
+
+def derivative_key(params: Dict[str, Any], source: Dict[str, Any]) -> Optional[str]:
+    """
+    Computes a stable, content-addressed key for an optimized image.
+
+    The key is derived from the normalized transform parameters and the validators (ETag / Last-Modified) of the
+    source object, so a new version of the source automatically maps to a new key.
+
+    Args:
+        params (Dict[str, Any]): The transform parameters (url, width, height, quality, ...).
+        source (Dict[str, Any]): Information about the source image, as returned by `head_source`.
+
+    Returns:
+        Optional[str]: The hex digest key or None if the source has no validator to bind the derivative to.
+    """
+    etag = source.get('etag')
+    last_modified = source.get('last_modified')
+    if not etag and not last_modified:
+        return None
+
+    payload = json.dumps({
+        'params': params,
+        'etag': etag,
+        'last_modified': last_modified,
+    }, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def response_validators(params: Dict[str, Any], source: Dict[str, Any]) -> Dict[str, Optional[str]]:
+    """
+    Computes the HTTP validators of an optimized image: a deterministic ETag derived from the source validators and
+    the transform parameters, and the Last-Modified date of the source.
+
+    Returns:
+        Dict[str, Optional[str]]: A dictionary with the etag and last_modified, either of them may be None.
+    """
+    key = derivative_key(params, source)
+    return {
+        'etag': f'"{key[:32]}"' if key else None,
+        'last_modified': source.get('last_modified'),
+    }
+
+
+class DerivativeStore:
+    """
+    Base class for derivative (optimized image) storage backends.
+
+    Keeps hit and miss counters for the lifetime of the container, so they can be surfaced in response headers.
+    """
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[CachedDerivative]:
+        try:
+            cached = self._get(key)
+        except Exception as exc:
+            logger.warning("Derivative cache lookup failed for key %s: %s", key, exc)
+            cached = None
+
+        if cached is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return cached
+
+    def put(self, key: str, image_data: bytes, content_type: str, ratio: float) -> None:
+        try:
+            self._put(key, image_data, content_type, ratio)
+        except Exception as exc:
+            logger.warning("Derivative cache write failed for key %s: %s", key, exc)
+
+    def exists(self, key: str) -> bool:
+        """
+        Checks whether a derivative is stored, without reading it. Not counted as a hit or miss.
+        """
+        try:
+            return self._exists(key)
+        except Exception as exc:
+            logger.warning("Derivative cache lookup failed for key %s: %s", key, exc)
+            return False
+
+    def lock(self, key: str, ttl: float) -> bool:
+        """
+        Takes the lock of a derivative about to be produced, so other instances wait for it (see `wait`) instead of
+        producing it too. Locks older than `ttl` seconds are considered abandoned and taken over.
+
+        Returns:
+            bool: False if another instance holds the lock, True otherwise (including stores without locking and
+            failures to lock, which must not fail the request).
+        """
+        try:
+            return self._lock(key, ttl)
+        except Exception as exc:
+            logger.warning("Derivative cache lock failed for key %s: %s", key, exc)
+            return True
+
+    def unlock(self, key: str) -> None:
+        try:
+            self._unlock(key)
+        except Exception as exc:
+            logger.warning("Derivative cache unlock failed for key %s: %s", key, exc)
+
+    def wait(self, key: str, timeout: float, ttl: float, interval: float = 0.2) -> Optional[CachedDerivative]:
+        """
+        Waits for a derivative locked by another instance to be stored.
+
+        Returns:
+            Optional[CachedDerivative]: The derivative or None if it was not stored within `timeout` seconds, or the
+            lock was released (or abandoned) without it.
+        """
+        deadline = time.monotonic() + timeout
+        try:
+            while time.monotonic() < deadline:
+                time.sleep(interval)
+                cached = self._get(key)
+                if cached is None and not self._is_locked(key, ttl):
+                    # Released between the two checks, or abandoned by a failed producer.
+                    cached = self._get(key)
+                    if cached is None:
+                        return None
+                if cached is not None:
+                    self.hits += 1
+                    return cached
+        except Exception as exc:
+            logger.warning("Derivative cache lookup failed for key %s: %s", key, exc)
+        return None
+
+    def _get(self, key: str) -> Optional[CachedDerivative]:
+        raise NotImplementedError
+
+    def _exists(self, key: str) -> bool:
+        return self._get(key) is not None
+
+    def _lock(self, key: str, ttl: float) -> bool:
+        return True
+
+    def _unlock(self, key: str) -> None:
+        pass
+
+    def _is_locked(self, key: str, ttl: float) -> bool:
+        return False
+
+    def _put(self, key: str, image_data: bytes, content_type: str, ratio: float) -> None:
+        raise NotImplementedError
+
+
+class S3DerivativeStore(DerivativeStore):
+    """
+    Stores derivatives as objects under `prefix` in an S3 bucket. The content type and optimization ratio are kept
+    as object metadata.
+    """
+
+    def __init__(self, client, bucket_name: str, prefix: str = '') -> None:
+        super().__init__()
+        self.client = client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+    def _object_key(self, key: str) -> str:
+        return f'{self.prefix}{key}'
+
+    def _get(self, key: str) -> Optional[CachedDerivative]:
+        try:
+            r = self.client.get_object(Bucket=self.bucket_name, Key=self._object_key(key))
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+        with r['Body'] as fin:
+            image_data = fin.read()
+        ratio = float(r.get('Metadata', {}).get('ratio', 0))
+        return image_data, r['ContentType'], ratio
+
+    def _exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket_name, Key=self._object_key(key))
+        except self.client.exceptions.ClientError as exc:
+            if exc.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def _put(self, key: str, image_data: bytes, content_type: str, ratio: float) -> None:
+        self.client.put_object(Bucket=self.bucket_name,
+                               Key=self._object_key(key),
+                               Body=image_data,
+                               ContentType=content_type,
+                               Metadata={'ratio': f'{ratio:.4f}'})
+
+    def _lock(self, key: str, ttl: float) -> bool:
+        # A conditional write (`If-None-Match: *`, supported since botocore 1.35.2) only creates the lock object if
+        # nobody holds it.
+        lock_key = f'{self._object_key(key)}.lock'
+        for _ in range(2):
+            try:
+                self.client.put_object(Bucket=self.bucket_name, Key=lock_key, Body=b'', IfNoneMatch='*')
+                return True
+            except self.client.exceptions.ClientError as exc:
+                code = exc.response.get('Error', {}).get('Code')
+                if code not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                    raise
+            if self._is_locked(key, ttl):
+                return False
+            self.client.delete_object(Bucket=self.bucket_name, Key=lock_key)
+        return False
+
+    def _unlock(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket_name, Key=f'{self._object_key(key)}.lock')
+
+    def _is_locked(self, key: str, ttl: float) -> bool:
+        try:
+            r = self.client.head_object(Bucket=self.bucket_name, Key=f'{self._object_key(key)}.lock')
+        except self.client.exceptions.ClientError as exc:
+            if exc.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return (datetime.now(timezone.utc) - r['LastModified']).total_seconds() <= ttl
+
+
+class LocalDerivativeStore(DerivativeStore):
+    """
+    Stores derivatives as files in a local directory, next to a small JSON sidecar with their metadata.
+    Mostly useful for tests and local development.
+    """
+
+    def __init__(self, directory: str) -> None:
+        super().__init__()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _get(self, key: str) -> Optional[CachedDerivative]:
+        path = self._path(key)
+        try:
+            with open(f'{path}.json') as fin:
+                meta = json.load(fin)
+            with open(path, 'rb') as fin:
+                image_data = fin.read()
+        except FileNotFoundError:
+            return None
+        return image_data, meta['content_type'], meta['ratio']
+
+    def _exists(self, key: str) -> bool:
+        return os.path.exists(f'{self._path(key)}.json')
+
+    def _lock(self, key: str, ttl: float) -> bool:
+        # O_EXCL only creates the lock file if nobody holds it, also across processes sharing the directory.
+        path = f'{self._path(key)}.lock'
+        for _ in range(2):
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                pass
+            if self._is_locked(key, ttl):
+                return False
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return False
+
+    def _unlock(self, key: str) -> None:
+        try:
+            os.remove(f'{self._path(key)}.lock')
+        except FileNotFoundError:
+            pass
+
+    def _is_locked(self, key: str, ttl: float) -> bool:
+        try:
+            return time.time() - os.path.getmtime(f'{self._path(key)}.lock') <= ttl
+        except FileNotFoundError:
+            return False
+
+    def _put(self, key: str, image_data: bytes, content_type: str, ratio: float) -> None:
+        path = self._path(key)
+        with open(path, 'wb') as fout:
+            fout.write(image_data)
+        # The sidecar is written last, so a partially written derivative is never served.
+        with open(f'{path}.json', 'w') as fout:
+            json.dump({'content_type': content_type, 'ratio': ratio}, fout)
+
+
+def create_derivative_store(bucket_name: Optional[str],
+                            prefix: str = '',
+                            directory: Optional[str] = None,
+                            client=None) -> Optional[DerivativeStore]:
+    """
+    Creates the configured derivative store, preferring S3 over a local directory.
+
+    Returns:
+        Optional[DerivativeStore]: The store or None if derivative caching is disabled.
+    """
+    if bucket_name:
+        logger.info("Using S3 derivative cache: s3://%s/%s", bucket_name, prefix)
+        return S3DerivativeStore(client, bucket_name, prefix)
+    if directory:
+        logger.info("Using local derivative cache: %s", directory)
+        return LocalDerivativeStore(directory)
+    return None
@@ -0,0 +1,70 @@
+import os
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, Optional, Tuple, TypeVar
+
+from imaginex_lambda.lib.utils import logger
+
+T = TypeVar('T')
+
+# The lock of a derivative in the store (see `DerivativeStore.lock`) is considered abandoned after STORE_LOCK_TTL
+# seconds, other instances wait for the derivative at most STORE_LOCK_WAIT seconds before producing it themselves.
+STORE_LOCK_TTL = float(os.getenv('DERIVATIVE_CACHE_LOCK_TTL', 30))
+STORE_LOCK_WAIT = float(os.getenv('DERIVATIVE_CACHE_LOCK_WAIT', 10))
+STORE_LOCK_POLL = float(os.getenv('DERIVATIVE_CACHE_LOCK_POLL', 0.2))
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls for the same key: the first caller (the leader) runs the function, callers arriving
+    while it runs (the followers) wait for its result, or its exception, instead of running it again.
+
+    Only calls in flight are shared, a call made after the leader has finished runs again.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> Tuple[T, bool]:
+        """
+        Runs `fn`, unless a call with the same key is already running, in which case its result is returned instead.
+
+        Returns:
+            Tuple[T, bool]: The result and whether it was shared from another caller.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            logger.info("Waiting for the identical request in flight")
+            return future.result(), True
+
+        try:
+            result = fn()
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+def create_single_flight(enabled: bool) -> Optional[SingleFlight]:
+    """
+    Creates the deduplication of concurrent identical requests.
+
+    Returns:
+        Optional[SingleFlight]: The single flight or None if it is disabled.
+    """
+    return SingleFlight() if enabled else None
@@ -1,4 +1,5 @@
 import json
+from typing import Dict, Optional
 
 
 class HandlerError(Exception):
@@ -9,6 +10,16 @@ class HandlerError(Exception):
         self.code = code
 
 
+class NotModified(HandlerError):
+    """
+    Raised when a conditional request matches the current version of the image, before anything is downloaded.
+    """
+
+    def __init__(self, validators: Dict[str, Optional[str]]) -> None:
+        super().__init__('Not Modified', code=304)
+        self.validators = validators
+
+
 def error(msg: str, code=422):
     return {
         'statusCode': code,
@@ -0,0 +1,21 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+
+def create_executor(workers: Optional[int] = None) -> Optional[ThreadPoolExecutor]:
+    """
+    Creates the thread pool used to run independent parts of the processing concurrently. Pillow releases the GIL
+    while resampling and encoding, so threads are enough to use all vCPUs of the lambda.
+
+    Args:
+        workers (Optional[int]): Number of worker threads, defaults to the number of CPUs.
+
+    Returns:
+        Optional[ThreadPoolExecutor]: The executor or None if only a single worker is configured, in which case
+        everything runs serially on the calling thread.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1:
+        return None
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='imaginex')
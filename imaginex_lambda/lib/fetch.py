@@ -0,0 +1,107 @@
+import os
+from collections import deque
+from concurrent.futures import Executor, Future
+from typing import TYPE_CHECKING, Callable, Deque, Iterator, Optional, Sequence, TypeVar
+
+# botocore and requests take a good part of the cold start to import, they are only imported on first use.
+if TYPE_CHECKING:
+    from requests import Session
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+# The HTTP session and the S3 client live in module state, so warm invocations reuse their keep-alive connections.
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 3))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 20))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 2))
+HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', 0.2))
+
+HTTP_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+
+def create_http_session(pool_size: int = HTTP_POOL_SIZE,
+                        retries: int = HTTP_RETRIES,
+                        backoff: float = HTTP_RETRY_BACKOFF) -> 'Session':
+    """
+    Creates an HTTP session with a keep-alive connection pool, retrying connection errors and transient (429, 5xx)
+    responses with exponential backoff.
+
+    Args:
+        pool_size (int): Maximum number of connections kept open per host.
+        retries (int): Maximum number of retries of a request.
+        backoff (float): Backoff factor between retries, in seconds.
+
+    Returns:
+        Session: The configured session.
+    """
+    from requests import Session
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(total=retries,
+                  backoff_factor=backoff,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=('GET', 'HEAD'),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def create_s3_client(pool_size: int = HTTP_POOL_SIZE,
+                     connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+                     read_timeout: float = HTTP_READ_TIMEOUT,
+                     retries: int = HTTP_RETRIES):
+    """
+    Creates an S3 client with the same pool size, timeouts and retry budget as the HTTP session.
+    """
+    import botocore.session
+    from botocore.config import Config
+
+    config = Config(max_pool_connections=pool_size,
+                    connect_timeout=connect_timeout,
+                    read_timeout=read_timeout,
+                    retries={'max_attempts': retries, 'mode': 'standard'})
+    return botocore.session.get_session().create_client('s3', config=config)
+
+
+def fetch_all(executor: Optional[Executor],
+              items: Sequence[T],
+              fetch: Callable[[T], R],
+              limit: int = HTTP_POOL_SIZE,
+              release: Optional[Callable[[R], None]] = None) -> Iterator[R]:
+    """
+    Fetches the items on `executor`, at most `limit` ahead of the one being consumed, and yields the results in the
+    order of `items` as soon as each is available, so the caller can process one result while the following ones are
+    still downloading. Without an executor, the items are fetched one at a time on the calling thread.
+
+    When a fetch fails or the caller stops early, the fetches not started yet are cancelled and the results of those
+    already running are passed to `release` (e.g. to close their buffers), so no download outlives the iteration.
+    """
+    if executor is None:
+        for item in items:
+            yield fetch(item)
+        return
+
+    pending: Deque['Future[R]'] = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(fetch, item))
+            if len(pending) >= limit:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            if future.cancel():
+                continue
+            try:
+                result = future.result()
+            except Exception:
+                continue
+            if release is not None:
+                release(result)
@@ -1,59 +1,165 @@
 import os
-import shutil
-from contextlib import ExitStack
+import threading
+from concurrent.futures import Executor, Future
+from contextlib import ExitStack, closing
 from io import BytesIO
 from tempfile import TemporaryFile
-from typing import IO, Tuple, Dict, Any, Optional
-from urllib.request import urlopen
+from typing import IO, Tuple, Dict, Any, Optional, List
 from urllib.parse import unquote
 
-import botocore.session
-from PIL import Image
+from PIL import Image, ImageSequence
 
-from imaginex_lambda.lib.exceptions import HandlerError
-from imaginex_lambda.lib.utils import is_absolute, is_s3, get_extension, logger, is_landscape
+from imaginex_lambda.lib.cache import DerivativeStore, derivative_key, response_validators
+from imaginex_lambda.lib.coalesce import SingleFlight, STORE_LOCK_TTL, STORE_LOCK_WAIT, STORE_LOCK_POLL
+from imaginex_lambda.lib.exceptions import HandlerError, NotModified
+from imaginex_lambda.lib.fetch import create_http_session, create_s3_client, fetch_all, HTTP_TIMEOUT, HTTP_POOL_SIZE
+from imaginex_lambda.lib.limits import check_animation_pixels, check_source_bytes, copy_limited, decode_budget, \
+    output_budget
+from imaginex_lambda.lib.lru import LRUCache
+from imaginex_lambda.lib.metadata import apply_metadata, encoder_metadata, exif_orientation, has_metadata_changes, \
+    has_pending_metadata, oriented_size, strip_metadata
+from imaginex_lambda.lib.metrics import stage, metric
+from imaginex_lambda.lib.quality import search_quality, AUTO_QUALITY_MAX
+from imaginex_lambda.lib.resize import crop_box, fit_size, prepare_mode, reduction_size, resample, restore_palette, \
+    validate_fit
+from imaginex_lambda.lib.utils import is_absolute, is_s3, get_extension, logger, http_date, \
+    accepted_formats, negotiate_format, is_not_modified, ANIMATED_FORMATS
 
 # Pillow supported formats:
 # BLP, BMP, DDS, DIB, EPS, GIF, ICNS, ICO, IM, JPG, JPEG, MSP, PCX, PNG, PPM, SPIDER, TGA, TIFF, WEBP, XBM
 
-session = botocore.session.get_session()
-s3_client = session.create_client('s3')
+# The HTTP session and the S3 client are created on first use, so cold starts which never touch S3 (or fail
+# validation) skip creating them. Once created, they are plain module attributes, which tests can patch.
+_clients_lock = threading.Lock()
+
+
+def get_http_session():
+    session = globals().get('http_session')
+    if session is None:
+        with _clients_lock:
+            session = globals().get('http_session')
+            if session is None:
+                session = globals()['http_session'] = create_http_session()
+    return session
+
+
+def get_s3_client():
+    client = globals().get('s3_client')
+    if client is None:
+        with _clients_lock:
+            client = globals().get('s3_client')
+            if client is None:
+                client = globals()['s3_client'] = create_s3_client()
+    return client
+
+
+def __getattr__(name: str):
+    if name == 'http_session':
+        return get_http_session()
+    if name == 's3_client':
+        return get_s3_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 # @TODO: Add placeholder image for errors.
 
-def download_image(buffer: IO[bytes], img_url: str, chunk_size: int = 1024) -> Tuple[IO[bytes], Dict[str, Any]]:
+def read_into_memory(stream: IO[bytes], content_length: Optional[int], chunk_size: int = 64 * 1024) -> BytesIO:
+    """
+    Reads a response body into memory, without going through a temporary file. Bodies larger than the source byte
+    budget (`MAX_SOURCE_BYTES`) are rejected upfront when their size is known, and as soon as they exceed it otherwise.
+
+    When the content length is known, the buffer is allocated once, up front, and the stream writes straight into its
+    storage (`readinto` on a view of the buffer), so the body is never copied. Otherwise, the buffer grows as chunks
+    arrive.
+
+    Args:
+        stream (IO[bytes]): The response body to read.
+        content_length (Optional[int]): The size of the body, if known.
+        chunk_size (int): The chunk size to use when the stream does not support `readinto` or the size is unknown.
+
+    Returns:
+        BytesIO: Buffer with the body, positioned at its start.
+
+    Raises:
+        HandlerError: If the body is over the source byte budget.
+    """
+    buffer = BytesIO()
+    if not content_length:
+        copy_limited(stream, buffer, chunk_size)
+        buffer.seek(0)
+        return buffer
+
+    check_source_bytes(content_length)
+
+    buffer.seek(content_length - 1)
+    buffer.write(b'\0')
+
+    readinto = getattr(stream, 'readinto', None)
+    read = 0
+    with buffer.getbuffer() as view:
+        while read < content_length:
+            if readinto is not None:
+                n = readinto(view[read:])
+            else:
+                chunk = stream.read(min(chunk_size, content_length - read))
+                n = len(chunk)
+                view[read:read + n] = chunk
+            if not n:
+                break
+            read += n
+
+    if read < content_length:
+        raise Exception(f'incomplete download, received {read} of {content_length} bytes')
+
+    buffer.seek(0)
+    return buffer
+
+
+def download_image(buffer: Optional[IO[bytes]], img_url: str, chunk_size: int = 64 * 1024) \
+        -> Tuple[IO[bytes], Dict[str, Any]]:
     """
     Function responsible for downloading an image file from a given URL and writing its contents to a buffer.
     It takes two arguments, buffer and img_url, and returns a dictionary containing information about the downloaded
     image.
 
     Args:
-        buffer: (IO[bytes]) A file-like object that the downloaded image will be written to.
+        buffer: (Optional[IO[bytes]]) A file-like object that the downloaded image will be written to. If None, the
+            image is read into memory (see `read_into_memory`).
         img_url: (str) A string representing the URL of the image to be downloaded.
+        chunk_size (int): The chunk size to use when downloading the image.
     Returns:
         Tuple[IO[bytes], Dict[str, Any]]: dictionary containing information about the downloaded image
     """
     logger.info("Downloading image from %s", img_url)
 
-    with urlopen(img_url) as r:
-        content_type = r.headers['content-type']
-        content_size = int(r.headers['content-length'])
+    with get_http_session().get(img_url, stream=True, timeout=HTTP_TIMEOUT) as r:
+        r.raise_for_status()
+        content_type = r.headers.get('content-type')
+        content_size = int(r.headers.get('content-length') or 0)
+        etag = r.headers.get('etag')
+        last_modified = r.headers.get('last-modified')
 
-        shutil.copyfileobj(r, buffer, chunk_size)
+        # Content-Length is the size on the wire, which does not match the body of compressed responses.
+        r.raw.decode_content = True
+        if buffer is None:
+            buffer = read_into_memory(r.raw, None if r.headers.get('content-encoding') else content_size, chunk_size)
+        else:
+            copy_limited(r.raw, buffer, chunk_size)
 
     logger.info("Downloaded image from %s. Content type: %s, content size: %d", img_url, content_type, content_size)
-    return buffer, {'content_type': content_type, 'content_size': content_size}
+    return buffer, {'content_type': content_type, 'content_size': content_size, 'etag': etag,
+                    'last_modified': last_modified}
 
 
-def get_s3_image(buffer: IO[bytes], bucket_name: str, key: str, chunk_size: int = 1024) \
+def get_s3_image(buffer: Optional[IO[bytes]], bucket_name: str, key: str, chunk_size: int = 64 * 1024) \
         -> Tuple[IO[bytes], Dict[str, Any]]:
     """
     Function responsible for downloading an image file from an Amazon S3 bucket and writing its contents to a buffer.
     It takes two arguments, buffer and key, and returns a dictionary containing information about the downloaded image.
 
     Args:
-        buffer (IO[bytes]): The buffer to write the downloaded image contents to.
+        buffer (Optional[IO[bytes]]): The buffer to write the downloaded image contents to. If None, the image is read
+            into memory (see `read_into_memory`).
         bucket_name (str): The name of the S3 bucket to download the image from.
         key (str): The key of the S3 object to download.
         chunk_size (int): The chunk size to use when downloading the image.
@@ -70,24 +176,406 @@ def get_s3_image(buffer: IO[bytes], bucket_name: str, key: str, chunk_size: int
         raise Exception('must specify a value for S3_BUCKET_NAME for S3 support')
 
     logger.info("Downloading image from S3 with key: %s", key)
-    r = s3_client.get_object(Bucket=bucket_name, Key=key)
+    r = get_s3_client().get_object(Bucket=bucket_name, Key=key)
 
     content_type = r['ContentType']
     content_size = r['ContentLength']
 
     with r['Body'] as fin:
-        shutil.copyfileobj(fin, buffer, chunk_size)
+        if buffer is None:
+            buffer = read_into_memory(fin, content_size, chunk_size)
+        else:
+            copy_limited(fin, buffer, chunk_size)
 
     logger.info("Downloaded image from S3 with key: %s. Content type: %s, content size: %d", key, content_type,
                 content_size)
-    return buffer, {'content_type': content_type, 'content_size': content_size}
+    return buffer, {'content_type': content_type, 'content_size': content_size, 'etag': r.get('ETag'),
+                    'last_modified': http_date(r.get('LastModified'))}
+
+
+def head_source(url: str, bucket_name: str) -> Dict[str, Any]:
+    """
+    Retrieves information about the source image without downloading its contents, using a HEAD request for absolute
+    URLs and `head_object` for S3 objects.
+
+    Args:
+        url (str): The URL of the image, in any of the forms accepted by `download_and_optimize`.
+        bucket_name (str): The name of the S3 bucket used for relative URLs.
+
+    Returns:
+        Dict[str, Any]: A dictionary with the content_type, content_size, etag and last_modified of the source.
+    """
+    if is_absolute(url) and not is_s3(url):
+        logger.info("Fetching image headers from %s", url)
+        with get_http_session().head(url, allow_redirects=True, timeout=HTTP_TIMEOUT) as r:
+            r.raise_for_status()
+            return {
+                'content_type': r.headers.get('content-type'),
+                'content_size': int(r.headers.get('content-length') or 0),
+                'etag': r.headers.get('etag'),
+                'last_modified': r.headers.get('last-modified'),
+            }
+
+    bucket_name, key = split_s3_url(url, bucket_name)
+    if not bucket_name:
+        raise Exception('must specify a value for S3_BUCKET_NAME for S3 support')
+
+    logger.info("Fetching image headers from S3 with key: %s", key)
+    r = get_s3_client().head_object(Bucket=bucket_name, Key=key)
+    return {
+        'content_type': r['ContentType'],
+        'content_size': r['ContentLength'],
+        'etag': r.get('ETag'),
+        'last_modified': http_date(r.get('LastModified')),
+    }
+
+
+def probe_source(url: str, bucket_name: str, probe_size: int) -> Dict[str, Any]:
+    """
+    Fetches only the first `probe_size` bytes of the source image (HTTP `Range` / S3 `Range=`), enough to sniff its
+    format and, for most files, its dimensions.
+
+    Args:
+        url (str): The URL of the image, in any of the forms accepted by `download_and_optimize`.
+        bucket_name (str): The name of the S3 bucket used for relative URLs.
+        probe_size (int): The number of bytes to fetch.
+
+    Returns:
+        Dict[str, Any]: A dictionary with the probed `data`, whether it is the `complete` image, and the content_type,
+        content_size (of the whole image, if known), etag and last_modified of the source.
+    """
+    byte_range = f'bytes=0-{probe_size - 1}'
+
+    if is_absolute(url) and not is_s3(url):
+        logger.info("Probing image from %s", url)
+        with get_http_session().get(url, headers={'Range': byte_range}, stream=True, timeout=HTTP_TIMEOUT) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            headers = r.headers
+            if r.status_code == 206:
+                data = r.raw.read(probe_size)
+            else:
+                # Servers without range support send the whole image, which is then kept instead of fetched again,
+                # within the source byte budget.
+                content_length = int(headers.get('content-length') or 0)
+                data = read_into_memory(r.raw, None if headers.get('content-encoding') else content_length).getvalue()
+            content_range = headers.get('content-range')
+            if r.status_code != 206:
+                content_size = len(data)
+            elif content_range and not content_range.endswith('/*'):
+                content_size = int(content_range.rsplit('/', 1)[1])
+            else:
+                content_size = None
+            info = {
+                'content_type': headers.get('content-type'),
+                'etag': headers.get('etag'),
+                'last_modified': headers.get('last-modified'),
+            }
+    else:
+        bucket_name, key = split_s3_url(url, bucket_name)
+        if not bucket_name:
+            raise Exception('must specify a value for S3_BUCKET_NAME for S3 support')
+
+        logger.info("Probing image from S3 with key: %s", key)
+        r = get_s3_client().get_object(Bucket=bucket_name, Key=key, Range=byte_range)
+        with r['Body'] as fin:
+            data = fin.read()
+        content_range = r.get('ContentRange')
+        content_size = int(content_range.rsplit('/', 1)[1]) if content_range else len(data)
+        info = {
+            'content_type': r['ContentType'],
+            'etag': r.get('ETag'),
+            'last_modified': http_date(r.get('LastModified')),
+        }
+
+    complete = content_size is not None and len(data) >= content_size
+    logger.info("Probed %d bytes of the image, complete: %s", len(data), complete)
+    return {**info, 'data': data, 'complete': complete, 'content_size': content_size}
+
+
+def probe_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Reads the dimensions of the image, as displayed (see `exif_orientation`), from its (possibly truncated) header,
+    without decoding any pixels.
+
+    Returns:
+        Optional[Tuple[int, int]]: The size of the image or None if the header does not fit into `data`.
+    """
+    try:
+        with Image.open(BytesIO(data)) as img:
+            return oriented_size(img.size, exif_orientation(img))
+    except Exception as exc:
+        logger.info("Could not read image dimensions from the probe: %s", exc)
+        return None
+
+
+def probe_metadata_changes(data: bytes) -> bool:
+    """
+    Checks, from just the probed header of the image, whether its orientation, color profile or metadata would be
+    changed (see `has_metadata_changes`), True if the header does not fit into `data`.
+    """
+    try:
+        with Image.open(BytesIO(data)) as img:
+            return has_metadata_changes(img)
+    except Exception as exc:
+        logger.info("Could not read image metadata from the probe: %s", exc)
+        return True
+
+
+def probe_passthrough(data: bytes,
+                      width: Optional[int],
+                      height: Optional[int],
+                      formats: Tuple[str, ...],
+                      output_format: Optional[str],
+                      fit: Optional[str] = None) -> Optional[str]:
+    """
+    Decides, from just the probed header of the image, whether it can be served unchanged, i.e. it is already no
+    larger than requested, stays in its format and has no metadata to strip or convert.
+
+    Returns:
+        Optional[str]: The content type of the image if it can be passed through, None otherwise.
+
+    Raises:
+        HandlerError: If the image format is not supported.
+    """
+    mime = get_extension(data)
+    # A probe cannot tell whether the image is animated, which changes the negotiated format, so images in formats
+    # which can be are only passed through when they keep their format either way.
+    negotiated = {negotiate_format(mime['extension'], mime['content_type'], formats, output_format, animated)
+                  for animated in ((False, True) if mime['extension'] in ANIMATED_FORMATS else (False,))}
+    if len(negotiated) > 1:
+        return None
+    extension, content_type = negotiated.pop()
+    if extension != mime['extension']:
+        return None
+
+    dimensions = probe_dimensions(data)
+    if dimensions is None or fit_size(dimensions, width, height, fit) is not None or probe_metadata_changes(data):
+        return None
+    return content_type
+
+
+def image_info(url: str, bucket_name: str, probe_size: int = 64 * 1024) -> Dict[str, Any]:
+    """
+    Returns the format and dimensions of an image, using only a probe of its first bytes when possible.
+
+    Args:
+        url (str): The URL of the image, in any of the forms accepted by `download_and_optimize`.
+        bucket_name (str): The name of the S3 bucket used for relative URLs.
+        probe_size (int): The number of bytes to probe.
+
+    Returns:
+        Dict[str, Any]: A dictionary with the format, content_type, width, height and size (in bytes) of the image.
+
+    Raises:
+        HandlerError: If `url` is empty or the image format is not supported.
+    """
+    if not url:
+        raise HandlerError('url is required')
+
+    probe = probe_source(url, bucket_name, probe_size)
+    mime = get_extension(probe['data'])
+    dimensions = probe_dimensions(probe['data'])
+    content_size = probe['content_size']
+
+    if dimensions is None and not probe['complete']:
+        logger.info("Image header does not fit into the probe, downloading the whole image")
+        buffer, info = fetch_source(None, url, bucket_name)
+        content_size = buffer.seek(0, os.SEEK_END)
+        with Image.open(buffer) as img:
+            dimensions = oriented_size(img.size, exif_orientation(img))
+
+    if dimensions is None:
+        raise HandlerError('Unsupported image format')
+
+    return {
+        'format': mime['extension'],
+        'content_type': mime['content_type'],
+        'width': dimensions[0],
+        'height': dimensions[1],
+        'size': content_size,
+    }
+
+
+def fetch_source(buffer: Optional[IO[bytes]],
+                 url: str,
+                 bucket_name: str,
+                 chunk_size: int = 64 * 1024,
+                 memory_cache: Optional[LRUCache] = None,
+                 source: Optional[Dict[str, Any]] = None) -> Tuple[IO[bytes], Dict[str, Any]]:
+    """
+    Downloads the source image from either an absolute URL or S3, reusing a copy from the in-process cache when
+    possible.
+
+    Args:
+        buffer (Optional[IO[bytes]]): The buffer to write the downloaded image contents to, None to read it into memory.
+        url (str): The URL of the image, in any of the forms accepted by `download_and_optimize`.
+        bucket_name (str): The name of the S3 bucket used for relative URLs.
+        chunk_size (int): The chunk size to use when downloading the image.
+        memory_cache (Optional[LRUCache]): In-process cache to look the source up in and store it to.
+        source (Optional[Dict[str, Any]]): Fresh information about the source (see `head_source`). When given, a
+            cached copy is only reused if its ETag matches.
+
+    Returns:
+        Tuple[IO[bytes], Dict[str, Any]]: The buffer with the image contents and information about the image.
+    """
+    cache_key = ('source', url)
+    if memory_cache is not None:
+        cached = memory_cache.get(cache_key)
+        if cached is not None:
+            data, info = cached
+            if source is None or source.get('etag') == info.get('etag'):
+                logger.info("Using source image from in-memory cache")
+                return BytesIO(data), info
+
+    if is_absolute(url) and not is_s3(url):
+        buffer, info = download_image(buffer, url, chunk_size)
+    else:
+        s3_bucket, key = split_s3_url(url, bucket_name)
+        buffer, info = get_s3_image(buffer, s3_bucket, key, chunk_size)
+
+    if memory_cache is not None:
+        if isinstance(buffer, BytesIO):
+            data = buffer.getvalue()
+        else:
+            buffer.seek(0)
+            data = buffer.read()
+        memory_cache.put(cache_key, (data, info), len(data))
+
+    return buffer, info
+
+
+def split_s3_url(url: str, bucket_name: str) -> Tuple[str, str]:
+    """
+    Splits an S3 image URL into the bucket name and the object key. URLs in the `s3://bucket/key` form carry their own
+    bucket, relative URLs are resolved against `bucket_name`.
+    """
+    if is_s3(url):
+        dynamic_bucket, key = unquote(url).replace('s3://', '').split('/', 1)
+        logger.info("Dynamic bucket: %s", dynamic_bucket)
+        return dynamic_bucket, key
+    return bucket_name, url.strip('/')
+
+
+def reduce_on_load(img: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    """
+    Decodes the image at the smallest power-of-two scale that is still at least `size`, so the final resample works
+    on (and keeps in memory) as few pixels as possible.
+
+    JPEG images are scaled by the decoder itself (DCT scaling via `Image.draft`), so the full resolution is never
+    materialized. Other formats are decoded fully and then reduced with the cheap `Image.reduce` box filter.
+
+    Args:
+        img (PIL.Image): The opened, not yet loaded, image.
+        size (Tuple[int, int]): The final size the image will be resampled to.
+
+    Returns:
+        PIL.Image: Either the same image (drafted in place) or a new, reduced one.
+    """
+    if img.format in ('JPEG', 'MPO'):
+        original = img.size
+        img.draft(img.mode, size)
+        if img.size != original:
+            logger.info(f"Decoding JPEG at reduced scale: {img.width}x{img.height}px")
+        return img
+
+    # Averaging palette indices or bilevel pixels makes no sense, those are resampled with NEAREST anyway.
+    if img.mode in ('1', 'P'):
+        return img
+
+    factor = 1
+    while img.width // (factor * 2) >= size[0] and img.height // (factor * 2) >= size[1]:
+        factor *= 2
+    if factor == 1:
+        return img
+
+    logger.info(f"Reducing image by a factor of {factor} before resampling")
+    return img.reduce(factor)
+
+
+def pixel_bytes(img: Image.Image) -> int:
+    """
+    Returns the size of the decoded pixel data of the image.
+    """
+    return img.width * img.height * len(img.getbands())
+
+
+def is_animated(buffer: IO[bytes]) -> bool:
+    """
+    Checks whether the image in the buffer has more than one frame, without decoding it, and rewinds the buffer.
+    """
+    buffer.seek(0)
+    with Image.open(buffer) as img:
+        animated = getattr(img, 'is_animated', False)
+    buffer.seek(0)
+    return animated
+
+
+def optimize_animation(img: Image.Image,
+                       ext: str,
+                       quality: int,
+                       size: Optional[Tuple[int, int]],
+                       fit: Optional[str] = None) -> bytes:
+    """
+    Resizes every frame of an animated image and encodes them as an animated GIF or WebP, keeping the frame durations,
+    the loop count and, for GIFs, the disposal methods.
+
+    Frames are decoded lazily, one at a time, and resized straight away, so only the current source frame and the
+    (already resized) output frames are kept in memory, which Pillow's encoders need as a whole anyway. Their total
+    size is checked against the animation pixel budget before every frame is decoded. GIFs are resampled with NEAREST,
+    which introduces no colors outside the source palette and keeps transparency exact.
+
+    Args:
+        img (PIL.Image): The opened animated image.
+        ext (str): The Pillow format to encode the animation in, one of `ANIMATED_FORMATS`.
+        quality (int): The quality of the compressed frames (WebP only).
+        size (Optional[Tuple[int, int]]): The size to resize the frames to, None to keep it.
+        fit (Optional[str]): The fit mode `size` was computed for, see `fit_size`.
+
+    Returns:
+        bytes: Encoded animation data
+
+    Raises:
+        HandlerError: If the frames are over the animation pixel budget.
+    """
+    box = crop_box(img.size, size, fit) if size is not None else None
+    frames, durations, disposals = [], [], []
+    for frame in ImageSequence.Iterator(img):
+        check_animation_pixels(len(frames) + 1, size or img.size)
+        # WebP only reads the frame duration when the frame is loaded.
+        frame.load()
+        durations.append(frame.info.get('duration', 0))
+        disposals.append(getattr(frame, 'disposal_method', 0))
+        if size is None:
+            # Seeking to the next frame reuses the decoded image, so it has to be copied.
+            frames.append(frame.copy())
+            continue
+        if ext != 'GIF' and frame.mode not in ('RGB', 'RGBA'):
+            frame = frame.convert('RGBA')
+        frames.append(resample(frame, size, box, Image.Resampling.NEAREST if ext == 'GIF' else None))
+    logger.info(f"Processed {len(frames)} frames of the animation")
+
+    options = {'save_all': True, 'append_images': frames[1:], 'duration': durations}
+    if ext == 'GIF':
+        options.update(optimize=True, disposal=disposals)
+        if 'loop' in img.info:
+            options['loop'] = img.info['loop']
+    else:
+        # GIFs without a loop count play once, WebP has no way to leave it out.
+        options.update(quality=quality, background=(0, 0, 0, 0), loop=img.info.get('loop', 1))
+
+    with BytesIO() as tmp:
+        frames[0].save(tmp, format=ext, **options)
+        return tmp.getvalue()
 
 
 def optimize_image(buffer: IO[bytes],
                    ext: str,
-                   quality: int,
+                   quality: Optional[int],
                    width: Optional[int] = None,
-                   height: Optional[int] = None) -> bytes:
+                   height: Optional[int] = None,
+                   max_bytes: Optional[int] = None,
+                   fit: Optional[str] = None) -> bytes:
     """
     The optimize_image function is designed to optimize an image that is passed in. It resizes the image
     to the given width (if necessary), compresses the image to reduce its size, and returns the optimized image data.
@@ -101,6 +589,8 @@ def optimize_image(buffer: IO[bytes],
             this width.
         height (Optional[int]): the maximum height of the image. If the image is wider than this value, it will be resized to fit within
             this height.
+        max_bytes (Optional[int]): the largest acceptable size of the optimized image, see `encode_image`.
+        fit (Optional[str]): how the image is fitted into `width` and `height` when both are given, see `fit_size`.
     Returns:
         bytes: Optimized image data
     """
@@ -110,99 +600,567 @@ def optimize_image(buffer: IO[bytes],
     with ExitStack() as stack:
         img = stack.enter_context(Image.open(buffer))
 
-        if width is not None and height is not None:
-            if is_landscape(img):
-                logger.info("Image is in landscape orientation, using width")
-                height = None
-            else:
-                logger.info("Image is in portrait orientation, using height")
-                width = None
-
-        if width and width < img.width:
-            logger.info(f"Resizing image given width {width}px...")
-            new_height = int(width * img.height / img.width)
-            logger.info(f"New height: {new_height}px")
-            img = stack.enter_context(img.resize((width, new_height)))
-            logger.info(f"Resized image to width:{width}px and height: {new_height}px")
-        elif height and height < img.height:
-            logger.info(f"Resizing image to the given {height}px...")
-            new_width = int(height * img.width / img.height)
-            logger.info(f"New width: {new_width}px")
-            img = stack.enter_context(img.resize((new_width, height)))
-            logger.info(f"Resized image to width: {new_width}px and height: {height}px")
-        tmp = stack.enter_context(BytesIO())
-        img.save(tmp, quality=quality, optimize=True, format=ext)
-        tmp.seek(0)
+        draft_size = decode_budget(img.size, img.format)
+
+        if getattr(img, 'is_animated', False) and ext in ANIMATED_FORMATS:
+            new_size = budgeted_size(img.size, width, height, fit)
+            with stage('animation') as animation_stage:
+                # Animations are encoded once, the quality search would encode every frame several times.
+                image_data = optimize_animation(img, ext, quality if quality is not None else AUTO_QUALITY_MAX,
+                                                new_size, fit)
+                animation_stage.bytes_out = len(image_data)
+            logger.info("Optimized animation!")
+            return image_data
+
+        # Sized as displayed, but resampled as stored, the image is turned the right way up once it is small.
+        orientation = exif_orientation(img)
+        new_size = budgeted_size(oriented_size(img.size, orientation), width, height, fit)
+        if new_size is not None:
+            new_size = oriented_size(new_size, orientation)
+
+        with stage('decode') as decode_stage:
+            if draft_size is not None and (new_size is None or new_size[0] > draft_size[0]):
+                # Over the pixel budget, the output gets as large as the reduced decode allows.
+                img.draft(img.mode, draft_size)
+                new_size = fit_size(img.size, *new_size, fit) if new_size is not None else None
+            elif new_size is not None:
+                reduced = reduce_on_load(img, reduction_size(img.size, new_size, fit))
+                if reduced is not img:
+                    img = stack.enter_context(reduced)
+            img.load()
+            strip_metadata(img)
+            decode_stage.bytes_out = pixel_bytes(img)
+
+        source_mode = img.mode
+        if new_size is not None:
+            with stage('resize', bytes_in=pixel_bytes(img)) as resize_stage:
+                converted = prepare_mode(img, [ext])
+                if converted is not img:
+                    img = stack.enter_context(converted)
+                img = stack.enter_context(resample(img, new_size, crop_box(img.size, new_size, fit)))
+                resize_stage.bytes_out = pixel_bytes(img)
+            logger.info(f"Resized image to width: {new_size[0]}px and height: {new_size[1]}px")
+
+        if has_pending_metadata(img, orientation):
+            with stage('metadata', bytes_in=pixel_bytes(img)):
+                transformed = apply_metadata(img, orientation)
+                if transformed is not img:
+                    img = stack.enter_context(transformed)
+
+        with stage('encode', bytes_in=pixel_bytes(img)) as encode_stage:
+            quantized = restore_palette(img, source_mode, ext)
+            if quantized is not img:
+                img = stack.enter_context(quantized)
+            image_data = encode_image(img, ext, quality, max_bytes)
+            encode_stage.bytes_out = len(image_data)
 
         logger.info("Optimized image!")
-        return tmp.read()
+        return image_data
+
+
+def budgeted_size(size: Tuple[int, int],
+                  width: Optional[int],
+                  height: Optional[int],
+                  fit: Optional[str] = None) -> Optional[Tuple[int, int]]:
+    """
+    Like `fit_size`, but also shrinks the output to the output pixel budget (see `output_budget`).
+    """
+    new_size = fit_size(size, width, height, fit)
+    limited = output_budget(new_size or size)
+    return limited if limited != size else None
+
+
+def encode_image(img: Image.Image, ext: str, quality: Optional[int], max_bytes: Optional[int] = None) -> bytes:
+    """
+    Encodes the image in the given format, converting its mode first when the format cannot store it.
+
+    Args:
+        img (PIL.Image): The image to encode.
+        ext (str): The Pillow format to encode the image in.
+        quality (Optional[int]): The quality of the compressed image, None (`q=auto`) to search for the lowest
+            quality which keeps the image perceptually close to the original (see `search_quality`).
+        max_bytes (Optional[int]): The largest acceptable size of the encoded image, lowering the quality as needed.
+
+    Returns:
+        bytes: Encoded image data
+    """
+    if quality is None or max_bytes:
+        image_data, quality = search_quality(img, ext, encode_image, quality, max_bytes)
+        metric('Quality', quality)
+        return image_data
+
+    with ExitStack() as stack:
+        if ext == 'JPEG' and img.mode not in ('RGB', 'L', 'CMYK'):
+            img = stack.enter_context(img.convert('RGB'))
+
+        tmp = stack.enter_context(BytesIO())
+        img.save(tmp, quality=quality, optimize=True, format=ext, **encoder_metadata(img))
+        return tmp.getvalue()
+
+
+def validate_max_bytes(max_bytes: Optional[int]) -> None:
+    """
+    Raises:
+        HandlerError: If `max_bytes` is given and less than or equal to zero.
+    """
+    if max_bytes is not None and max_bytes <= 0:
+        raise HandlerError('maxbytes must be greater than zero')
+
+
+def validate_size(width: Optional[int], height: Optional[int]) -> None:
+    """
+    Raises:
+        HandlerError: If `width` and `height` are both empty, or if `width` or `height` are less than or equal to zero.
+    """
+    if width is None and height is None:
+        raise HandlerError('Width or height must be defined')
+
+    if width is not None and width <= 0:
+        raise HandlerError('width must be greater than zero')
+
+    if height is not None and height <= 0:
+        raise HandlerError('height must be greater than zero')
+
+
+def transform_params(url: str,
+                     quality: Optional[int],
+                     width: Optional[int],
+                     height: Optional[int],
+                     formats: Tuple[str, ...],
+                     output_format: Optional[str],
+                     max_bytes: Optional[int] = None,
+                     fit: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Normalizes the parameters of a transformation, for use in cache keys.
+    """
+    params = {'url': url, 'quality': 'auto' if quality is None else quality, 'width': width, 'height': height,
+              'accept': formats, 'format': output_format and output_format.lower()}
+    if max_bytes:
+        # Only added when set, so the keys of existing derivatives stay the same.
+        params['max_bytes'] = max_bytes
+    if fit:
+        params['fit'] = fit
+    return params
+
+
+def check_not_modified(validators: Dict[str, Optional[str]],
+                       if_none_match: Optional[str],
+                       if_modified_since: Optional[str]) -> None:
+    """
+    Raises:
+        NotModified: If the conditional request headers match the validators of the image.
+    """
+    if is_not_modified(validators, if_none_match, if_modified_since):
+        logger.info("Image not modified")
+        raise NotModified(validators)
+
+
+def memory_cache_key(params: Dict[str, Any]) -> Tuple:
+    return ('derivative',) + tuple(sorted(params.items()))
 
 
 def download_and_optimize(url: str,
-                          quality: int,
+                          quality: Optional[int],
                           width: Optional[int],
                           height: Optional[int],
                           bucket_name: str,
-                          chunk_size: int = 1024) -> Tuple[bytes, str, float]:
+                          chunk_size: int = 64 * 1024,
+                          store: Optional[DerivativeStore] = None,
+                          details: Optional[Dict[str, Any]] = None,
+                          memory_cache: Optional[LRUCache] = None,
+                          download_mode: str = 'memory',
+                          accept: Optional[str] = None,
+                          output_format: Optional[str] = None,
+                          if_none_match: Optional[str] = None,
+                          if_modified_since: Optional[str] = None,
+                          probe_size: int = 0,
+                          max_bytes: Optional[int] = None,
+                          coalescer: Optional[SingleFlight] = None,
+                          store_lock: bool = False,
+                          fit: Optional[str] = None) -> Tuple[bytes, str, float]:
     """
     This is the function responsible for coordinating the download and optimization of the images. It should
     not concern itself with any lambda-specific information.
 
     Args:
         url (str): The URL of the image to download.
-        quality (int): The quality to optimize the image (0 to 100).
+        quality (Optional[int]): The quality to optimize the image (0 to 100), None to pick it per image (`q=auto`).
         width (Optional[int]): The width of the image to resize to.
         height (Optional[int]): The height of the image to resize to.
         bucket_name (str): The name of the S3 bucket to download the image from.
         chunk_size (int): The chunk size to use when downloading the image.
+        store (Optional[DerivativeStore]): Derivative cache consulted before downloading and written to on a miss.
+        details (Optional[Dict[str, Any]]): Dictionary filled with additional information about the processing,
+            such as the derivative cache status and the validators (etag, last_modified) of the image.
+        memory_cache (Optional[LRUCache]): In-process cache for source images and derivatives, kept across warm
+            invocations.
+        download_mode (str): Where to keep the downloaded source, either `memory` or `tempfile`.
+        accept (Optional[str]): The Accept header of the request, used to pick WebP/AVIF output for capable clients.
+        output_format (Optional[str]): Explicitly requested output format (e.g. `webp`), overrides `accept`.
+        if_none_match (Optional[str]): The If-None-Match header of the request.
+        if_modified_since (Optional[str]): The If-Modified-Since header of the request.
+        probe_size (int): When non-zero, only this many bytes of the source are fetched first, to reject unsupported
+            formats and pass through images which need neither resizing nor conversion before the full download.
+        max_bytes (Optional[int]): The largest acceptable size of the optimized image, the quality is lowered as
+            needed to fit it.
+        coalescer (Optional[SingleFlight]): Shares the result of a running identical request (same transform and
+            conditional headers) with concurrent ones, instead of processing the image once per request.
+        store_lock (bool): On a derivative cache miss, lock the derivative in the store while producing it, so other
+            instances wait for it instead of producing it too.
+        fit (Optional[str]): How the image is fitted into `width` and `height` when both are given (`contain`,
+            `cover` or `fill`, see `fit_size`), None to resize by the width or height depending on its orientation.
 
     Returns:
         Tuple[bytes, str, float]: A tuple containing the optimized image data, content type, and the compression ratio.
 
     Raises:
-        HandlerError: If `url` is empty, `width` and `height` are both empty or both provided, or if `width`
-        or `height` are less than or equal to zero.
+        HandlerError: If `url` is empty, `width` and `height` are both empty or both provided, if `width`
+        or `height` are less than or equal to zero, or if `fit` is not a known fit mode.
+        NotModified: If the conditional headers match the current version of the image. The source is only checked
+        with a HEAD request in that case, nothing is downloaded or decoded.
 
     """
 
     if not url:
         raise HandlerError('url is required')
 
-    if width is None and height is None:
-        raise HandlerError('Width or height must be defined')
+    validate_size(width, height)
+    validate_max_bytes(max_bytes)
+    validate_fit(fit)
 
-    if width is not None and width <= 0:
-        raise HandlerError('width must be greater than zero')
+    if details is None:
+        details = {}
 
-    if height is not None and height <= 0:
-        raise HandlerError('height must be greater than zero')
+    formats = accepted_formats(accept)
+    params = transform_params(url, quality, width, height, formats, output_format, max_bytes, fit)
+    memory_key = memory_cache_key(params)
+
+    if coalescer is not None:
+        def lead() -> Tuple[Tuple[bytes, str, float], Dict[str, Any]]:
+            leader_details: Dict[str, Any] = {}
+            result = download_and_optimize(url, quality, width, height, bucket_name, chunk_size, store, leader_details,
+                                           memory_cache, download_mode, accept, output_format, if_none_match,
+                                           if_modified_since, probe_size, max_bytes, store_lock=store_lock,
+                                           fit=fit)
+            return result, leader_details
+
+        (result, leader_details), shared = coalescer.do(memory_key + (if_none_match, if_modified_since), lead)
+        details.update(leader_details)
+        if shared:
+            details['coalesced'] = 'HIT'
+        return result
+
+    if memory_cache is not None:
+        cached = memory_cache.get(memory_key)
+        details['memory_cache'] = 'HIT' if cached else 'MISS'
+        if cached is not None:
+            result, validators = cached
+            details.update(validators)
+            check_not_modified(validators, if_none_match, if_modified_since)
+            logger.info("Returning image from in-memory cache")
+            return result
+
+    source = None
+    if store is not None or if_none_match or if_modified_since:
+        with stage('head'):
+            source = head_source(url, bucket_name)
+        validators = response_validators(params, source)
+        details.update(validators)
+        check_not_modified(validators, if_none_match, if_modified_since)
+
+    cache_key = None
+    locked = False
+    if store is not None:
+        cache_key = derivative_key(params, source)
+        if cache_key is None:
+            logger.info("Source has no ETag or Last-Modified, bypassing derivative cache")
+            details['cache'] = 'BYPASS'
+        else:
+            with stage('cache'):
+                cached = store.get(cache_key)
+            details.update(cache='HIT' if cached else 'MISS', cache_hits=store.hits, cache_misses=store.misses)
+            if cached is None and store_lock:
+                locked = store.lock(cache_key, STORE_LOCK_TTL)
+                if not locked:
+                    logger.info("Image is being produced by another instance, waiting for it")
+                    with stage('cacheWait'):
+                        cached = store.wait(cache_key, STORE_LOCK_WAIT, STORE_LOCK_TTL, STORE_LOCK_POLL)
+                    if cached is not None:
+                        details.update(cache='HIT', cache_hits=store.hits)
+            if cached is not None:
+                logger.info("Returning image from derivative cache")
+                if memory_cache is not None:
+                    memory_cache.put(memory_key, (cached, validators), len(cached[0]))
+                return cached
+
+    with ExitStack() as stack:
+        if locked:
+            # Released even if producing the image fails, so waiting instances stop waiting.
+            stack.callback(store.unlock, cache_key)
+
+        probe = None
+        passthrough_type = None
+        if probe_size and not (memory_cache is not None and memory_cache.get(('source', url))):
+            with stage('probe') as probe_stage:
+                probe = probe_source(url, bucket_name, probe_size)
+                probe_stage.bytes_out = len(probe['data'])
+            passthrough_type = probe_passthrough(probe['data'], width, height, formats, output_format, fit)
+            # Sources over the budgets are rejected before they are downloaded.
+            if probe['content_size']:
+                check_source_bytes(probe['content_size'])
+            dimensions = probe_dimensions(probe['data'])
+            if dimensions is not None:
+                decode_budget(dimensions, get_extension(probe['data'])['extension'])
 
-    with TemporaryFile() as buffer:
-        if is_s3(url):
-            dynamic_bucket, key = unquote(url).replace('s3://', '').split('/', 1)
-            logger.info("Dynamic bucket: %s", dynamic_bucket)
-            buffer, _ = get_s3_image(buffer, dynamic_bucket, key, chunk_size)
-        elif is_absolute(url):
-            buffer, _ = download_image(buffer, url, chunk_size)
+        if probe is not None and probe['complete']:
+            buffer, info = BytesIO(probe['data']), probe
         else:
-            key = url.strip('/')
-            buffer, _ = get_s3_image(buffer, bucket_name, key, chunk_size)
-
-        buffer.flush()
-        original = os.stat(buffer.name).st_size
-        mime = get_extension(buffer)
-        content_type = mime['content_type']
-        extension = mime['extension']
-
-        image_data = optimize_image(
-            buffer,
-            ext=extension,
-            quality=quality,
-            width=width,
-            height=height
-        )
-
-    ratio = len(image_data) / original if original != 0 else 0
-
-    logger.info("Returning image and metadata")
-    return image_data, content_type, ratio
+            buffer = stack.enter_context(TemporaryFile()) if download_mode == 'tempfile' else None
+            with stage('fetch') as fetch_stage:
+                buffer, info = fetch_source(buffer, url, bucket_name, chunk_size, memory_cache, source)
+                fetch_stage.bytes_out = buffer.seek(0, os.SEEK_END)
+        if source is None:
+            validators = response_validators(params, info)
+            details.update(validators)
+
+        original = buffer.seek(0, os.SEEK_END)
+        metric('BytesIn', original, 'Bytes')
+        if passthrough_type is not None and max_bytes and original > max_bytes:
+            passthrough_type = None
+        if passthrough_type is not None:
+            logger.info("Image needs no resizing or conversion, returning it unchanged")
+            buffer.seek(0)
+            image_data = buffer.read()
+            content_type = passthrough_type
+        else:
+            with stage('sniff', bytes_in=original):
+                mime = get_extension(buffer)
+                animated = mime['extension'] in ANIMATED_FORMATS and is_animated(buffer)
+                extension, content_type = negotiate_format(mime['extension'], mime['content_type'], formats,
+                                                           output_format, animated)
+            if extension != mime['extension']:
+                logger.info(f"Converting {mime['extension']} to {extension}")
+
+            image_data = optimize_image(
+                buffer,
+                ext=extension,
+                quality=quality,
+                width=width,
+                height=height,
+                max_bytes=max_bytes,
+                fit=fit
+            )
+
+        ratio = len(image_data) / original if original != 0 else 0
+        metric('BytesOut', len(image_data), 'Bytes')
+
+        if cache_key is not None:
+            with stage('cacheWrite', bytes_in=len(image_data)):
+                store.put(cache_key, image_data, content_type, ratio)
+        if memory_cache is not None:
+            memory_cache.put(memory_key, ((image_data, content_type, ratio), validators), len(image_data))
+
+        logger.info("Returning image and metadata")
+        return image_data, content_type, ratio
+
+
+def download_and_optimize_variants(url: Optional[str],
+                                   variants: List[Dict[str, Any]],
+                                   bucket_name: str,
+                                   chunk_size: int = 64 * 1024,
+                                   store: Optional[DerivativeStore] = None,
+                                   memory_cache: Optional[LRUCache] = None,
+                                   download_mode: str = 'memory',
+                                   accept: Optional[str] = None,
+                                   executor: Optional[Executor] = None) -> List[Tuple[bytes, str, float]]:
+    """
+    Produces several variants (e.g. all `srcset` breakpoints) of one or more images, downloading and decoding every
+    source only once. Variants are resampled progressively, each from the previous, larger one, and written to the
+    derivative store under the same keys as the equivalent single requests to `download_and_optimize`.
+
+    Sources are downloaded concurrently over the pooled connections, so the next source is usually ready while the
+    variants of the current one are being produced. With an executor, variants are also encoded concurrently while
+    the next ones are being resampled.
+
+    Args:
+        url (Optional[str]): The URL of the image to download, used for variants without their own `url`.
+        variants (List[Dict[str, Any]]): The variants to produce, each with `quality`, `width` and/or `height`, an
+            optional output `format`, `max_bytes` and `fit`, and an optional `url`.
+        bucket_name (str): The name of the S3 bucket to download the image from.
+        chunk_size (int): The chunk size to use when downloading the image.
+        store (Optional[DerivativeStore]): Derivative cache to write the variants to.
+        memory_cache (Optional[LRUCache]): In-process cache for the source image and the variants.
+        download_mode (str): Where to keep the downloaded source, either `memory` or `tempfile`.
+        accept (Optional[str]): The Accept header of the request, used to pick WebP/AVIF output for capable clients.
+        executor (Optional[Executor]): Executor to run downloads and encodes on, None to run everything serially.
+
+    Returns:
+        List[Tuple[bytes, str, float]]: The optimized image data, content type and compression ratio of every variant,
+        in the order of `variants`.
+
+    Raises:
+        HandlerError: If a variant has no url, no variants are given or any of them has an invalid size.
+    """
+    if not variants:
+        raise HandlerError('At least one variant must be defined')
+
+    sources: Dict[str, List[int]] = {}
+    for i, variant in enumerate(variants):
+        variant_url = variant.get('url') or url
+        if not variant_url:
+            raise HandlerError('url is required')
+        validate_size(variant.get('width'), variant.get('height'))
+        validate_max_bytes(variant.get('max_bytes'))
+        validate_fit(variant.get('fit'))
+        sources.setdefault(variant_url, []).append(i)
+
+    formats = accepted_formats(accept)
+    results: List[Optional[Tuple[bytes, str, float]]] = [None] * len(variants)
+
+    def fetch(source_url: str) -> Tuple[IO[bytes], Dict[str, Any]]:
+        buffer = TemporaryFile() if download_mode == 'tempfile' else None
+        return fetch_source(buffer, source_url, bucket_name, chunk_size, memory_cache)
+
+    def process(source_url: str, fetched: Tuple[IO[bytes], Dict[str, Any]]) -> None:
+        buffer, source = fetched
+        with buffer:
+            indices = sources[source_url]
+            produced = optimize_variants(buffer, [variants[i] for i in indices], formats, executor)
+            for i, result in zip(indices, produced):
+                results[i] = result
+                cache_variant(source_url, variants[i], formats, source, result, store, memory_cache)
+
+    source_urls = list(sources)
+    if len(source_urls) == 1:
+        process(source_urls[0], fetch(source_urls[0]))
+    else:
+        # Sources are downloaded ahead on the executor, while the current one is processed.
+        fetched_sources = fetch_all(executor, source_urls, fetch, HTTP_POOL_SIZE,
+                                    release=lambda fetched: fetched[0].close())
+        with closing(fetched_sources):
+            for source_url, fetched in zip(source_urls, fetched_sources):
+                process(source_url, fetched)
+
+    logger.info("Returning %d variants", len(variants))
+    return results
+
+
+def optimize_variants(buffer: IO[bytes],
+                      variants: List[Dict[str, Any]],
+                      formats: Tuple[str, ...],
+                      executor: Optional[Executor] = None) -> List[Tuple[bytes, str, float]]:
+    """
+    Decodes the image once and produces all of its variants, see `download_and_optimize_variants`.
+
+    Returns:
+        List[Tuple[bytes, str, float]]: The optimized image data, content type and compression ratio of every variant,
+        in the order of `variants`.
+    """
+    original = buffer.seek(0, os.SEEK_END)
+    mime = get_extension(buffer)
+
+    if mime['extension'] in ANIMATED_FORMATS and is_animated(buffer):
+        # Frames are decoded one at a time, so there is no decoded image to share, every variant is made on its own.
+        results = []
+        for variant in variants:
+            extension, content_type = negotiate_format(mime['extension'], mime['content_type'], formats,
+                                                       variant.get('format'), animated=True)
+            buffer.seek(0)
+            image_data = optimize_image(buffer, extension, variant['quality'], variant.get('width'),
+                                        variant.get('height'), variant.get('max_bytes'), variant.get('fit'))
+            results.append((image_data, content_type, len(image_data) / original if original != 0 else 0))
+        return results
+
+    with ExitStack() as stack:
+        img = stack.enter_context(Image.open(buffer))
+        draft_size = decode_budget(img.size, img.format)
+        orientation = exif_orientation(img)
+        displayed = oriented_size(img.size, orientation)
+        fits = [variant.get('fit') for variant in variants]
+        sizes = [oriented_size(budgeted_size(displayed, variant.get('width'), variant.get('height'), fits[i])
+                               or displayed, orientation) for i, variant in enumerate(variants)]
+        largest = max(sizes, key=lambda size: size[0] * size[1])
+        outputs = [negotiate_format(mime['extension'], mime['content_type'], formats, variant.get('format'))
+                   for variant in variants]
+
+        if draft_size is not None and largest[0] > draft_size[0]:
+            img.draft(img.mode, draft_size)
+            sizes = [fit_size(img.size, *size, fits[i]) or img.size for i, size in enumerate(sizes)]
+        else:
+            reductions = [reduction_size(img.size, size, fit) for size, fit in zip(sizes, fits)]
+            reduced = reduce_on_load(img, (max(w for w, _ in reductions), max(h for _, h in reductions)))
+            if reduced is not img:
+                img = stack.enter_context(reduced)
+        img.load()
+        strip_metadata(img)
+
+        source_mode = img.mode
+        converted = prepare_mode(img, [extension for extension, _ in outputs])
+        if converted is not img:
+            img = stack.enter_context(converted)
+        source = img
+
+        # Largest first, so every variant is resampled from the closest larger one rather than the full source.
+        order = sorted(range(len(variants)), key=lambda i: sizes[i][0] * sizes[i][1], reverse=True)
+        encoded = {}
+        queued = []
+        for i in order:
+            if fits[i] in ('cover', 'fill'):
+                # Cropped or stretched variants do not share the aspect ratio of the others, they are resampled from
+                # the source.
+                variant_img = source
+                if source.size != sizes[i]:
+                    box = crop_box(source.size, sizes[i], fits[i])
+                    variant_img = stack.enter_context(resample(source, sizes[i], box))
+            else:
+                if img.size != sizes[i]:
+                    img = stack.enter_context(resample(img, sizes[i]))
+                variant_img = img
+            if variant_img.size != source.size:
+                logger.info(f"Resized variant to width: {variant_img.width}px and height: {variant_img.height}px")
+
+            transformed = apply_metadata(variant_img, orientation)
+            if transformed is not variant_img:
+                variant_img = stack.enter_context(transformed)
+            extension, content_type = outputs[i]
+            quantized = restore_palette(variant_img, source_mode, extension)
+            if quantized is not variant_img:
+                variant_img = stack.enter_context(quantized)
+            quality, max_bytes = variants[i]['quality'], variants[i].get('max_bytes')
+            if executor is None:
+                encoded[i] = (encode_image(variant_img, extension, quality, max_bytes), content_type)
+            else:
+                if any(variant_img is other for other in queued):
+                    # `Image.save` keeps its options on the image, so concurrent encodes each need their own image.
+                    variant_img = stack.enter_context(variant_img.copy())
+                queued.append(variant_img)
+                encoded[i] = (executor.submit(encode_image, variant_img, extension, quality, max_bytes), content_type)
+
+        # The encodes must finish before the resampled images are closed by the exit stack.
+        results = []
+        for i in range(len(variants)):
+            image_data, content_type = encoded[i]
+            if isinstance(image_data, Future):
+                image_data = image_data.result()
+            results.append((image_data, content_type, len(image_data) / original if original != 0 else 0))
+        return results
+
+
+def cache_variant(url: str,
+                  variant: Dict[str, Any],
+                  formats: Tuple[str, ...],
+                  source: Dict[str, Any],
+                  result: Tuple[bytes, str, float],
+                  store: Optional[DerivativeStore] = None,
+                  memory_cache: Optional[LRUCache] = None) -> None:
+    """
+    Writes a variant to the caches, under the same keys as the equivalent single request.
+    """
+    params = transform_params(url, variant['quality'], variant.get('width'), variant.get('height'), formats,
+                              variant.get('format'), variant.get('max_bytes'), variant.get('fit'))
+    if store is not None:
+        cache_key = derivative_key(params, source)
+        if cache_key is not None:
+            store.put(cache_key, *result)
+    if memory_cache is not None:
+        memory_cache.put(memory_cache_key(params), (result, response_validators(params, source)), len(result[0]))
@@ -0,0 +1,125 @@
+import math
+import os
+from typing import IO, Optional, Tuple
+
+from PIL import Image
+
+from imaginex_lambda.lib.exceptions import HandlerError
+from imaginex_lambda.lib.utils import logger
+
+# Resource budgets, so the memory a request can take is known upfront and can be sized per lambda memory tier.
+# A decoded RGB(A) image takes 3-4 bytes per pixel, plus the resized copy.
+MAX_SOURCE_BYTES = int(os.getenv('MAX_SOURCE_BYTES', 50 * 1024 * 1024))
+MAX_SOURCE_PIXELS = int(os.getenv('MAX_SOURCE_PIXELS', Image.MAX_IMAGE_PIXELS))
+MAX_OUTPUT_PIXELS = int(os.getenv('MAX_OUTPUT_PIXELS', 4096 * 4096))
+# All frames of an animation are kept in memory until they are encoded, this is their total size in pixels.
+MAX_ANIMATION_PIXELS = int(os.getenv('MAX_ANIMATION_PIXELS', 64 * 1024 * 1024))
+# `reduce` decodes JPEGs over the pixel budget at a lower scale and shrinks outputs over the output budget, `reject`
+# fails such requests.
+BUDGET_MODE = os.getenv('BUDGET_MODE', 'reduce')
+
+# JPEGs can be decoded at up to 1/8 of their size, so in `reduce` mode they may have up to 64 times more pixels.
+JPEG_MAX_SCALE = 8
+
+TOO_LARGE = 413
+
+
+def check_source_bytes(size: int, max_bytes: Optional[int] = None) -> None:
+    """
+    Raises:
+        HandlerError: If `size` exceeds the source byte budget (`MAX_SOURCE_BYTES` unless `max_bytes` is given).
+    """
+    if max_bytes is None:
+        max_bytes = MAX_SOURCE_BYTES
+    if max_bytes and size > max_bytes:
+        raise HandlerError(f'Source image too large: {size} bytes, the limit is {max_bytes} bytes', code=TOO_LARGE)
+
+
+def copy_limited(source: IO[bytes], target: IO[bytes], chunk_size: int, max_bytes: Optional[int] = None) -> int:
+    """
+    Copies `source` into `target` like `shutil.copyfileobj`, failing as soon as more than `max_bytes` arrive instead
+    of buffering the whole body first.
+
+    Returns:
+        int: The number of bytes copied.
+    """
+    copied = 0
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            return copied
+        copied += len(chunk)
+        check_source_bytes(copied, max_bytes)
+        target.write(chunk)
+
+
+def decode_budget(size: Tuple[int, int], image_format: Optional[str]) -> Optional[Tuple[int, int]]:
+    """
+    Checks the size of a source image, read from its header, against the pixel budget before anything is decoded.
+
+    Args:
+        size (Tuple[int, int]): The size of the source image.
+        image_format (Optional[str]): The Pillow format of the source image.
+
+    Returns:
+        Optional[Tuple[int, int]]: None if the image can be decoded at full size, otherwise the size to draft it to
+        (`Image.draft`) so it is decoded within the budget, for JPEGs only (see `BUDGET_MODE`).
+
+    Raises:
+        HandlerError: If the image is over the budget and cannot be decoded at a reduced size.
+    """
+    width, height = size
+    if not MAX_SOURCE_PIXELS or width * height <= MAX_SOURCE_PIXELS:
+        return None
+
+    if BUDGET_MODE == 'reduce' and image_format in ('JPEG', 'MPO'):
+        for scale in (2, 4, JPEG_MAX_SCALE):
+            # The decoder rounds the scaled size up, but picks the scale from the requested size rounded down.
+            if math.ceil(width / scale) * math.ceil(height / scale) <= MAX_SOURCE_PIXELS:
+                logger.info(f"Image of {width}x{height}px is over the pixel budget, decoding it at 1/{scale} scale")
+                return width // scale, height // scale
+
+    raise HandlerError(f'Source image too large: {width}x{height}px, the limit is {MAX_SOURCE_PIXELS} pixels',
+                       code=TOO_LARGE)
+
+
+def output_budget(size: Tuple[int, int]) -> Tuple[int, int]:
+    """
+    Checks the size of an output image against the output pixel budget.
+
+    Returns:
+        Tuple[int, int]: The size itself or, in `reduce` mode, the largest size within the budget with the same
+        aspect ratio.
+
+    Raises:
+        HandlerError: If the output is over the budget in `reject` mode.
+    """
+    width, height = size
+    if not MAX_OUTPUT_PIXELS or width * height <= MAX_OUTPUT_PIXELS:
+        return size
+
+    if BUDGET_MODE != 'reduce':
+        raise HandlerError(f'Output image too large: {width}x{height}px, the limit is {MAX_OUTPUT_PIXELS} pixels',
+                           code=TOO_LARGE)
+
+    factor = math.sqrt(MAX_OUTPUT_PIXELS / (width * height))
+    reduced = max(int(width * factor), 1), max(int(height * factor), 1)
+    logger.info(f"Output of {width}x{height}px is over the pixel budget, reducing it to {reduced[0]}x{reduced[1]}px")
+    return reduced
+
+
+def check_animation_pixels(frames: int, size: Tuple[int, int]) -> None:
+    """
+    Checks the frames of an animation kept in memory for encoding against the animation pixel budget.
+
+    Args:
+        frames (int): The number of frames kept so far.
+        size (Tuple[int, int]): The size of every frame.
+
+    Raises:
+        HandlerError: If the frames are over the budget.
+    """
+    width, height = size
+    if MAX_ANIMATION_PIXELS and frames * width * height > MAX_ANIMATION_PIXELS:
+        raise HandlerError(f'Animation too large: {frames} frames of {width}x{height}px, the limit is '
+                           f'{MAX_ANIMATION_PIXELS} pixels', code=TOO_LARGE)
@@ -0,0 +1,77 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+
+class LRUCache:
+    """
+    Bounded, size-aware least-recently-used cache with per-entry expiration.
+
+    Lives in module state, so its contents survive across warm invocations of the same container. Entries are
+    evicted in least-recently-used order once the total size of the stored values exceeds `max_bytes`.
+
+    Args:
+        max_bytes (int): Maximum total size of the cached values in bytes.
+        ttl (float): Number of seconds an entry stays valid after it was stored.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries: 'OrderedDict[Hashable, Tuple[Any, int, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, size, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any, size: int) -> None:
+        # Values larger than the whole cache would only evict everything else.
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key: Hashable) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+
+def create_memory_cache(max_mb: float, ttl: float) -> Optional[LRUCache]:
+    """
+    Creates the in-process cache for sources and derivatives.
+
+    Returns:
+        Optional[LRUCache]: The cache or None if it is disabled (`max_mb` is zero).
+    """
+    if max_mb <= 0:
+        return None
+    return LRUCache(int(max_mb * 1024 * 1024), ttl)
@@ -0,0 +1,233 @@
+import os
+from functools import lru_cache
+from io import BytesIO
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image
+
+from imaginex_lambda.lib.utils import logger
+
+# EXIF (with its orientation reset and without the embedded thumbnail), XMP and comments are dropped from outputs
+# unless KEEP_METADATA is set.
+KEEP_METADATA = os.getenv('KEEP_METADATA', '0') not in ('0', 'false', 'False', '')
+# convert: colors of images with an ICC profile other than sRGB are converted to sRGB and the profile is dropped,
+# strip: the profile is dropped without converting the colors, keep: the profile is embedded in the output.
+ICC_PROFILE = os.getenv('ICC_PROFILE', 'convert').lower()
+if ICC_PROFILE not in ('convert', 'strip', 'keep'):
+    raise ValueError("ICC_PROFILE must be one of convert, strip, keep")
+
+ORIENTATION = 0x0112
+# The transposition which displays an image the right way up, per EXIF orientation, as in `ImageOps.exif_transpose`.
+TRANSPOSITIONS = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+METADATA_KEYS = ('exif', 'xmp', 'XML:com.adobe.xmp', 'comment')
+# XMP, IPTC and Photoshop tags, which the TIFF encoder copies from the tags of a TIFF source rather than its info.
+TIFF_METADATA_TAGS = (700, 33723, 34377)
+# The metadata encoders are given explicitly, JPEG and WebP would drop it otherwise.
+ENCODER_KEYS = ('icc_profile', 'exif', 'xmp')
+PROFILE_COLOR_SPACES = {'RGB': 'RGB', 'RGBA': 'RGB', 'P': 'RGB', 'CMYK': 'CMYK', 'L': 'GRAY', 'LA': 'GRAY'}
+
+
+def exif_orientation(img: Image.Image) -> int:
+    """
+    Reads the EXIF orientation of the image from its header, without decoding any pixels.
+
+    Returns:
+        int: The orientation, 1 if the image is stored the right way up or has no EXIF.
+    """
+    # Reading the EXIF of a PNG without an eXIf chunk before its pixels would decode the whole image.
+    if img.format == 'PNG' and 'exif' not in img.info:
+        return 1
+    try:
+        orientation = int(img.getexif().get(ORIENTATION, 1))
+    except Exception as exc:
+        logger.info("Could not read the EXIF orientation: %s", exc)
+        return 1
+    return orientation if orientation in TRANSPOSITIONS else 1
+
+
+def oriented_size(size: Tuple[int, int], orientation: int) -> Tuple[int, int]:
+    """
+    Converts a size between the stored and the displayed orientation of an image, which differ for rotated images.
+    """
+    return (size[1], size[0]) if orientation in (5, 6, 7, 8) else size
+
+
+@lru_cache(maxsize=32)
+def profile_info(icc: bytes) -> Tuple[str, bool]:
+    """
+    Returns the color space of an ICC profile (`RGB`, `CMYK`, `GRAY`, ...) and whether it is an sRGB profile.
+    """
+    from PIL import ImageCms
+
+    profile = ImageCms.ImageCmsProfile(BytesIO(icc))
+    description = ImageCms.getProfileDescription(profile) or ''
+    return profile.profile.xcolor_space.strip(), 'srgb' in description.lower()
+
+
+@lru_cache(maxsize=None)
+def srgb_profile() -> Any:
+    from PIL import ImageCms
+
+    return ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB'))
+
+
+def convertible_profile(icc: bytes) -> bool:
+    """
+    Checks whether the colors of images with this ICC profile can and need to be converted to sRGB.
+    """
+    try:
+        color_space, srgb = profile_info(icc)
+    except Exception as exc:
+        logger.info("Could not read the ICC profile: %s", exc)
+        return False
+    return not srgb and color_space in ('RGB', 'CMYK')
+
+
+def has_metadata_changes(img: Image.Image) -> bool:
+    """
+    Checks, from just the opened (not decoded) image, whether its output would differ from it in orientation, color
+    profile or metadata, so it cannot be served unchanged.
+    """
+    if exif_orientation(img) != 1:
+        return True
+    if img.info.get('icc_profile') and ICC_PROFILE != 'keep':
+        return True
+    return not KEEP_METADATA and (any(img.info.get(key) for key in METADATA_KEYS)
+                                  or any(tag in getattr(img, 'tag_v2', {}) for tag in TIFF_METADATA_TAGS))
+
+
+def strip_metadata(img: Image.Image) -> None:
+    """
+    Drops the metadata the output should not carry from the decoded source, before any other image is derived from it
+    (and copies its metadata). Kept EXIF gets its orientation reset, as the image is transposed by `apply_metadata`,
+    and loses its embedded thumbnail, which would no longer match the image.
+    """
+    exif = img.getexif() if KEEP_METADATA else None
+    icc = img.info.get('icc_profile')
+    for key in METADATA_KEYS:
+        img.info.pop(key, None)
+    if not KEEP_METADATA and hasattr(img, 'tag_v2'):
+        for tag in TIFF_METADATA_TAGS:
+            img.tag_v2.pop(tag, None)
+
+    if exif:
+        if ORIENTATION in exif:
+            exif[ORIENTATION] = 1
+        img.info['exif'] = exif.tobytes()
+
+    if icc and ICC_PROFILE != 'keep' and not (ICC_PROFILE == 'convert' and convertible_profile(icc)):
+        logger.info("Dropping the ICC profile of the image")
+        del img.info['icc_profile']
+
+
+def profile_to_srgb(img: Image.Image, icc: bytes, output_mode: str) -> Optional[Image.Image]:
+    """
+    Converts the colors of the image from the ICC profile `icc` to sRGB.
+
+    Returns:
+        Optional[PIL.Image]: The converted image, without a profile, or None if the conversion failed, in which case
+        the profile is dropped from the image.
+    """
+    from PIL import ImageCms
+
+    try:
+        converted = ImageCms.profileToProfile(img, ImageCms.ImageCmsProfile(BytesIO(icc)), srgb_profile(),
+                                              outputMode=output_mode)
+    except ImageCms.PyCMSError as exc:
+        logger.info("Could not convert the image to sRGB, dropping the profile: %s", exc)
+        img.info.pop('icc_profile', None)
+        return None
+    converted.info = {key: value for key, value in img.info.items() if key != 'icc_profile'}
+    return converted
+
+
+def convert_cmyk(img: Image.Image) -> Image.Image:
+    """
+    Converts a CMYK image to RGB, for outputs which cannot store CMYK (all but JPEG). The plain mode conversion ignores
+    the ICC profile, so colors go through the profile to sRGB instead when it is to be converted, see `ICC_PROFILE`.
+
+    Returns:
+        PIL.Image: The converted image.
+    """
+    icc = img.info.get('icc_profile')
+    if icc and ICC_PROFILE == 'convert' and convertible_profile(icc) and profile_info(icc)[0] == 'CMYK':
+        logger.info("Converting the image from its CMYK ICC profile to sRGB")
+        converted = profile_to_srgb(img, icc, 'RGB')
+        if converted is not None:
+            return converted
+    return img.convert('RGB')
+
+
+def convert_to_srgb(img: Image.Image) -> Image.Image:
+    """
+    Converts the colors of the image from its ICC profile to sRGB, see `ICC_PROFILE`.
+
+    Returns:
+        PIL.Image: Either the same image, if it has no profile to convert, or a new, converted one without a profile.
+    """
+    icc = img.info.get('icc_profile')
+    if not icc or ICC_PROFILE != 'convert':
+        return img
+
+    color_space, _ = profile_info(icc)
+    if color_space == 'RGB' and img.mode in ('P', 'PA'):
+        img = img.convert('RGBA' if 'transparency' in img.info or img.mode == 'PA' else 'RGB')
+    modes = {'RGB': ('RGB', 'RGBA'), 'CMYK': ('CMYK',)}[color_space]
+    if img.mode not in modes:
+        logger.info(f"Cannot convert {img.mode} images with a {color_space} ICC profile, dropping the profile")
+        img.info.pop('icc_profile', None)
+        return img
+
+    logger.info(f"Converting the image from its {color_space} ICC profile to sRGB")
+    converted = profile_to_srgb(img, icc, 'RGBA' if img.mode == 'RGBA' else 'RGB')
+    return img if converted is None else converted
+
+
+def has_pending_metadata(img: Image.Image, orientation: int) -> bool:
+    """
+    Checks whether `apply_metadata` has anything to do: a transposition or a color conversion.
+    """
+    return orientation in TRANSPOSITIONS or (ICC_PROFILE == 'convert' and bool(img.info.get('icc_profile')))
+
+
+def apply_metadata(img: Image.Image, orientation: int) -> Image.Image:
+    """
+    Turns the (resized) image the right way up and converts its colors to sRGB, which is much cheaper than doing so
+    before it is resized.
+
+    Args:
+        img (PIL.Image): The image, with its metadata already stripped by `strip_metadata`.
+        orientation (int): The EXIF orientation of the source image, see `exif_orientation`.
+
+    Returns:
+        PIL.Image: Either the same image or a new one.
+    """
+    if orientation in TRANSPOSITIONS:
+        logger.info(f"Transposing the image for EXIF orientation {orientation}")
+        img = img.transpose(TRANSPOSITIONS[orientation])
+    return convert_to_srgb(img)
+
+
+def encoder_metadata(img: Image.Image) -> Dict[str, Any]:
+    """
+    Returns the metadata left on the image, as options for `Image.save`. A kept ICC profile is left out when the
+    image is no longer in its color space, e.g. a CMYK image converted to RGB for WebP.
+    """
+    options = {key: img.info[key] for key in ENCODER_KEYS if img.info.get(key)}
+    if 'icc_profile' in options:
+        try:
+            color_space, _ = profile_info(options['icc_profile'])
+        except Exception:
+            color_space = None
+        if color_space != PROFILE_COLOR_SPACES.get(img.mode):
+            del options['icc_profile']
+    return options
+
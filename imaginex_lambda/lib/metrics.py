@@ -0,0 +1,177 @@
+import json
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - not available on Windows
+    resource = None
+
+_recorder: 'ContextVar[Optional[StageRecorder]]' = ContextVar('imaginex_stage_recorder', default=None)
+
+
+def peak_memory_mb() -> Optional[float]:
+    """
+    Returns the peak resident memory of the process so far in megabytes, which is what lambda reports as the
+    "Max Memory Used" of the invocation.
+    """
+    if resource is None:
+        return None
+    # Reported in bytes on macOS, in kilobytes elsewhere.
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor
+
+
+class Stage:
+    """
+    A single timed stage of a request. Set `bytes_out` (and `bytes_in`, unless given upfront) inside the `with`
+    block to record the amount of data the stage consumed and produced.
+    """
+
+    def __init__(self, recorder: 'StageRecorder', name: str, bytes_in: Optional[int] = None) -> None:
+        self.recorder = recorder
+        self.name = name
+        self.bytes_in = bytes_in
+        self.bytes_out: Optional[int] = None
+        self.start = 0.0
+
+    def __enter__(self) -> 'Stage':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.recorder.add(self.name, (time.perf_counter() - self.start) * 1000, self.bytes_in, self.bytes_out)
+
+
+class NullStage:
+    """
+    Stands in for `Stage` when instrumentation is disabled, a single shared instance which records nothing.
+    """
+
+    bytes_in: Optional[int] = None
+    bytes_out: Optional[int] = None
+
+    def __enter__(self) -> 'NullStage':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+class StageRecorder:
+    """
+    Collects the duration, bytes in/out and peak memory of every stage of a request, and formats them as a
+    `Server-Timing` header and a CloudWatch embedded metric format (EMF) log line.
+    """
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.stages: List[Dict[str, Any]] = []
+        self.metrics: Dict[str, Tuple[float, str]] = {}
+
+    def add(self, name: str, duration: float, bytes_in: Optional[int], bytes_out: Optional[int]) -> None:
+        self.stages.append({'name': name, 'duration': duration, 'bytes_in': bytes_in, 'bytes_out': bytes_out,
+                            'peak_memory': peak_memory_mb()})
+
+    def total(self) -> float:
+        return (time.perf_counter() - self.start) * 1000
+
+    def server_timing(self) -> str:
+        entries = [f"{stage['name']};dur={stage['duration']:.1f}" for stage in self.stages]
+        entries.append(f'total;dur={self.total():.1f}')
+        return ', '.join(entries)
+
+    def emf(self, namespace: str, properties: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Builds the EMF document of the request: a duration metric per stage, the total duration, the peak memory and
+        the metrics recorded with `metric` (e.g. bytes in and out), dimensioned by the output content type.
+
+        Args:
+            namespace (str): The CloudWatch metrics namespace.
+            properties (Dict[str, Any]): Additional properties logged with the metrics (status code, url, ...).
+
+        Returns:
+            Dict[str, Any]: The EMF document.
+        """
+        values: Dict[str, Any] = {}
+        metrics = []
+        for stage in self.stages:
+            # Stages repeated in a request (e.g. several fetches) are summed.
+            name = f"{stage['name']}Time"
+            if name not in values:
+                metrics.append({'Name': name, 'Unit': 'Milliseconds'})
+                values[name] = 0.0
+            values[name] += round(stage['duration'], 3)
+
+        extra = dict(self.metrics, TotalTime=(round(self.total(), 3), 'Milliseconds'))
+        peak_memory = peak_memory_mb()
+        if peak_memory is not None:
+            extra['PeakMemory'] = (round(peak_memory, 1), 'Megabytes')
+        for name, (value, unit) in extra.items():
+            values[name] = value
+            metrics.append({'Name': name, 'Unit': unit})
+
+        properties = dict(properties)
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{'Namespace': namespace, 'Dimensions': [['ContentType']], 'Metrics': metrics}],
+            },
+            'ContentType': properties.pop('content_type', None) or 'none',
+            'stages': self.stages,
+            **properties,
+            **values,
+        }
+
+    def emit(self, namespace: str, properties: Dict[str, Any]) -> None:
+        # Written straight to stdout: EMF lines must be plain JSON, without the prefix added by the logger.
+        sys.stdout.write(json.dumps(self.emf(namespace, properties), separators=(',', ':')) + '\n')
+        sys.stdout.flush()
+
+
+@contextmanager
+def record_stages(enabled: bool) -> Iterator[Optional[StageRecorder]]:
+    """
+    Records the stages of the request processed in the `with` block, yielding the recorder, or None when
+    instrumentation is disabled.
+    """
+    if not enabled:
+        yield None
+        return
+
+    recorder = StageRecorder()
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
+
+
+def stage(name: str, bytes_in: Optional[int] = None):
+    """
+    Times a stage of the current request, as `with stage('decode', bytes_in=size) as s: ... s.bytes_out = n`.
+    Outside of `record_stages` (or with instrumentation disabled) it returns a shared no-op stage.
+    """
+    recorder = _recorder.get()
+    if recorder is None:
+        return NULL_STAGE
+    return Stage(recorder, name, bytes_in)
+
+
+def metric(name: str, value: float, unit: str = 'Count') -> None:
+    """
+    Records a value (e.g. `BytesIn`) of the current request, logged as an EMF metric. No-op outside of
+    `record_stages`.
+    """
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.metrics[name] = (value, unit)
@@ -0,0 +1,150 @@
+import os
+from io import BytesIO
+from typing import Callable, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from imaginex_lambda.lib.utils import logger
+
+# `q=auto` picks the lowest quality whose output still scores at least AUTO_QUALITY_SSIM against the resized image,
+# searching between AUTO_QUALITY_MIN and AUTO_QUALITY_MAX in steps of AUTO_QUALITY_STEP. The step bounds the search
+# to a few encodes (4 with the defaults).
+AUTO_QUALITY_SSIM = float(os.getenv('AUTO_QUALITY_SSIM', 0.95))
+AUTO_QUALITY_MIN = int(os.getenv('AUTO_QUALITY_MIN', 30))
+AUTO_QUALITY_MAX = int(os.getenv('AUTO_QUALITY_MAX', 90))
+AUTO_QUALITY_STEP = int(os.getenv('AUTO_QUALITY_STEP', 5))
+
+# Formats whose size depends on the quality, the others are encoded once. The JPEG 2000 encoder ignores `quality`.
+LOSSY_FORMATS = {'JPEG', 'WEBP', 'AVIF'}
+
+# SSIM is computed on (at most) this many 8x8 luminance windows, spread evenly over the image.
+SSIM_WINDOW = 8
+SSIM_MAX_WINDOWS = 1024
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+
+class Luminance:
+    """
+    The luminance channel of an image, sampled as the windows `ssim` compares.
+    """
+
+    def __init__(self, img: Image.Image, windows: Optional[List[Tuple[int, int]]] = None) -> None:
+        if img.mode != 'L':
+            img = img.convert('L')
+        self.width, self.height = img.size
+        self.data = img.tobytes()
+        self.windows = windows if windows is not None else self.spread_windows()
+
+    def spread_windows(self) -> List[Tuple[int, int]]:
+        columns, rows = self.width // SSIM_WINDOW, self.height // SSIM_WINDOW
+        stride = 1
+        while (columns // stride) * (rows // stride) > SSIM_MAX_WINDOWS:
+            stride += 1
+        step = SSIM_WINDOW * stride
+        return [(x, y) for y in range(0, rows * SSIM_WINDOW, step) for x in range(0, columns * SSIM_WINDOW, step)]
+
+    def window(self, x: int, y: int) -> List[int]:
+        pixels: List[int] = []
+        for row in range(y, y + SSIM_WINDOW):
+            start = row * self.width + x
+            pixels.extend(self.data[start:start + SSIM_WINDOW])
+        return pixels
+
+
+def ssim(reference: Luminance, img: Image.Image) -> float:
+    """
+    Computes the mean structural similarity (SSIM) of `img` to the reference luminance, from 0 to 1 (identical).
+
+    Args:
+        reference (Luminance): The luminance of the image before encoding.
+        img (PIL.Image): The decoded output, of the same size.
+
+    Returns:
+        float: The mean SSIM over the sampled windows, 1 for images too small to have any.
+    """
+    other = Luminance(img, reference.windows)
+    if not reference.windows:
+        return 1.0
+
+    n = SSIM_WINDOW * SSIM_WINDOW
+    total = 0.0
+    for x, y in reference.windows:
+        a, b = reference.window(x, y), other.window(x, y)
+        mean_a, mean_b = sum(a) / n, sum(b) / n
+        var_a = sum(p * p for p in a) / n - mean_a * mean_a
+        var_b = sum(p * p for p in b) / n - mean_b * mean_b
+        covariance = sum(p * q for p, q in zip(a, b)) / n - mean_a * mean_b
+        total += ((2 * mean_a * mean_b + SSIM_C1) * (2 * covariance + SSIM_C2)
+                  / ((mean_a * mean_a + mean_b * mean_b + SSIM_C1) * (var_a + var_b + SSIM_C2)))
+    return total / len(reference.windows)
+
+
+def search_quality(img: Image.Image,
+                   ext: str,
+                   encode: Callable[[Image.Image, str, int], bytes],
+                   quality: Optional[int] = None,
+                   max_bytes: Optional[int] = None) -> Tuple[bytes, int]:
+    """
+    Binary-searches the encoder quality of an (already resized) image for the smallest output meeting the targets:
+    no larger than `max_bytes`, and, with `quality=None` (`q=auto`), scoring at least `AUTO_QUALITY_SSIM`.
+
+    Every quality is encoded (and scored) at most once, the final result reuses the encode of the search.
+
+    Args:
+        img (PIL.Image): The image to encode.
+        ext (str): The Pillow format to encode the image in.
+        encode (Callable[[Image.Image, str, int], bytes]): Encodes the image at a given quality.
+        quality (Optional[int]): The highest quality to use, None to search up to `AUTO_QUALITY_MAX` for the
+            lowest quality meeting the SSIM target.
+        max_bytes (Optional[int]): The largest acceptable output size, if any. When even the lowest quality is
+            larger, its output is returned anyway.
+
+    Returns:
+        Tuple[bytes, int]: The encoded image data and the quality it was encoded at.
+    """
+    highest = quality if quality is not None else AUTO_QUALITY_MAX
+    if ext not in LOSSY_FORMATS:
+        return encode(img, ext, highest), highest
+
+    lowest = min(AUTO_QUALITY_MIN, highest)
+    candidates = sorted(set(range(lowest, highest, AUTO_QUALITY_STEP)) | {highest})
+    encodes: Dict[int, bytes] = {}
+    scores: Dict[int, float] = {}
+    reference: List[Luminance] = []
+
+    def encoded(i: int) -> bytes:
+        q = candidates[i]
+        if q not in encodes:
+            encodes[q] = encode(img, ext, q)
+        return encodes[q]
+
+    def score(i: int) -> float:
+        q = candidates[i]
+        if q not in scores:
+            if not reference:
+                reference.append(Luminance(img))
+            with Image.open(BytesIO(encoded(i))) as decoded:
+                scores[q] = ssim(reference[0], decoded)
+        return scores[q]
+
+    def first(lo: int, hi: int, predicate: Callable[[int], bool]) -> int:
+        # The first index in [lo, hi) meeting the predicate, hi if none does. Sizes and scores grow with quality.
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if predicate(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    top = len(candidates) - 1
+    if max_bytes:
+        # The last quality within the byte budget.
+        top = max(first(0, len(candidates), lambda i: len(encoded(i)) > max_bytes) - 1, 0)
+    chosen = top
+    if quality is None:
+        chosen = min(first(0, top + 1, lambda i: score(i) >= AUTO_QUALITY_SSIM), top)
+
+    logger.info(f"Quality search picked q={candidates[chosen]} after {len(encodes)} encodes")
+    return encoded(chosen), candidates[chosen]
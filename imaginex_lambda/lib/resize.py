@@ -0,0 +1,221 @@
+import math
+import os
+from typing import Iterable, Optional, Tuple
+
+from PIL import Image
+
+from imaginex_lambda.lib.exceptions import HandlerError
+from imaginex_lambda.lib.metadata import convert_cmyk
+from imaginex_lambda.lib.utils import logger, is_landscape
+
+FILTERS = {
+    'lanczos': Image.Resampling.LANCZOS,
+    'bicubic': Image.Resampling.BICUBIC,
+    'hamming': Image.Resampling.HAMMING,
+    'bilinear': Image.Resampling.BILINEAR,
+    'box': Image.Resampling.BOX,
+    'nearest': Image.Resampling.NEAREST,
+}
+# The filter images are resampled with, palette and bilevel images are always resampled with NEAREST.
+RESIZE_FILTER = os.getenv('RESIZE_FILTER', 'bicubic').lower()
+# Images are first reduced with a cheap box filter (or decoded at a reduced scale) down to at least RESIZE_REDUCING_GAP
+# times the output size, and only the rest is resampled with RESIZE_FILTER. Larger gaps are closer to resampling the
+# full image, at the cost of more pixels to decode and resample, `0` resamples the full image.
+RESIZE_REDUCING_GAP = float(os.getenv('RESIZE_REDUCING_GAP', 1.0))
+if RESIZE_FILTER not in FILTERS:
+    raise ValueError(f"RESIZE_FILTER must be one of {', '.join(FILTERS)}")
+if 0 < RESIZE_REDUCING_GAP < 1:
+    raise ValueError("RESIZE_REDUCING_GAP must be 0 or at least 1")
+
+# contain: fit within width x height, cover: fill width x height and crop the overflow, fill: stretch to it.
+FIT_MODES = ('contain', 'cover', 'fill')
+
+
+def validate_fit(fit: Optional[str]) -> None:
+    """
+    Raises:
+        HandlerError: If `fit` is given and not one of `FIT_MODES`.
+    """
+    if fit is not None and fit not in FIT_MODES:
+        raise HandlerError(f"fit must be one of {', '.join(FIT_MODES)}")
+
+
+def target_size(size: Tuple[int, int], width: Optional[int], height: Optional[int]) -> Optional[Tuple[int, int]]:
+    """
+    Computes the size the image should be resized to, keeping its aspect ratio. When both `width` and `height` are
+    given, the width is used for landscape images and the height for portrait ones. Images are never upscaled.
+
+    Args:
+        size (Tuple[int, int]): The current size of the image.
+        width (Optional[int]): The maximum width of the image.
+        height (Optional[int]): The maximum height of the image.
+
+    Returns:
+        Optional[Tuple[int, int]]: The new size or None if the image should keep its size.
+    """
+    img_width, img_height = size
+    if width is not None and height is not None:
+        if is_landscape(size):
+            logger.info("Image is in landscape orientation, using width")
+            height = None
+        else:
+            logger.info("Image is in portrait orientation, using height")
+            width = None
+
+    if width and width < img_width:
+        logger.info(f"Resizing image given width {width}px...")
+        return width, int(width * img_height / img_width)
+    if height and height < img_height:
+        logger.info(f"Resizing image to the given {height}px...")
+        return int(height * img_width / img_height), height
+    return None
+
+
+def fit_size(size: Tuple[int, int],
+             width: Optional[int],
+             height: Optional[int],
+             fit: Optional[str] = None) -> Optional[Tuple[int, int]]:
+    """
+    Computes the size the image should be resized to in the given fit mode. Without a fit mode, or with only one of
+    `width` and `height`, this is `target_size`. Images are never upscaled: `cover` then keeps the requested aspect
+    ratio at the largest size the image allows, `fill` stops at the size of the image in each dimension.
+
+    Args:
+        size (Tuple[int, int]): The current size of the image.
+        width (Optional[int]): The requested width.
+        height (Optional[int]): The requested height.
+        fit (Optional[str]): One of `FIT_MODES`, None to pick the width or height by the orientation of the image.
+
+    Returns:
+        Optional[Tuple[int, int]]: The new size or None if the image should keep its size.
+    """
+    if fit is None or width is None or height is None:
+        return target_size(size, width, height)
+
+    img_width, img_height = size
+    if fit == 'contain':
+        scale = min(width / img_width, height / img_height, 1)
+        new_size = max(1, round(img_width * scale)), max(1, round(img_height * scale))
+    elif fit == 'cover':
+        scale = min(img_width / width, img_height / height, 1)
+        new_size = max(1, round(width * scale)), max(1, round(height * scale))
+    else:
+        new_size = min(width, img_width), min(height, img_height)
+    return new_size if new_size != size else None
+
+
+def crop_box(size: Tuple[int, int],
+             new_size: Tuple[int, int],
+             fit: Optional[str] = None) -> Optional[Tuple[float, float, float, float]]:
+    """
+    Returns the centered region of the image to resample to `new_size`, which is only a part of it for `cover`.
+
+    Returns:
+        Optional[Tuple[float, float, float, float]]: The region or None to resample the whole image.
+    """
+    if fit != 'cover':
+        return None
+    img_width, img_height = size
+    scale = min(img_width / new_size[0], img_height / new_size[1])
+    crop_width, crop_height = new_size[0] * scale, new_size[1] * scale
+    if crop_width >= img_width - 0.5 and crop_height >= img_height - 0.5:
+        return None
+    left, top = (img_width - crop_width) / 2, (img_height - crop_height) / 2
+    return left, top, left + crop_width, top + crop_height
+
+
+def reduction_size(size: Tuple[int, int], new_size: Tuple[int, int], fit: Optional[str] = None) -> Tuple[int, int]:
+    """
+    Returns the size the whole image can be reduced to (see `reduce_on_load`) before it is resampled to `new_size`,
+    keeping `RESIZE_REDUCING_GAP` times the output pixels in each dimension for the final filter.
+    """
+    if not RESIZE_REDUCING_GAP:
+        return size
+    if fit == 'cover':
+        scale = max(new_size[0] / size[0], new_size[1] / size[1])
+        new_size = size[0] * scale, size[1] * scale
+    return (min(size[0], math.ceil(new_size[0] * RESIZE_REDUCING_GAP)),
+            min(size[1], math.ceil(new_size[1] * RESIZE_REDUCING_GAP)))
+
+
+def working_mode(img: Image.Image, extensions: Iterable[str]) -> Optional[str]:
+    """
+    Picks the mode the image is resampled in to be encoded in all of `extensions`: alpha is dropped when every output
+    is a JPEG, so one band less is resampled, palette and bilevel images are expanded, as filters other than NEAREST
+    need actual colors, unless every output is a GIF, which keeps the palette.
+
+    Returns:
+        Optional[str]: The mode to convert the image to or None to keep its mode.
+    """
+    extensions = set(extensions)
+    if extensions == {'GIF'} and img.mode in ('P', '1'):
+        return None
+    if extensions == {'JPEG'}:
+        if img.mode in ('1', 'LA', 'La') or (img.mode == 'P' and img.palette.mode == 'L'):
+            return 'L'
+        return 'RGB' if img.mode not in ('RGB', 'L', 'CMYK') else None
+
+    if img.mode == '1':
+        return 'L'
+    if img.mode == 'P':
+        return 'RGBA' if 'transparency' in img.info or img.palette.mode == 'RGBA' else 'RGB'
+    if img.mode in ('PA', 'RGBa'):
+        return 'RGBA'
+    if img.mode == 'La':
+        return 'LA'
+    # Only JPEG stores CMYK.
+    return 'RGB' if img.mode == 'CMYK' else None
+
+
+def prepare_mode(img: Image.Image, extensions: Iterable[str]) -> Image.Image:
+    """
+    Converts the image to its `working_mode` for `extensions`, before it is resampled. CMYK images are converted
+    through their ICC profile, see `convert_cmyk`.
+
+    Returns:
+        PIL.Image: Either the same image or a new, converted one.
+    """
+    mode = working_mode(img, extensions)
+    if mode is None:
+        return img
+    logger.info(f"Converting image from {img.mode} to {mode} before resampling")
+    if img.mode == 'CMYK' and mode == 'RGB':
+        return convert_cmyk(img)
+    return img.convert(mode)
+
+
+def restore_palette(img: Image.Image, source_mode: str, ext: str) -> Image.Image:
+    """
+    Quantizes PNG outputs of palette sources, expanded by `prepare_mode`, back to a palette, so they do not get
+    several times larger than their source.
+
+    Returns:
+        PIL.Image: Either the same image or a new, quantized one.
+    """
+    if ext != 'PNG' or source_mode not in ('P', 'PA') or img.mode not in ('RGB', 'RGBA'):
+        return img
+    return img.quantize(256, method=Image.Quantize.FASTOCTREE)
+
+
+def resample(img: Image.Image,
+             size: Tuple[int, int],
+             box: Optional[Tuple[float, float, float, float]] = None,
+             resample_filter: Optional[Image.Resampling] = None) -> Image.Image:
+    """
+    Resamples the image (or the `box` region of it) to `size` with `RESIZE_FILTER`, reducing it with a box filter
+    first when it is more than `RESIZE_REDUCING_GAP` times larger.
+
+    Args:
+        img (PIL.Image): The image to resample.
+        size (Tuple[int, int]): The size to resample it to.
+        box (Optional[Tuple[float, float, float, float]]): The region of the image to resample, see `crop_box`.
+        resample_filter (Optional[Image.Resampling]): The filter to use instead of `RESIZE_FILTER`.
+
+    Returns:
+        PIL.Image: The resampled image.
+    """
+    if img.mode in ('1', 'P'):
+        resample_filter = Image.Resampling.NEAREST
+    elif resample_filter is None:
+        resample_filter = FILTERS[RESIZE_FILTER]
+    return img.resize(size, resample_filter, box, RESIZE_REDUCING_GAP or None)
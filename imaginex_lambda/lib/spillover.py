@@ -0,0 +1,52 @@
+import hashlib
+from typing import Optional
+
+from imaginex_lambda.lib.utils import logger
+
+
+def base64_size(size: int) -> int:
+    """
+    Returns the length of the base64 encoding of `size` bytes, without encoding anything.
+    """
+    return 4 * ((size + 2) // 3)
+
+
+def spill_to_s3(image_data: bytes,
+                content_type: str,
+                client,
+                bucket_name: str,
+                prefix: str = '',
+                public_url: Optional[str] = None,
+                expires: int = 3600) -> str:
+    """
+    Uploads an optimized image which is too large to be returned in the lambda response to S3, under a key derived
+    from its contents. An image spilled over before (the same contents) is not uploaded again.
+
+    Args:
+        image_data (bytes): The optimized image data.
+        content_type (str): The content type of the image.
+        client: The S3 client.
+        bucket_name (str): The bucket to upload the image to.
+        prefix (str): The key prefix within the bucket.
+        public_url (Optional[str]): Base URL (e.g. a CDN) the bucket is served from. If not given, a presigned URL is
+            returned instead.
+        expires (int): Number of seconds the presigned URL is valid for.
+
+    Returns:
+        str: The URL the client should be redirected to.
+    """
+    key = f'{prefix}{hashlib.sha256(image_data).hexdigest()}'
+    try:
+        client.head_object(Bucket=bucket_name, Key=key)
+        logger.info("Image was already spilled over to s3://%s/%s", bucket_name, key)
+    except client.exceptions.ClientError as exc:
+        if exc.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+        logger.info("Spilling %d bytes over to s3://%s/%s", len(image_data), bucket_name, key)
+        client.put_object(Bucket=bucket_name, Key=key, Body=image_data, ContentType=content_type)
+
+    if public_url:
+        return f"{public_url.rstrip('/')}/{key}"
+    return client.generate_presigned_url('get_object',
+                                         Params={'Bucket': bucket_name, 'Key': key},
+                                         ExpiresIn=expires)
@@ -1,11 +1,14 @@
 import base64
-from typing import IO, Dict, Any
+import json
+from datetime import datetime
+from email.utils import format_datetime, parsedate_to_datetime
+from functools import lru_cache
+from typing import IO, Dict, Any, Optional, Tuple, Union
 from urllib.parse import urlparse, unquote
 
-import filetype
 import logging
 
-from PIL.Image import Image
+import PIL.Image
 
 from imaginex_lambda.lib.exceptions import HandlerError
 
@@ -13,27 +16,68 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Output formats which can be requested explicitly via the `f` query parameter.
+OUTPUT_FORMATS = {
+    'avif': ('AVIF', 'image/avif'),
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'jpg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+    'gif': ('GIF', 'image/gif'),
+}
 
-def success(image_data: bytes, headers: Dict[str, Any]) -> Dict[str, Any]:
+# Source formats which can be safely re-encoded as WebP/AVIF. GIFs are kept, as they are usually animated, ICOs too.
+NEGOTIABLE_FORMATS = {'JPEG', 'PNG', 'WEBP', 'AVIF', 'TIFF', 'BMP', 'JPEG2000'}
+
+# Output formats which can store an animation.
+ANIMATED_FORMATS = {'GIF', 'WEBP'}
+
+
+def success(image_data: bytes, headers: Dict[str, Any], binary: bool = False) -> Dict[str, Any]:
+    """
+    Formats a successful image response. The body is base64 encoded, as required by API Gateway and lambda function
+    URLs, unless `binary` is set, in which case the raw bytes are returned (for callers other than the lambda runtime).
+    """
     return {
         'statusCode': 200,
-        'body': base64.b64encode(image_data).decode(),
-        'isBase64Encoded': True,
+        'body': image_data if binary else base64.b64encode(image_data).decode(),
+        'isBase64Encoded': not binary,
+        'headers': headers
+    }
+
+def redirect(location: str, headers: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'statusCode': 302,
+        'body': '',
+        'headers': {**headers, 'Location': location}
+    }
+
+def not_modified(headers: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'statusCode': 304,
+        'body': '',
         'headers': headers
     }
 
+def success_json(data: Any, headers: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    return {
+        'statusCode': 200,
+        'body': json.dumps(data),
+        'headers': {**(headers or {}), 'Content-Type': 'application/json'}
+    }
+
 def is_absolute(url: str) -> bool:
     return bool(urlparse(url).netloc)
 
 def is_s3(url: str) -> bool:
     return unquote(url).startswith('s3://')
 
-def get_extension(buffer: IO[bytes]) -> Dict:
+def get_extension(buffer: Union[IO[bytes], bytes]) -> Dict:
     """
     Determines the file extension and content type of an image file contained in the given buffer.
 
     Args:
-        buffer (IO[bytes]): The buffer containing the image file.
+        buffer (Union[IO[bytes], bytes]): The buffer containing the image file, or just its first bytes.
 
     Returns:
         Dict[str, str]: A dictionary containing the content_type and extension of the image file.
@@ -43,6 +87,7 @@ def get_extension(buffer: IO[bytes]) -> Dict:
     """
     logger.info("Getting extension...")
 
+    import filetype
     kind = filetype.guess(buffer)
     if kind is None:
         raise HandlerError('Unsupported image format')
@@ -56,6 +101,150 @@ def get_extension(buffer: IO[bytes]) -> Dict:
     return {'content_type': content_type, 'extension': extension}
 
 
+def http_date(value: Optional[datetime]) -> Optional[str]:
+    """
+    Formats a datetime as an HTTP date (RFC 7231), e.g. `Wed, 21 Oct 2015 07:28:00 GMT`.
+    """
+    if value is None:
+        return None
+    return format_datetime(value, usegmt=True)
+
+
+def get_header(event: Dict[str, Any], name: str) -> Optional[str]:
+    """
+    Looks up a request header in the lambda event, ignoring the case of its name.
+    """
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+@lru_cache(maxsize=None)
+def is_avif_supported() -> bool:
+    """
+    Checks whether Pillow can encode AVIF, either natively or through the optional `pillow-avif-plugin` package.
+    """
+    try:
+        import pillow_avif  # noqa: F401 - registers the plugin
+    except ImportError:
+        pass
+    PIL.Image.init()
+    return 'AVIF' in PIL.Image.SAVE
+
+
+def accepted_formats(accept: Optional[str]) -> Tuple[str, ...]:
+    """
+    Parses an Accept header and returns the modern image formats the client accepts, in order of preference.
+
+    Args:
+        accept (Optional[str]): The value of the Accept header.
+
+    Returns:
+        Tuple[str, ...]: A subset of ('avif', 'webp'), AVIF only if this Pillow build can encode it.
+    """
+    if not accept:
+        return ()
+
+    accepted = set()
+    for media_range in accept.split(','):
+        media_type, *params = [part.strip() for part in media_range.split(';')]
+        q = 1.0
+        for param in params:
+            if param.startswith('q='):
+                q = cast_to_float(param[2:]) or 0.0
+        if q > 0:
+            accepted.add(media_type.lower())
+
+    formats = []
+    if 'image/avif' in accepted and is_avif_supported():
+        formats.append('avif')
+    if 'image/webp' in accepted:
+        formats.append('webp')
+    return tuple(formats)
+
+
+def negotiate_format(extension: str,
+                     content_type: str,
+                     formats: Tuple[str, ...],
+                     requested: Optional[str] = None,
+                     animated: bool = False) -> Tuple[str, str]:
+    """
+    Picks the output format of the optimized image.
+
+    An explicitly requested format always wins. Otherwise, the first format accepted by the client is used, as long
+    as the source can be safely converted. Animated sources are only converted to WebP (GIFs included), as it is the
+    only negotiable format which keeps the animation. The source format is kept in every other case.
+
+    Args:
+        extension (str): The Pillow format of the source image.
+        content_type (str): The content type of the source image.
+        formats (Tuple[str, ...]): The formats accepted by the client (see `accepted_formats`).
+        requested (Optional[str]): The explicitly requested format (e.g. `webp`), if any.
+        animated (bool): Whether the source image has more than one frame.
+
+    Returns:
+        Tuple[str, str]: The Pillow format and content type of the output image.
+
+    Raises:
+        HandlerError: If the requested format is not supported.
+    """
+    if requested:
+        requested = requested.lower()
+        if requested not in OUTPUT_FORMATS or (requested == 'avif' and not is_avif_supported()):
+            raise HandlerError(f'Unsupported output format: {requested}')
+        return OUTPUT_FORMATS[requested]
+
+    if animated:
+        return OUTPUT_FORMATS['webp'] if 'webp' in formats else (extension, content_type)
+
+    if extension in NEGOTIABLE_FORMATS and formats:
+        return OUTPUT_FORMATS[formats[0]]
+
+    return extension, content_type
+
+
+def is_not_modified(validators: Dict[str, Optional[str]],
+                    if_none_match: Optional[str],
+                    if_modified_since: Optional[str]) -> bool:
+    """
+    Evaluates the If-None-Match and If-Modified-Since request headers against the validators of the image
+    (RFC 7232). If-Modified-Since is only considered when If-None-Match is absent.
+
+    Args:
+        validators (Dict[str, Optional[str]]): The etag and last_modified of the image.
+        if_none_match (Optional[str]): The value of the If-None-Match header.
+        if_modified_since (Optional[str]): The value of the If-Modified-Since header.
+
+    Returns:
+        bool: True if the client already has the current version of the image.
+    """
+    etag = validators.get('etag')
+    if if_none_match:
+        if not etag:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        # Weak comparison, the W/ prefix does not matter for GET requests.
+        return '*' in tags or etag.replace('W/', '') in [tag.replace('W/', '') for tag in tags]
+
+    last_modified = validators.get('last_modified')
+    if if_modified_since and last_modified:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+
+def cast_to_float(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+
 def cast_to_int(value):
     try:
         return int(value)
@@ -63,18 +252,17 @@ def cast_to_int(value):
         return None
 
 
-def is_landscape(image: Image) -> bool:
+def is_landscape(size: Tuple[int, int]) -> bool:
     """
     Checks whether an image is landscape or portrait.
 
     Args:
-        image (PIL.Image): The opened PIL Image object.
+        size (Tuple[int, int]): The width and height of the image.
 
     Returns:
         bool: True if the image is landscape, False if it is portrait.
     """
-    # Get the width and height of the image
-    width, height = image.size
+    width, height = size
 
     # Compare the width and height to determine if the image is landscape or portrait
     if width > height:
@@ -0,0 +1,371 @@
+"""
+Pre-warms the derivative cache ahead of traffic, e.g. after a deploy or a catalog import.
+
+Every image under an S3 prefix (or listed in a manifest, one URL per line) is downloaded once and all configured
+width/quality/format variants are written to the derivative store, under the same keys as the equivalent requests.
+Variants already in the store for the current ETag of their source are skipped, and completed sources are appended
+to a state file, so an interrupted run resumes where it stopped. Images are processed on a pool of worker processes.
+
+    python -m imaginex_lambda.prewarm --prefix s3://my-bucket/images/ --widths 640,1080,1920 --state prewarm.state
+    python -m imaginex_lambda.prewarm --manifest urls.txt --cache-dir ./derivatives --workers 4
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+from imaginex_lambda.lib.cache import create_derivative_store, derivative_key
+from imaginex_lambda.lib.fetch import create_s3_client
+from imaginex_lambda.lib.img_lib import cache_variant, fetch_source, get_s3_client, head_source, optimize_variants, \
+    transform_params, split_s3_url
+from imaginex_lambda.lib.utils import accepted_formats, http_date, logger
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+# The configuration of the handler, read here rather than imported from it: importing the handler would create its S3
+# client, which the worker processes would then inherit.
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', 64 * 1024))
+S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME', None)
+DERIVATIVE_CACHE_BUCKET = os.getenv('DERIVATIVE_CACHE_BUCKET', None)
+DERIVATIVE_CACHE_PREFIX = os.getenv('DERIVATIVE_CACHE_PREFIX', 'derivatives/')
+DERIVATIVE_CACHE_DIR = os.getenv('DERIVATIVE_CACHE_DIR', None)
+
+# next.config.js `deviceSizes` and the default `q` of next/image.
+DEFAULT_WIDTHS = (640, 750, 828, 1080, 1200, 1920, 2048, 3840)
+DEFAULT_QUALITIES = (75,)
+DEFAULT_ACCEPT = ('image/avif,image/webp,*/*',)
+PROGRESS_EVERY = 100
+
+# The configuration of the worker process, see `init_worker`.
+_worker: Dict[str, Any] = {}
+
+
+def list_prefix(client, bucket_name: str, prefix: str, url_format: str) -> Iterator[Dict[str, Any]]:
+    """
+    Lists the objects under an S3 prefix as prewarm tasks. The listing carries the ETag and Last-Modified of every
+    object, so up-to-date sources are skipped without a request per object.
+
+    Args:
+        client: The S3 client.
+        bucket_name (str): The bucket to list.
+        prefix (str): The key prefix to list.
+        url_format (str): Formats the URL requests use for an object, from its `key` and `bucket`, e.g. `/{key}`
+            for requests relative to `S3_BUCKET_NAME`.
+    """
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('/'):
+                continue
+            yield {
+                'url': url_format.format(key=obj['Key'], bucket=bucket_name),
+                'source': {'etag': obj.get('ETag'), 'last_modified': http_date(obj.get('LastModified'))},
+            }
+
+
+def read_manifest(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Reads prewarm tasks from a manifest with one URL per line, skipping blank lines and `#` comments.
+    """
+    with open(path) as fin:
+        for line in fin:
+            url = line.strip()
+            if url and not url.startswith('#'):
+                yield {'url': url, 'source': None}
+
+
+def build_variants(widths: Iterable[int],
+                   qualities: Iterable[int],
+                   output_formats: Iterable[Optional[str]]) -> List[Dict[str, Any]]:
+    return [{'width': width, 'height': None, 'quality': quality, 'format': output_format}
+            for output_format in output_formats for quality in qualities for width in widths]
+
+
+def config_hash(variants: List[Dict[str, Any]], accepts: Iterable[str]) -> str:
+    """
+    Identifies a variant configuration in the state file, so sources completed under another configuration are
+    processed again.
+    """
+    payload = json.dumps({'variants': variants, 'accept': sorted(accepts)}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def source_version(source: Dict[str, Any]) -> Optional[str]:
+    """
+    Identifies the version of a source in the state file, by its ETag or, without one, its Last-Modified date.
+    """
+    return source.get('etag') or source.get('last_modified')
+
+
+def load_state(path: Optional[str], config: str) -> Dict[str, Optional[str]]:
+    """
+    Reads the state file of an earlier run.
+
+    Returns:
+        Dict[str, Optional[str]]: The version of every source completed under the same configuration, by URL.
+    """
+    done: Dict[str, Optional[str]] = {}
+    if not path or not os.path.exists(path):
+        return done
+    with open(path) as fin:
+        for line in fin:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line may have been cut off by the interruption.
+                continue
+            if entry.get('config') == config:
+                done[entry['url']] = entry.get('version')
+    return done
+
+
+def open_state(path: str) -> IO[str]:
+    """
+    Opens the state file for appending, first terminating a line cut off by an interruption.
+    """
+    state_file = open(path, 'a')
+    if state_file.tell():
+        with open(path, 'rb') as fin:
+            fin.seek(-1, os.SEEK_END)
+            if fin.read(1) != b'\n':
+                state_file.write('\n')
+    return state_file
+
+
+def init_worker(bucket_name: Optional[str],
+                cache_bucket: Optional[str],
+                cache_prefix: str,
+                cache_dir: Optional[str],
+                variants: List[Dict[str, Any]],
+                accepts: List[str],
+                chunk_size: int) -> None:
+    """
+    Configures the current (worker) process. The store and its clients are created in every worker, after the fork.
+    """
+    _worker.update(
+        bucket_name=bucket_name,
+        store=create_derivative_store(cache_bucket, cache_prefix, cache_dir, get_s3_client() if cache_bucket else None),
+        variants=variants,
+        # Accept headers mapping to the same formats produce the same derivatives.
+        formats=list(dict.fromkeys(accepted_formats(accept) for accept in accepts)),
+        chunk_size=chunk_size,
+    )
+
+
+def missing_variants(url: str, source: Dict[str, Any]) -> List[Tuple[Tuple[str, ...], List[Dict[str, Any]]]]:
+    """
+    Finds the variants of a source which are not in the store for its current version yet.
+
+    Returns:
+        List[Tuple[Tuple[str, ...], List[Dict[str, Any]]]]: The missing variants, grouped by the accepted formats.
+    """
+    store = _worker['store']
+    missing = []
+    for formats in _worker['formats']:
+        group = []
+        for variant in _worker['variants']:
+            params = transform_params(url, variant['quality'], variant['width'], variant['height'], formats,
+                                      variant['format'])
+            key = derivative_key(params, source)
+            if key is None:
+                raise ValueError('Source has no ETag or Last-Modified, its derivatives cannot be cached')
+            if not store.exists(key):
+                group.append(variant)
+        if group:
+            missing.append((formats, group))
+    return missing
+
+
+def prewarm_source(task: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Produces the missing variants of a single source and writes them to the store, in a worker process.
+
+    Returns:
+        Dict[str, Any]: The outcome: the url, the version of the source, the number of variants written and skipped,
+        the bytes downloaded and written, and the error if the source failed.
+    """
+    url = task['url']
+    result = {'url': url, 'version': None, 'written': 0, 'skipped': 0, 'bytes_in': 0, 'bytes_out': 0, 'error': None}
+    try:
+        source = task['source'] or head_source(url, _worker['bucket_name'])
+        result['version'] = source_version(source)
+        total = len(_worker['variants']) * len(_worker['formats'])
+        if 'done_version' in task and task['done_version'] == result['version']:
+            result['skipped'] = total
+            return result
+
+        missing = missing_variants(url, source)
+        result['skipped'] = total - sum(len(group) for _, group in missing)
+        if not missing:
+            return result
+
+        buffer, info = fetch_source(None, url, _worker['bucket_name'], _worker['chunk_size'])
+        with buffer:
+            result['version'] = source_version(info)
+            result['bytes_in'] = buffer.seek(0, os.SEEK_END)
+            for formats, group in missing:
+                buffer.seek(0)
+                for variant, produced in zip(group, optimize_variants(buffer, group, formats)):
+                    cache_variant(url, variant, formats, info, produced, _worker['store'])
+                    result['written'] += 1
+                    result['bytes_out'] += len(produced[0])
+    except Exception as exc:
+        logger.warning("Prewarming %s failed: %s", url, exc)
+        result['error'] = str(exc)
+    return result
+
+
+def imap_bounded(executor: Optional[Executor], fn: Callable[[T], R], items: Iterable[T], limit: int) -> Iterator[R]:
+    """
+    Like `executor.map`, but submits at most `limit` items ahead, so long listings are not queued all at once.
+    Without an executor, the items are processed on the calling process.
+    """
+    if executor is None:
+        for item in items:
+            yield fn(item)
+        return
+
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def throughput(stats: Dict[str, Any], elapsed: float) -> Dict[str, Any]:
+    elapsed = max(elapsed, 1e-9)
+    return {
+        **stats,
+        'elapsed': round(elapsed, 3),
+        'images_per_sec': round(stats['processed'] / elapsed, 2),
+        'variants_per_sec': round(stats['written'] / elapsed, 2),
+        'mb_per_sec': round(stats['bytes_in'] / elapsed / 1024 / 1024, 3),
+    }
+
+
+def prewarm(tasks: Iterable[Dict[str, Any]],
+            variants: List[Dict[str, Any]],
+            accepts: List[str],
+            bucket_name: Optional[str] = None,
+            cache_bucket: Optional[str] = None,
+            cache_prefix: str = '',
+            cache_dir: Optional[str] = None,
+            workers: int = 1,
+            state_path: Optional[str] = None,
+            chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> Dict[str, Any]:
+    """
+    Prewarms the derivative store with all `variants` of the sources of `tasks` (see `list_prefix` and
+    `read_manifest`), for every Accept header of `accepts`.
+
+    Returns:
+        Dict[str, Any]: The counters of the run (sources processed, up to date and failed, variants written and
+        skipped, bytes in and out) and its throughput.
+    """
+    config = config_hash(variants, accepts)
+    done = load_state(state_path, config)
+    stats = {'sources': 0, 'processed': 0, 'up_to_date': 0, 'errors': 0, 'written': 0, 'skipped': 0, 'bytes_in': 0,
+             'bytes_out': 0}
+
+    def pending_tasks() -> Iterator[Dict[str, Any]]:
+        for task in tasks:
+            stats['sources'] += 1
+            if task['url'] in done:
+                if task['source'] is None:
+                    # Only known once the worker has checked the source.
+                    task = {**task, 'done_version': done[task['url']]}
+                elif source_version(task['source']) == done[task['url']]:
+                    stats['up_to_date'] += 1
+                    continue
+            yield task
+
+    init_args = (bucket_name, cache_bucket, cache_prefix, cache_dir, variants, accepts, chunk_size)
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=init_args)
+    else:
+        init_worker(*init_args)
+
+    start = time.perf_counter()
+    state_file = open_state(state_path) if state_path else None
+    try:
+        for result in imap_bounded(executor, prewarm_source, pending_tasks(), workers * 2):
+            stats['skipped'] += result['skipped']
+            if result['error']:
+                stats['errors'] += 1
+                continue
+            if result['written']:
+                stats['processed'] += 1
+            else:
+                stats['up_to_date'] += 1
+            for counter in ('written', 'bytes_in', 'bytes_out'):
+                stats[counter] += result[counter]
+            if state_file is not None:
+                state_file.write(json.dumps({'url': result['url'], 'version': result['version'],
+                                            'config': config}) + '\n')
+                state_file.flush()
+            if stats['sources'] % PROGRESS_EVERY == 0:
+                logger.info("Prewarm progress: %s", throughput(stats, time.perf_counter() - start))
+    finally:
+        if state_file is not None:
+            state_file.close()
+        if executor is not None:
+            executor.shutdown()
+
+    return throughput(stats, time.perf_counter() - start)
+
+
+def parse_list(value: str, cast: Callable[[str], T] = str) -> List[T]:
+    return [cast(item) for item in value.split(',') if item]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sources = parser.add_mutually_exclusive_group(required=True)
+    sources.add_argument('--prefix', help='S3 prefix to prewarm, as s3://bucket/prefix')
+    sources.add_argument('--manifest', help='file with one source URL per line')
+    parser.add_argument('--url-format', default=None,
+                        help='URL requests use for a listed object, from {key} and {bucket} (default: /{key} for '
+                             'objects in S3_BUCKET_NAME, s3://{bucket}/{key} otherwise)')
+    parser.add_argument('--bucket', default=S3_BUCKET_NAME, help='bucket of relative URLs (default: S3_BUCKET_NAME)')
+    parser.add_argument('--widths', type=lambda v: parse_list(v, int), default=list(DEFAULT_WIDTHS))
+    parser.add_argument('--qualities', type=lambda v: parse_list(v, int), default=list(DEFAULT_QUALITIES))
+    parser.add_argument('--formats', type=parse_list, default=[],
+                        help='explicit output formats (`f`), besides the format negotiated from --accept')
+    parser.add_argument('--accept', action='append', default=None,
+                        help='Accept header to prewarm negotiated formats for, repeatable (default: AVIF and WebP)')
+    parser.add_argument('--cache-bucket', default=DERIVATIVE_CACHE_BUCKET)
+    parser.add_argument('--cache-prefix', default=DERIVATIVE_CACHE_PREFIX)
+    parser.add_argument('--cache-dir', default=DERIVATIVE_CACHE_DIR)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--state', default=None, help='state file to resume an interrupted run from')
+    args = parser.parse_args(argv)
+
+    if not args.cache_bucket and not args.cache_dir:
+        parser.error('a derivative store is required, set --cache-bucket or --cache-dir')
+
+    bucket_name = args.bucket
+    if args.prefix:
+        prefix_bucket, prefix = split_s3_url(args.prefix, '')
+        bucket_name = bucket_name or prefix_bucket
+        url_format = args.url_format or ('/{key}' if prefix_bucket == bucket_name else 's3://{bucket}/{key}')
+        # Listed with a client of its own, the shared one is only created in the workers.
+        tasks = list_prefix(create_s3_client(), prefix_bucket, prefix, url_format)
+    else:
+        tasks = read_manifest(args.manifest)
+
+    variants = build_variants(args.widths, args.qualities, [None] + args.formats)
+    report = prewarm(tasks, variants, args.accept or list(DEFAULT_ACCEPT), bucket_name, args.cache_bucket,
+                     args.cache_prefix, args.cache_dir, args.workers, args.state)
+    print(json.dumps(report))
+    return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
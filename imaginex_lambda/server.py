@@ -0,0 +1,206 @@
+"""
+HTTP server for deployments outside of lambda (containers, VMs behind a load balancer).
+
+Serves `GET /_next/image?url=&w=&q=` (any query parameter of the lambda works, e.g. `f`, `maxbytes` or `info`) through
+the lambda `handler`, with raw binary bodies instead of base64. The listening socket is opened once and shared by
+`SERVER_WORKERS` pre-forked worker processes (one per CPU by default), each handling up to `SERVER_THREADS` requests
+at a time on separate threads, so concurrent identical requests reaching the same worker are coalesced (see
+`COALESCE_REQUESTS`). Every worker keeps its derivative and in-memory caches, HTTP connection pools and S3 client
+across requests.
+
+    python -m imaginex_lambda.server --port 8080
+"""
+import argparse
+import os
+import signal
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+from imaginex_lambda.handler import handler
+from imaginex_lambda.lib.utils import logger
+
+SERVER_HOST = os.getenv('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.getenv('SERVER_PORT', 8080))
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', 0)) or os.cpu_count() or 1
+# Requests a worker processes at a time, `1` handles them one at a time on the worker's main thread, like lambda.
+SERVER_THREADS = max(1, int(os.getenv('SERVER_THREADS', 4)))
+SERVER_PATH = os.getenv('SERVER_PATH', '/_next/image')
+HEALTH_PATH = '/_health'
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+def to_event(path: str, headers: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    """
+    Maps an HTTP request onto the lambda event `handler` expects, the way API Gateway does (for repeated query
+    parameters, the last one wins).
+
+    Returns:
+        Optional[Dict[str, Any]]: The event or None if the path is not served.
+    """
+    parts = urlsplit(path)
+    if parts.path != SERVER_PATH:
+        return None
+    return {
+        'queryStringParameters': dict(parse_qsl(parts.query, keep_blank_values=True)),
+        'headers': {name.lower(): value for name, value in headers.items()},
+    }
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'imaginex'
+    # Every connection is closed after its response, a keep-alive connection would hold one of the worker's threads
+    # for everybody else.
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self) -> None:
+        self.respond(include_body=True)
+
+    def do_HEAD(self) -> None:
+        self.respond(include_body=False)
+
+    def respond(self, include_body: bool) -> None:
+        if urlsplit(self.path).path == HEALTH_PATH:
+            self.send(200, {'Content-Type': 'text/plain'}, b'ok', include_body)
+            return
+
+        event = to_event(self.path, dict(self.headers.items()))
+        if event is None:
+            self.send(404, {'Content-Type': 'text/plain'}, b'Not Found', include_body)
+            return
+
+        response = handler(event, None, binary=True)
+        body = response.get('body') or b''
+        if isinstance(body, str):
+            body = body.encode()
+        self.send(response['statusCode'], response.get('headers') or {}, body, include_body)
+
+    def send(self, status: int, headers: Dict[str, str], body: bytes, include_body: bool) -> None:
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if include_body:
+            # Written in chunks, so large images go out as the socket accepts them.
+            view = memoryview(body)
+            for start in range(0, len(view), WRITE_CHUNK_SIZE):
+                self.wfile.write(view[start:start + WRITE_CHUNK_SIZE])
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.info(f"{self.address_string()} - {format % args}")
+
+
+class ThreadedImageServer(ThreadingHTTPServer):
+    """
+    Handles every request on its own thread, at most `threads` at a time: while they are all busy, the worker does not
+    accept connections and leaves them to the other workers.
+    """
+    daemon_threads = True
+
+    def __init__(self, server_address: Any, handler_class: Any, threads: int) -> None:
+        super().__init__(server_address, handler_class)
+        self.slots = threading.BoundedSemaphore(threads)
+
+    def get_request(self) -> Any:
+        self.slots.acquire()
+        try:
+            return super().get_request()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def shutdown_request(self, request: Any) -> None:
+        try:
+            super().shutdown_request(request)
+        finally:
+            self.slots.release()
+
+
+def create_server(host: str = SERVER_HOST, port: int = SERVER_PORT, threads: int = SERVER_THREADS) -> HTTPServer:
+    """
+    Opens the listening socket. It is non-blocking, so a worker woken up for a connection another worker accepted
+    first goes back to waiting instead of blocking in `accept`.
+    """
+    if threads > 1:
+        server: HTTPServer = ThreadedImageServer((host, port), ImageRequestHandler, threads)
+    else:
+        server = HTTPServer((host, port), ImageRequestHandler)
+    server.socket.setblocking(False)
+    return server
+
+
+def fork_worker(server: HTTPServer) -> int:
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            server.serve_forever()
+        finally:
+            os._exit(0)
+    return pid
+
+
+def serve(server: HTTPServer, workers: int = SERVER_WORKERS) -> None:
+    """
+    Serves requests on `workers` pre-forked processes sharing the listening socket, restarting any worker which
+    dies, until the server receives SIGTERM or SIGINT. With a single worker (or without `fork`), requests are
+    served on the current process.
+    """
+    host, port = server.server_address[:2]
+    logger.info(f"Serving {SERVER_PATH} on http://{host}:{port} with {workers} worker(s)")
+    if workers <= 1 or not hasattr(os, 'fork'):
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    children: List[int] = [fork_worker(server) for _ in range(workers)]
+    stopping = False
+
+    def stop(signum: int, frame: Any) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        if pid not in children:
+            continue
+        children.remove(pid)
+        if not stopping:
+            logger.warning(f"Worker {pid} exited with status {status}, restarting it")
+            children.append(fork_worker(server))
+
+    server.server_close()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS, help='worker processes, one per CPU by default')
+    parser.add_argument('--threads', type=int, default=SERVER_THREADS, help='concurrent requests per worker')
+    args = parser.parse_args(argv)
+
+    serve(create_server(args.host, args.port, args.threads), args.workers)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,26 @@
+from io import BytesIO
+
+from PIL import Image, ImageFilter
+
+
+def make_image(img_type='JPEG', size=(800, 600), color=(10, 200, 30), mode='RGB', noise=False, blur=0,
+               **options):
+    """
+    Encodes a synthetic source image, rewound and ready to be read. Use `.getvalue()` for the raw bytes.
+
+    Args:
+        img_type: The Pillow format to save as.
+        size: The image size.
+        color: The fill color, ignored for noise.
+        mode: The image mode.
+        noise: Fill with random noise instead, which compresses like a photo rather than a flat color.
+        blur: The radius of a Gaussian blur, to make noise smoother and more photo-like.
+        **options: Passed to `Image.save`, e.g. `quality`.
+    """
+    img = Image.effect_noise(size, 64).convert(mode) if noise else Image.new(mode, size, color=color)
+    if blur:
+        img = img.filter(ImageFilter.GaussianBlur(blur))
+    buffer = BytesIO()
+    img.save(buffer, format=img_type, **options)
+    buffer.seek(0)
+    return buffer
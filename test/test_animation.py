@@ -0,0 +1,131 @@
+from io import BytesIO
+from unittest.mock import patch, MagicMock
+
+import pytest
+from PIL import Image, ImageDraw, ImageFilter, ImageSequence
+
+from imaginex_lambda.lib.exceptions import HandlerError
+from imaginex_lambda.lib.img_lib import download_and_optimize, download_and_optimize_variants, is_animated
+
+
+def make_animation(img_type='GIF', size=(400, 300), frames=6, **options):
+    # A photo-like background, where WebP beats GIF's palette by a wide margin.
+    noise = Image.effect_noise(size, 40).filter(ImageFilter.GaussianBlur(2)).convert('RGB')
+    background = Image.blend(Image.linear_gradient('L').resize(size).convert('RGB'), noise, 0.4)
+    images = []
+    for i in range(frames):
+        frame = background.copy()
+        ImageDraw.Draw(frame).ellipse((i * 40, 50, i * 40 + 100, 150), fill=(200, 30, 30))
+        images.append(frame)
+    buffer = BytesIO()
+    images[0].save(buffer, format=img_type, save_all=True, append_images=images[1:],
+                   duration=[100 + i * 10 for i in range(frames)], **options)
+    buffer.seek(0)
+    return buffer
+
+
+def optimize(source, accept=None, output_format=None, width=200):
+    with patch('imaginex_lambda.lib.img_lib.download_image', MagicMock(return_value=(source, {}))):
+        return download_and_optimize('https://example.com/a', 70, width, None, '', accept=accept,
+                                     output_format=output_format)
+
+
+def frames_of(image_data):
+    with Image.open(BytesIO(image_data)) as img:
+        frames = []
+        for frame in ImageSequence.Iterator(img):
+            frame.load()
+            frames.append((frame.size, frame.info['duration']))
+        return img.format, img.info.get('loop'), frames
+
+
+def test_is_animated():
+    assert is_animated(make_animation(frames=3))
+    assert not is_animated(make_animation(frames=1))
+
+
+def test_animated_gif_keeps_frames():
+    image_data, content_type, _ = optimize(make_animation(loop=0))
+
+    fmt, loop, frames = frames_of(image_data)
+    assert content_type == 'image/gif'
+    assert (fmt, loop) == ('GIF', 0)
+    assert frames == [((200, 150), 100 + i * 10) for i in range(6)]
+
+
+def test_animated_gif_to_webp():
+    image_data, content_type, ratio = optimize(make_animation(loop=0), accept='image/avif,image/webp')
+
+    fmt, loop, frames = frames_of(image_data)
+    assert content_type == 'image/webp'
+    assert (fmt, loop) == ('WEBP', 0)
+    assert frames == [((200, 150), 100 + i * 10) for i in range(6)]
+    assert ratio < 0.5
+
+
+@pytest.mark.parametrize('img_type', ['GIF', 'WEBP'])
+def test_animation_without_loop_plays_once(img_type):
+    options = {} if img_type == 'GIF' else {'loop': 1}
+    image_data, _, _ = optimize(make_animation(img_type, **options), output_format='webp')
+
+    assert frames_of(image_data)[1] == 1
+
+
+def test_animated_webp_keeps_frames():
+    image_data, content_type, _ = optimize(make_animation('WEBP', loop=3), accept='image/webp')
+
+    fmt, loop, frames = frames_of(image_data)
+    assert content_type == 'image/webp'
+    assert (fmt, loop) == ('WEBP', 3)
+    assert len(frames) == 6
+    assert frames[0][0] == (200, 150)
+
+
+def test_explicit_static_format_uses_first_frame():
+    image_data, content_type, _ = optimize(make_animation(loop=0), output_format='png')
+
+    with Image.open(BytesIO(image_data)) as img:
+        assert content_type == 'image/png'
+        assert not getattr(img, 'is_animated', False)
+        assert img.size == (200, 150)
+
+
+def test_animation_frames_are_resized_as_decoded():
+    source = make_animation(frames=8)
+    resized = []
+    original_resize = Image.Image.resize
+
+    def resize(self, *args, **kwargs):
+        resized.append(self.size)
+        return original_resize(self, *args, **kwargs)
+
+    with patch.object(Image.Image, 'resize', resize):
+        image_data, _, _ = optimize(source)
+
+    assert resized == [(400, 300)] * 8
+    assert len(frames_of(image_data)[2]) == 8
+
+
+def test_animated_variants():
+    variants = [{'width': w, 'height': None, 'quality': 70, 'format': None} for w in (100, 200)]
+
+    with patch('imaginex_lambda.lib.img_lib.download_image', MagicMock(return_value=(make_animation(loop=0), {}))):
+        results = download_and_optimize_variants('https://example.com/a', variants, '', accept='image/webp')
+
+    assert [r[1] for r in results] == ['image/webp', 'image/webp']
+    assert [frames_of(r[0])[2][0][0] for r in results] == [(100, 75), (200, 150)]
+    assert all(len(frames_of(r[0])[2]) == 6 for r in results)
+
+
+@pytest.mark.parametrize('width', [200, 1000])
+def test_animation_over_pixel_budget_is_rejected(width):
+    # Six frames, resized to 200x150px or kept at 400x300px.
+    frame_pixels = 200 * 150 if width == 200 else 400 * 300
+    with patch('imaginex_lambda.lib.limits.MAX_ANIMATION_PIXELS', 6 * frame_pixels):
+        optimize(make_animation(), width=width)
+
+    with patch('imaginex_lambda.lib.limits.MAX_ANIMATION_PIXELS', 6 * frame_pixels - 1), \
+            pytest.raises(HandlerError) as exc:
+        optimize(make_animation(), width=width)
+
+    assert exc.value.code == 413
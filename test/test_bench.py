@@ -0,0 +1,37 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import bench  # noqa: E402
+
+
+@pytest.mark.parametrize('source', ['http', 's3'])
+def test_bench_runs_offline(tmp_path, source):
+    output = tmp_path / 'results.json'
+
+    results = bench.main(['--formats', 'JPEG,GIF', '--megapixels', '0.02', '--widths', '64', '--qualities', '70',
+                          '--repeat', '2', '--source', source, '--sources', str(tmp_path / 'sources'),
+                          '--output', str(output)])
+
+    assert json.loads(output.read_text()) == results
+    assert [case['format'] for case in results['cases']] == ['JPEG', 'GIF']
+    assert results['handler_import_ms'] > 0
+    for case in results['cases']:
+        assert list(case['stages']) == ['fetch', 'sniff', 'decode', 'resize', 'encode', 'base64', 'total']
+        assert case['stages']['resize']['bytes'] == 64 * 42 * (3 if case['format'] == 'JPEG' else 1)
+        assert case['stages']['encode']['bytes'] == case['stages']['total']['bytes']
+        assert case['stages']['base64']['bytes'] == (case['stages']['encode']['bytes'] + 2) // 3 * 4
+        assert all(stage['seconds'] > 0 and stage['peak_rss_mb'] > 0 for stage in case['stages'].values())
+
+
+def test_bench_compare(tmp_path, capsys):
+    args = ['--formats', 'PNG', '--megapixels', '0.02', '--widths', '64', '--qualities', '70', '--repeat', '1',
+            '--sources', str(tmp_path / 'sources')]
+    bench.main(args + ['--output', str(tmp_path / 'a.json')])
+    bench.main(args + ['--output', str(tmp_path / 'b.json'), '--compare', str(tmp_path / 'a.json')])
+
+    assert 'bytes        +0' in capsys.readouterr().out
@@ -0,0 +1,79 @@
+from unittest.mock import patch, MagicMock
+
+import botocore.session
+from botocore.stub import Stubber
+
+from imaginex_lambda.handler import handler
+from imaginex_lambda.lib.cache import LocalDerivativeStore, S3DerivativeStore, derivative_key
+from test.images import make_image
+
+
+def test_derivative_key_depends_on_source_version():
+    params = {'url': 'https://example.com/a.png', 'quality': 70, 'width': 100, 'height': None}
+
+    key = derivative_key(params, {'etag': '"abc"'})
+    assert key == derivative_key(dict(params), {'etag': '"abc"'})
+    assert key != derivative_key(params, {'etag': '"def"'})
+    assert key != derivative_key({**params, 'width': 200}, {'etag': '"abc"'})
+    assert derivative_key(params, {'etag': None, 'last_modified': None}) is None
+
+
+def test_handler_cache_miss_then_hit(tmp_path):
+    store = LocalDerivativeStore(str(tmp_path))
+    head_source_mock = MagicMock(return_value={'etag': '"v1"', 'last_modified': None})
+    tmp_img = make_image('PNG', (300, 200), (0, 128, 255))
+    download_image_mock = MagicMock(return_value=(tmp_img, {}))
+    context = {'queryStringParameters': {'url': 'https://example.com/a.png', 'w': '100', 'q': '70'}}
+
+    with patch('imaginex_lambda.handler.DERIVATIVE_STORE', store), \
+            patch('imaginex_lambda.lib.img_lib.head_source', head_source_mock), \
+            patch('imaginex_lambda.lib.img_lib.download_image', download_image_mock):
+        miss = handler(context, None)
+        hit = handler(context, None)
+    tmp_img.close()
+
+    assert download_image_mock.call_count == 1
+    assert miss['statusCode'] == 200
+    assert miss['headers']['X-Cache'] == 'MISS'
+    assert hit['headers']['X-Cache'] == 'HIT'
+    assert hit['headers']['X-Cache-Hits'] == '1'
+    assert hit['headers']['X-Cache-Misses'] == '1'
+    assert hit['body'] == miss['body']
+    assert hit['headers']['Content-Type'] == miss['headers']['Content-Type'] == 'image/png'
+
+
+def test_handler_cache_bypass_without_validators(tmp_path):
+    store = LocalDerivativeStore(str(tmp_path))
+    head_source_mock = MagicMock(return_value={'etag': None, 'last_modified': None})
+    tmp_img = make_image('PNG', (300, 200), (0, 128, 255))
+    context = {'queryStringParameters': {'url': 'https://example.com/a.png', 'w': '100'}}
+
+    with patch('imaginex_lambda.handler.DERIVATIVE_STORE', store), \
+            patch('imaginex_lambda.lib.img_lib.head_source', head_source_mock), \
+            patch('imaginex_lambda.lib.img_lib.download_image', MagicMock(return_value=(tmp_img, {}))):
+        r = handler(context, None)
+    tmp_img.close()
+
+    assert r['statusCode'] == 200
+    assert r['headers']['X-Cache'] == 'BYPASS'
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_store_exists(tmp_path):
+    local = LocalDerivativeStore(str(tmp_path))
+    local.put('k', b'data', 'image/png', 0.5)
+    assert local.exists('k')
+    assert not local.exists('other')
+    assert local.hits == local.misses == 0
+
+    client = botocore.session.get_session().create_client('s3', region_name='us-east-1', aws_access_key_id='a',
+                                                          aws_secret_access_key='b')
+    store = S3DerivativeStore(client, 'bucket', 'derivatives/')
+    with Stubber(client) as stubber:
+        stubber.add_response('head_object', {}, {'Bucket': 'bucket', 'Key': 'derivatives/k'})
+        stubber.add_client_error('head_object', '404', http_status_code=404)
+        stubber.add_client_error('head_object', '403', http_status_code=403)
+        assert store.exists('k')
+        assert not store.exists('other')
+        # Errors other than a missing object are logged and treated as a miss.
+        assert not store.exists('denied')
@@ -0,0 +1,174 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch, MagicMock
+
+import botocore.session
+import pytest
+from botocore.stub import Stubber
+
+from imaginex_lambda.handler import handler
+from imaginex_lambda.lib.cache import LocalDerivativeStore, S3DerivativeStore
+from imaginex_lambda.lib.coalesce import SingleFlight
+from imaginex_lambda.lib.img_lib import download_and_optimize
+from test.images import make_image
+
+
+def slow_download(release, calls):
+    def download(buffer, url, chunk_size):
+        calls.append(url)
+        release.wait(5)
+        return make_image(), {'etag': '"v1"'}
+
+    return download
+
+
+def run_concurrently(fn, count):
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        futures = [pool.submit(fn) for _ in range(count)]
+        return [future.result() for future in futures]
+
+
+def test_single_flight_shares_results_and_errors():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        release.wait(5)
+        return 'result'
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = [pool.submit(flight.do, 'key', work) for _ in range(4)]
+        while len(calls) < 1:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        release.set()
+        results = [future.result() for future in futures]
+
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False, True, True, True]
+    assert {result for result, _ in results} == {'result'}
+    assert len(flight) == 0
+    # Only calls in flight are shared.
+    assert flight.do('key', lambda: 'again') == ('again', False)
+
+    def fail():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        flight.do('key', fail)
+    assert len(flight) == 0
+
+
+def test_handler_coalesces_identical_requests():
+    release = threading.Event()
+    calls = []
+    event = {'queryStringParameters': {'url': 'https://example.com/a.jpg', 'w': '200', 'q': '70'}}
+
+    def request():
+        return handler(event, None)
+
+    with patch('imaginex_lambda.lib.img_lib.download_image', side_effect=slow_download(release, calls)):
+        threading.Timer(0.2, release.set).start()
+        responses = run_concurrently(request, 6)
+
+    assert len(calls) == 1
+    assert {r['statusCode'] for r in responses} == {200}
+    assert len({r['body'] for r in responses}) == 1
+    assert sum(r['headers'].get('X-Coalesced') == 'HIT' for r in responses) == 5
+
+
+def test_different_transforms_are_not_coalesced():
+    responses = []
+    with patch('imaginex_lambda.lib.img_lib.download_image', MagicMock(side_effect=lambda *args: (make_image(), {}))) \
+            as download_mock:
+        for width in ('100', '200'):
+            responses.append(handler({'queryStringParameters': {'url': 'https://example.com/a.jpg', 'w': width}},
+                                     None))
+
+    assert download_mock.call_count == 2
+    assert all('X-Coalesced' not in r['headers'] for r in responses)
+
+
+def test_local_store_lock(tmp_path):
+    store = LocalDerivativeStore(str(tmp_path))
+    other = LocalDerivativeStore(str(tmp_path))
+
+    assert store.lock('k', 30)
+    assert not other.lock('k', 30)
+    assert other.wait('k', timeout=0.1, ttl=30, interval=0.02) is None
+
+    threading.Timer(0.1, lambda: (store.put('k', b'data', 'image/png', 0.5), store.unlock('k'))).start()
+    assert other.wait('k', timeout=5, ttl=30, interval=0.02) == (b'data', 'image/png', 0.5)
+    assert other.lock('k', 30)
+    other.unlock('k')
+
+    # A lock released without a derivative (the producer failed) stops the wait.
+    assert store.lock('failed', 30)
+    threading.Timer(0.1, store.unlock, ['failed']).start()
+    start = time.monotonic()
+    assert other.wait('failed', timeout=5, ttl=30, interval=0.02) is None
+    assert time.monotonic() - start < 2
+
+    # Abandoned locks are taken over.
+    assert store.lock('stale', 30)
+    os.utime(os.path.join(str(tmp_path), 'stale.lock'), (time.time() - 60, time.time() - 60))
+    assert other.lock('stale', 30)
+
+
+def test_s3_store_lock():
+    client = botocore.session.get_session().create_client('s3', region_name='us-east-1', aws_access_key_id='a',
+                                                          aws_secret_access_key='b')
+    store = S3DerivativeStore(client, 'bucket', 'derivatives/')
+    lock = {'Bucket': 'bucket', 'Key': 'derivatives/k.lock'}
+    now = datetime.now(timezone.utc)
+
+    with Stubber(client) as stubber:
+        stubber.add_response('put_object', {}, {**lock, 'Body': b'', 'IfNoneMatch': '*'})
+        assert store.lock('k', 30)
+
+        stubber.add_client_error('put_object', 'PreconditionFailed', http_status_code=412)
+        stubber.add_response('head_object', {'LastModified': now}, lock)
+        assert not store.lock('k', 30)
+
+        stubber.add_client_error('put_object', 'PreconditionFailed', http_status_code=412)
+        stubber.add_response('head_object', {'LastModified': now - timedelta(seconds=60)}, lock)
+        stubber.add_response('delete_object', {}, lock)
+        stubber.add_response('put_object', {}, {**lock, 'Body': b'', 'IfNoneMatch': '*'})
+        assert store.lock('k', 30)
+
+        stubber.add_response('delete_object', {}, lock)
+        store.unlock('k')
+
+        # Failing to lock must not fail the request, it is produced without the lock.
+        stubber.add_client_error('put_object', 'AccessDenied', http_status_code=403)
+        assert store.lock('k', 30)
+        stubber.assert_no_pending_responses()
+
+
+def test_store_lock_across_instances(tmp_path):
+    release = threading.Event()
+    calls = []
+    head = MagicMock(return_value={'etag': '"v1"', 'last_modified': None})
+
+    def request():
+        # A store per request, as separate instances would have.
+        details = {}
+        result = download_and_optimize('https://example.com/a.jpg', 70, 200, None, '',
+                                       store=LocalDerivativeStore(str(tmp_path)), details=details, store_lock=True)
+        return result, details
+
+    with patch('imaginex_lambda.lib.img_lib.download_image', side_effect=slow_download(release, calls)), \
+            patch('imaginex_lambda.lib.img_lib.head_source', head), \
+            patch('imaginex_lambda.lib.img_lib.STORE_LOCK_POLL', 0.02):
+        threading.Timer(0.2, release.set).start()
+        results = run_concurrently(request, 3)
+
+    assert len(calls) == 1
+    assert len({result for result, _ in results}) == 1
+    assert sorted(details['cache'] for _, details in results) == ['HIT', 'HIT', 'MISS']
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.lock')]
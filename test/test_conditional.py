@@ -0,0 +1,89 @@
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+from imaginex_lambda.handler import handler
+from imaginex_lambda.lib.lru import LRUCache
+from imaginex_lambda.lib.utils import is_not_modified
+from test.images import make_image
+
+LAST_MODIFIED = 'Wed, 21 Oct 2015 07:28:00 GMT'
+
+
+@pytest.mark.parametrize('if_none_match,if_modified_since,expected', [
+    ('"abc"', None, True),
+    ('W/"abc"', None, True),
+    ('"def", "abc"', None, True),
+    ('*', None, True),
+    ('"def"', None, False),
+    ('"def"', 'Thu, 22 Oct 2015 07:28:00 GMT', False),
+    (None, 'Wed, 21 Oct 2015 07:28:00 GMT', True),
+    (None, 'Thu, 22 Oct 2015 07:28:00 GMT', True),
+    (None, 'Tue, 20 Oct 2015 07:28:00 GMT', False),
+    (None, 'not a date', False),
+    (None, None, False),
+])
+def test_is_not_modified(if_none_match, if_modified_since, expected):
+    validators = {'etag': '"abc"', 'last_modified': LAST_MODIFIED}
+    assert is_not_modified(validators, if_none_match, if_modified_since) is expected
+
+
+def request(headers=None, memory_cache=None):
+    head_source_mock = MagicMock(return_value={'etag': '"v1"', 'last_modified': LAST_MODIFIED})
+    download_image_mock = MagicMock(return_value=(make_image('PNG', (300, 200), (0, 128, 255)), {'etag': '"v1"', 'last_modified': LAST_MODIFIED}))
+    context = {'queryStringParameters': {'url': 'https://example.com/a.png', 'w': '100'}, 'headers': headers or {}}
+
+    with patch('imaginex_lambda.handler.MEMORY_CACHE', memory_cache), \
+            patch('imaginex_lambda.lib.img_lib.head_source', head_source_mock), \
+            patch('imaginex_lambda.lib.img_lib.download_image', download_image_mock):
+        r = handler(context, None)
+    return r, head_source_mock, download_image_mock
+
+
+def test_caching_headers():
+    r, head_source_mock, _ = request()
+
+    assert r['statusCode'] == 200
+    assert r['headers']['ETag'].startswith('"')
+    assert r['headers']['Last-Modified'] == LAST_MODIFIED
+    assert 'max-age' in r['headers']['Cache-Control']
+    head_source_mock.assert_not_called()
+
+    # The ETag is deterministic for the same source and transform.
+    assert request()[0]['headers']['ETag'] == r['headers']['ETag']
+
+
+def test_if_none_match_skips_download():
+    etag = request()[0]['headers']['ETag']
+
+    r, head_source_mock, download_image_mock = request({'If-None-Match': etag})
+
+    assert r['statusCode'] == 304
+    assert r['body'] == ''
+    assert r['headers']['ETag'] == etag
+    head_source_mock.assert_called_once()
+    download_image_mock.assert_not_called()
+
+
+def test_if_none_match_changed_source():
+    r, _, download_image_mock = request({'If-None-Match': '"stale"'})
+
+    assert r['statusCode'] == 200
+    download_image_mock.assert_called_once()
+
+
+def test_if_modified_since():
+    r, _, download_image_mock = request({'if-modified-since': 'Thu, 22 Oct 2015 07:28:00 GMT'})
+
+    assert r['statusCode'] == 304
+    download_image_mock.assert_not_called()
+
+
+def test_not_modified_from_memory_cache():
+    cache = LRUCache(max_bytes=1024 * 1024, ttl=60)
+    etag = request(memory_cache=cache)[0]['headers']['ETag']
+
+    r, head_source_mock, _ = request({'If-None-Match': etag}, memory_cache=cache)
+
+    assert r['statusCode'] == 304
+    head_source_mock.assert_not_called()
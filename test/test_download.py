@@ -0,0 +1,84 @@
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from imaginex_lambda.lib.img_lib import download_and_optimize, read_into_memory
+from test.images import make_image
+
+IMAGE_DATA = make_image('PNG', (300, 200), (255, 0, 0)).getvalue()
+
+
+class ChunkedStream:
+    """Stream without `readinto`, returning at most 7 bytes per read."""
+
+    def __init__(self, data: bytes):
+        self.data = BytesIO(data)
+
+    def read(self, size=-1):
+        return self.data.read(min(size, 7) if size and size > 0 else 7)
+
+
+@pytest.fixture(scope='module')
+def image_server():
+    image_data = IMAGE_DATA
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            if self.path != '/no-length.png':
+                self.send_header('Content-Length', str(len(image_data)))
+            self.end_headers()
+            self.wfile.write(image_data)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+def test_read_into_memory_presized():
+    data = IMAGE_DATA
+
+    buffer = read_into_memory(BytesIO(data), len(data))
+
+    assert buffer.tell() == 0
+    assert buffer.getvalue() == data
+
+
+@pytest.mark.parametrize('content_length', [None, 0])
+def test_read_into_memory_unknown_length(content_length):
+    data = IMAGE_DATA
+
+    assert read_into_memory(ChunkedStream(data), content_length, chunk_size=16).getvalue() == data
+
+
+def test_read_into_memory_without_readinto():
+    data = IMAGE_DATA
+
+    assert read_into_memory(ChunkedStream(data), len(data)).getvalue() == data
+
+
+def test_read_into_memory_truncated():
+    data = IMAGE_DATA
+
+    with pytest.raises(Exception, match='incomplete download'):
+        read_into_memory(BytesIO(data[:10]), len(data))
+
+
+@pytest.mark.parametrize('download_mode', ['memory', 'tempfile'])
+@pytest.mark.parametrize('path', ['/image.png', '/no-length.png'])
+def test_download_modes(image_server, download_mode, path):
+    image_data, content_type, ratio = download_and_optimize(f'{image_server}{path}', 80, 100, None, '',
+                                                            download_mode=download_mode)
+
+    assert content_type == 'image/png'
+    assert Image.open(BytesIO(image_data)).size == (100, 66)
+    assert 0 < ratio
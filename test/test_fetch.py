@@ -0,0 +1,166 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from unittest.mock import patch
+
+import pytest
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+from imaginex_lambda.lib.fetch import create_http_session, create_s3_client, fetch_all
+from imaginex_lambda.lib.img_lib import download_image, get_s3_image, head_source
+from test.images import make_image
+
+IMAGE_DATA = make_image('PNG', (30, 20), (255, 0, 0)).getvalue()
+
+
+@pytest.fixture()
+def image_server():
+    state = {'connections': set(), 'failures': 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            state['connections'].add(self.client_address)
+            if state['failures']:
+                state['failures'] -= 1
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(IMAGE_DATA)))
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+            self.wfile.write(IMAGE_DATA)
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(IMAGE_DATA)))
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    state['url'] = f'http://127.0.0.1:{server.server_port}/image.png'
+    yield state
+    server.shutdown()
+
+
+def test_http_connections_are_reused(image_server):
+    session = create_http_session(pool_size=2, retries=0)
+
+    with patch('imaginex_lambda.lib.img_lib.http_session', session):
+        for _ in range(3):
+            buffer, info = download_image(None, image_server['url'])
+            assert buffer.getvalue() == IMAGE_DATA
+            assert info['etag'] == '"v1"'
+
+    assert len(image_server['connections']) == 1
+
+
+def test_http_retries_transient_errors(image_server):
+    image_server['failures'] = 2
+    session = create_http_session(retries=2, backoff=0)
+
+    with patch('imaginex_lambda.lib.img_lib.http_session', session):
+        buffer, _ = download_image(None, image_server['url'])
+
+    assert buffer.getvalue() == IMAGE_DATA
+    assert image_server['failures'] == 0
+
+
+def test_http_gives_up_after_retries(image_server):
+    image_server['failures'] = 3
+    session = create_http_session(retries=1, backoff=0)
+
+    with patch('imaginex_lambda.lib.img_lib.http_session', session), pytest.raises(Exception, match='503'):
+        download_image(None, image_server['url'])
+
+
+def test_http_head_source(image_server):
+    with patch('imaginex_lambda.lib.img_lib.http_session', create_http_session()):
+        info = head_source(image_server['url'], '')
+
+    assert info == {'content_type': 'image/png', 'content_size': len(IMAGE_DATA), 'etag': '"v1"',
+                    'last_modified': None}
+
+
+def test_s3_client_configuration():
+    client = create_s3_client(pool_size=7, connect_timeout=1, read_timeout=2, retries=4)
+
+    assert client.meta.config.max_pool_connections == 7
+    assert client.meta.config.connect_timeout == 1
+    assert client.meta.config.read_timeout == 2
+    assert client.meta.config.retries['total_max_attempts'] == 5
+
+
+def test_stubbed_s3_download():
+    client = create_s3_client()
+    stubber = Stubber(client)
+    stubber.add_response('get_object', {
+        'Body': StreamingBody(BytesIO(IMAGE_DATA), len(IMAGE_DATA)),
+        'ContentType': 'image/png',
+        'ContentLength': len(IMAGE_DATA),
+        'ETag': '"v1"',
+    }, {'Bucket': 'bucket', 'Key': 'image.png'})
+
+    with stubber, patch('imaginex_lambda.lib.img_lib.s3_client', client):
+        buffer, info = get_s3_image(None, 'bucket', 'image.png')
+
+    assert buffer.getvalue() == IMAGE_DATA
+    assert info['etag'] == '"v1"'
+    stubber.assert_no_pending_responses()
+
+
+def test_fetch_all_runs_concurrently_in_order():
+    def fetch(item):
+        time.sleep(0.2 if item == 1 else 0.05)
+        return item * 10
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(fetch_all(executor, [1, 2, 3, 4], fetch, limit=4))
+
+    assert results == [10, 20, 30, 40]
+    assert time.perf_counter() - start < 0.4
+    assert list(fetch_all(None, [1, 2], lambda item: item * 10)) == [10, 20]
+
+
+def test_fetch_all_releases_results_on_early_exit():
+    started = []
+    released = []
+
+    def fetch(item):
+        started.append(item)
+        time.sleep(0.05)
+        return item
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = fetch_all(executor, [1, 2, 3, 4, 5, 6], fetch, limit=3, release=released.append)
+        assert next(results) == 1
+        results.close()
+
+    # Only the items within the limit were fetched, and everything fetched but not consumed was released.
+    assert set(started) <= {1, 2, 3}
+    assert sorted(released) == sorted(set(started) - {1})
+
+
+def test_fetch_all_propagates_errors():
+    def fetch(item):
+        if item == 2:
+            raise ValueError('broken source')
+        return item
+
+    with ThreadPoolExecutor(max_workers=2) as executor, pytest.raises(ValueError, match='broken source'):
+        list(fetch_all(executor, [1, 2, 3], fetch))
@@ -0,0 +1,55 @@
+import os
+import re
+import subprocess
+import sys
+
+# Cumulative import time of the handler module, the cold start cost paid before the first request.
+IMPORT_TIME_BUDGET_MS = float(os.getenv('IMPORT_TIME_BUDGET_MS', 250))
+LAZY_MODULES = ('botocore', 'requests', 'urllib3', 'filetype')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_python(code, *options):
+    env = {key: value for key, value in os.environ.items()
+           if key not in ('DERIVATIVE_CACHE_BUCKET', 'SPILLOVER_BUCKET')}
+    return subprocess.run([sys.executable, *options, '-c', code], cwd=ROOT, env=env, capture_output=True, text=True,
+                          check=True)
+
+
+def import_times(stderr):
+    """
+    Parses the output of `python -X importtime` into the cumulative import time of every module, in milliseconds.
+    """
+    times = {}
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)', line)
+        if match:
+            times[match.group(2)] = int(match.group(1)) / 1000
+    return times
+
+
+def test_handler_import_time_budget():
+    # The best of a few runs, to keep a busy machine from failing the test.
+    durations = [import_times(run_python('import imaginex_lambda.handler', '-X', 'importtime').stderr)
+                 ['imaginex_lambda.handler'] for _ in range(3)]
+
+    assert min(durations) < IMPORT_TIME_BUDGET_MS
+
+
+def test_heavy_modules_are_imported_lazily():
+    result = run_python('import sys, imaginex_lambda.handler\n'
+                        f'print(",".join(m for m in {LAZY_MODULES!r} if m in sys.modules))')
+
+    assert result.stdout.strip() == ''
+
+
+def test_clients_are_created_on_first_use():
+    result = run_python('import sys\n'
+                        'from imaginex_lambda.lib import img_lib\n'
+                        'assert "s3_client" not in vars(img_lib)\n'
+                        'client = img_lib.get_s3_client()\n'
+                        'assert img_lib.s3_client is client is img_lib.get_s3_client()\n'
+                        'assert img_lib.http_session is img_lib.get_http_session()\n'
+                        'print("botocore" in sys.modules, "requests" in sys.modules)')
+
+    assert result.stdout.strip() == 'True True'
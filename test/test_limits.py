@@ -0,0 +1,131 @@
+import os
+import subprocess
+import sys
+from io import BytesIO
+from unittest.mock import patch, MagicMock
+
+import pytest
+from PIL import Image
+
+from imaginex_lambda.handler import handler
+from imaginex_lambda.lib.exceptions import HandlerError
+from imaginex_lambda.lib.img_lib import download_and_optimize, download_and_optimize_variants, read_into_memory
+from imaginex_lambda.lib.limits import decode_budget, output_budget
+from test.images import make_image
+
+
+def optimize(source, width=None, height=None):
+    with patch('imaginex_lambda.lib.img_lib.download_image', MagicMock(return_value=(source, {}))):
+        image_data, _, _ = download_and_optimize('https://example.com/a', 70, width, height, '')
+    return Image.open(BytesIO(image_data))
+
+
+def test_known_length_over_budget_is_rejected_upfront():
+    stream = MagicMock()
+
+    with patch('imaginex_lambda.lib.limits.MAX_SOURCE_BYTES', 1000), pytest.raises(HandlerError) as exc:
+        read_into_memory(stream, 1001)
+
+    assert exc.value.code == 413
+    stream.readinto.assert_not_called()
+
+
+def test_unknown_length_over_budget_stops_streaming():
+    stream = BytesIO(b'x' * 10000)
+
+    with patch('imaginex_lambda.lib.limits.MAX_SOURCE_BYTES', 1000), pytest.raises(HandlerError, match='too large'):
+        read_into_memory(stream, None, chunk_size=256)
+
+    assert stream.tell() == 1024
+
+
+def test_decode_budget():
+    with patch('imaginex_lambda.lib.limits.MAX_SOURCE_PIXELS', 1000):
+        assert decode_budget((40, 25), 'PNG') is None
+        assert decode_budget((80, 50), 'JPEG') == (40, 25)
+        assert decode_budget((101, 50), 'JPEG') == (25, 12)
+        with pytest.raises(HandlerError):
+            decode_budget((80, 50), 'PNG')
+        with pytest.raises(HandlerError):
+            decode_budget((1000, 1000), 'JPEG')
+        with patch('imaginex_lambda.lib.limits.BUDGET_MODE', 'reject'), pytest.raises(HandlerError):
+            decode_budget((80, 50), 'JPEG')
+
+
+def test_output_budget():
+    with patch('imaginex_lambda.lib.limits.MAX_OUTPUT_PIXELS', 10000):
+        assert output_budget((100, 100)) == (100, 100)
+        assert output_budget((400, 100)) == (200, 50)
+        with patch('imaginex_lambda.lib.limits.BUDGET_MODE', 'reject'), pytest.raises(HandlerError):
+            output_budget((400, 100))
+
+
+def test_jpeg_over_pixel_budget_is_decoded_reduced():
+    sources = make_image(size=(1600, 1200), noise=True), make_image(size=(1600, 1200), noise=True)
+
+    with patch('imaginex_lambda.lib.limits.MAX_SOURCE_PIXELS', 500_000), \
+            patch.object(Image.Image, 'load', autospec=True, side_effect=Image.Image.load) as load_mock:
+        assert optimize(sources[0], width=1200).size == (800, 600)
+        assert optimize(sources[1], width=400).size == (400, 300)
+
+    # The full 1600x1200 source was never decoded.
+    assert all(call.args[0].size[0] <= 800 for call in load_mock.call_args_list)
+
+
+def test_png_over_pixel_budget_is_rejected():
+    with patch('imaginex_lambda.lib.limits.MAX_SOURCE_PIXELS', 500_000), pytest.raises(HandlerError) as exc:
+        optimize(make_image('PNG', (1600, 1200), noise=True), width=400)
+
+    assert exc.value.code == 413
+
+
+def test_output_over_budget_is_reduced():
+    with patch('imaginex_lambda.lib.limits.MAX_OUTPUT_PIXELS', 120_000):
+        assert optimize(make_image('PNG', (800, 600), noise=True), width=800).size == (400, 300)
+        assert optimize(make_image('PNG', (800, 600), noise=True), width=600).size == (400, 300)
+
+
+def test_variants_respect_budgets():
+    variants = [{'width': w, 'height': None, 'quality': 70, 'format': None} for w in (400, 1200)]
+
+    source = make_image(size=(1600, 1200), noise=True)
+    with patch('imaginex_lambda.lib.img_lib.download_image', MagicMock(return_value=(source, {}))), \
+            patch('imaginex_lambda.lib.limits.MAX_SOURCE_PIXELS', 500_000):
+        results = download_and_optimize_variants('https://example.com/a', variants, '')
+
+    assert [Image.open(BytesIO(r[0])).size for r in results] == [(400, 300), (800, 600)]
+
+
+def test_handler_rejects_over_budget():
+    event = {'queryStringParameters': {'url': 'https://example.com/a.png', 'w': '200'}}
+
+    source = make_image('PNG', (1600, 1200), noise=True)
+    with patch('imaginex_lambda.lib.img_lib.download_image', MagicMock(return_value=(source, {}))), \
+            patch('imaginex_lambda.lib.limits.MAX_SOURCE_PIXELS', 500_000):
+        r = handler(event, None)
+
+    assert r['statusCode'] == 413
+    assert 'too large' in r['body']
+
+
+def test_handler_maps_decompression_bombs():
+    event = {'queryStringParameters': {'url': 'https://example.com/a.png', 'w': '200'}}
+
+    source = make_image('PNG', (1600, 1200), noise=True)
+    with patch('imaginex_lambda.lib.img_lib.download_image', MagicMock(return_value=(source, {}))), \
+            patch.object(Image, 'MAX_IMAGE_PIXELS', 1000):
+        r = handler(event, None)
+
+    assert r['statusCode'] == 413
+
+
+def test_import_leaves_pillow_limit_alone():
+    result = subprocess.run([sys.executable, '-c', 'from PIL import Image\n'
+                                                   'limit = Image.MAX_IMAGE_PIXELS\n'
+                                                   'import imaginex_lambda.handler\n'
+                                                   'print(Image.MAX_IMAGE_PIXELS == limit)'],
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            env={**os.environ, 'BUDGET_MODE': 'reduce', 'MAX_SOURCE_PIXELS': '1000'},
+                            capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == 'True'
@@ -0,0 +1,63 @@
+from io import BytesIO
+from tempfile import TemporaryFile
+from unittest.mock import patch, MagicMock
+
+from PIL import Image
+
+from imaginex_lambda.handler import download_and_optimize
+from imaginex_lambda.lib.lru import LRUCache, create_memory_cache
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(max_bytes=10, ttl=60)
+    cache.put('a', b'aaaa', 4)
+    cache.put('b', b'bbbb', 4)
+    assert cache.get('a') == b'aaaa'
+
+    cache.put('c', b'cccc', 4)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == b'aaaa'
+    assert cache.get('c') == b'cccc'
+    assert cache.size == 8
+
+
+def test_lru_expires_entries():
+    cache = LRUCache(max_bytes=10, ttl=60)
+    with patch('imaginex_lambda.lib.lru.time.monotonic', return_value=100):
+        cache.put('a', b'aaaa', 4)
+    with patch('imaginex_lambda.lib.lru.time.monotonic', return_value=159):
+        assert cache.get('a') == b'aaaa'
+    with patch('imaginex_lambda.lib.lru.time.monotonic', return_value=161):
+        assert cache.get('a') is None
+    assert cache.size == 0
+
+
+def test_lru_skips_oversized_values():
+    cache = LRUCache(max_bytes=10, ttl=60)
+    cache.put('a', b'a' * 11, 11)
+    assert len(cache) == 0
+
+
+def test_create_memory_cache_disabled():
+    assert create_memory_cache(0, 60) is None
+    assert create_memory_cache(1, 60).max_bytes == 1024 * 1024
+
+
+def test_breakpoints_download_source_once():
+    cache = LRUCache(max_bytes=10 * 1024 * 1024, ttl=60)
+    tmp_img = TemporaryFile()
+    Image.new('RGB', (1200, 800), color=(255, 0, 0)).save(tmp_img, format='JPEG')
+    download_image_mock = MagicMock(return_value=(tmp_img, {'etag': '"v1"'}))
+    url = 'https://example.com/hero.jpg'
+
+    with patch('imaginex_lambda.lib.img_lib.download_image', download_image_mock):
+        results = [download_and_optimize(url, 70, w, None, '', memory_cache=cache) for w in (250, 500, 750, 1000)]
+        details = {}
+        repeated = download_and_optimize(url, 70, 500, None, '', details=details, memory_cache=cache)
+    tmp_img.close()
+
+    assert download_image_mock.call_count == 1
+    assert [Image.open(BytesIO(image_data)).width for image_data, _, _ in results] == [250, 500, 750, 1000]
+    assert details['memory_cache'] == 'HIT'
+    assert repeated == results[1]
@@ -0,0 +1,144 @@
+from io import BytesIO
+from unittest.mock import patch
+
+import pytest
+from PIL import Image, ImageCms, TiffImagePlugin
+
+from imaginex_lambda.lib.img_lib import optimize_image, optimize_variants, probe_dimensions, probe_passthrough
+from imaginex_lambda.lib.metadata import ORIENTATION
+
+
+def swapped_profile():
+    """
+    An RGB profile other than sRGB, with the red and blue primaries of sRGB swapped.
+    """
+    data = bytearray(ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes())
+    count = int.from_bytes(data[128:132], 'big')
+    tags = {bytes(data[132 + 12 * i:136 + 12 * i]): 132 + 12 * i for i in range(count)}
+    r, b = tags[b'rXYZ'], tags[b'bXYZ']
+    data[r + 4:r + 12], data[b + 4:b + 12] = data[b + 4:b + 12], data[r + 4:r + 12]
+    return bytes(data).replace('sRGB'.encode('utf-16-be'), 'Test'.encode('utf-16-be'))
+
+
+def make_photo(orientation=6, img_type='JPEG', **options):
+    # Stored sideways, as phones do: the top of the displayed image (blue) is on the left.
+    img = Image.new('RGB', (400, 200), color=(200, 10, 10))
+    img.paste((10, 10, 200), (0, 0, 100, 200))
+    exif = Image.Exif()
+    exif[ORIENTATION] = orientation
+    exif[0x010f] = 'Camera'
+    buffer = BytesIO()
+    img.save(buffer, format=img_type, exif=exif.tobytes(), **options)
+    buffer.seek(0)
+    return buffer
+
+
+def test_rotated_photos_are_sized_as_displayed_and_turned_upright():
+    image_data = optimize_image(make_photo(), ext='JPEG', quality=90, width=100, height=100)
+
+    with Image.open(BytesIO(image_data)) as img:
+        # Portrait as displayed, so sized by its height.
+        assert img.size == (50, 100)
+        assert img.getpixel((25, 5))[2] > 150
+        assert img.getpixel((25, 95))[0] > 150
+        assert 'exif' not in img.info
+        assert 'comment' not in img.info
+
+
+def test_metadata_is_stripped_by_default():
+    image_data = optimize_image(make_photo(orientation=1, comment=b'comment'), ext='WEBP', quality=90, width=100)
+
+    with Image.open(BytesIO(image_data)) as img:
+        assert not set(img.info) & {'exif', 'xmp', 'comment', 'icc_profile'}
+
+
+def test_keep_metadata():
+    with patch('imaginex_lambda.lib.metadata.KEEP_METADATA', True):
+        image_data = optimize_image(make_photo(), ext='JPEG', quality=90, width=100)
+
+    with Image.open(BytesIO(image_data)) as img:
+        exif = img.getexif()
+        assert img.size == (100, 200)
+        # Already turned upright.
+        assert exif[ORIENTATION] == 1
+        assert exif[0x010f] == 'Camera'
+
+
+@pytest.mark.parametrize('width', [200, 100])
+def test_tiff_metadata_tags_are_stripped(width):
+    tags = TiffImagePlugin.ImageFileDirectory_v2()
+    tags[700], tags.tagtype[700] = b'<x:xmpmeta>secret</x:xmpmeta>', 1
+    tags[33723], tags.tagtype[33723] = b'\x1c\x02\x00\x00\x02\x00\x04', 7
+    buffer = BytesIO()
+    Image.new('RGB', (200, 100), color=(255, 0, 0)).save(buffer, format='TIFF', tiffinfo=tags)
+
+    image_data = optimize_image(buffer, ext='TIFF', quality=90, width=width)
+
+    with Image.open(BytesIO(image_data)) as img:
+        assert img.width == width
+        assert not {700, 33723} & set(img.tag_v2)
+
+
+@pytest.mark.parametrize('mode, color, kept', [
+    ('convert', (0, 0, 255), False),
+    ('strip', (255, 0, 0), False),
+    ('keep', (255, 0, 0), True),
+])
+@pytest.mark.parametrize('img_type', ['JPEG', 'WEBP', 'PNG'])
+def test_icc_profiles(img_type, mode, color, kept):
+    buffer = BytesIO()
+    Image.new('RGB', (200, 100), color=(255, 0, 0)).save(buffer, format='PNG', icc_profile=swapped_profile())
+
+    with patch('imaginex_lambda.lib.metadata.ICC_PROFILE', mode):
+        image_data = optimize_image(buffer, ext=img_type, quality=95, width=100)
+
+    with Image.open(BytesIO(image_data)) as img:
+        assert ('icc_profile' in img.info) == kept
+        assert img.convert('RGB').getpixel((50, 25)) == pytest.approx(color, abs=3)
+
+
+@pytest.mark.parametrize('img_type', ['JPEG', 'WEBP', 'PNG'])
+def test_cmyk_profiles_are_converted_for_every_output(img_type):
+    # Pillow cannot create CMYK profiles, so the profile is read as one and its conversion is stubbed.
+    buffer = BytesIO()
+    Image.new('CMYK', (200, 100), color=(0, 255, 255, 0)).save(buffer, format='JPEG',
+                                                               icc_profile=swapped_profile())
+    converted = []
+
+    def profile_to_profile(img, *args, **kwargs):
+        converted.append((img.mode, kwargs['outputMode']))
+        return Image.new(kwargs['outputMode'], img.size, color=(0, 0, 255))
+
+    with patch('imaginex_lambda.lib.metadata.profile_info', return_value=('CMYK', False)), \
+            patch('PIL.ImageCms.profileToProfile', side_effect=profile_to_profile):
+        image_data = optimize_image(buffer, ext=img_type, quality=95, width=100)
+
+    assert converted == [('CMYK', 'RGB')]
+    with Image.open(BytesIO(image_data)) as img:
+        assert 'icc_profile' not in img.info
+        assert img.convert('RGB').getpixel((50, 25)) == pytest.approx((0, 0, 255), abs=3)
+
+
+def test_probe_respects_orientation_and_metadata():
+    data = make_photo().getvalue()
+
+    assert probe_dimensions(data) == (200, 400)
+    assert probe_passthrough(data, 1000, None, (), None) is None
+
+    buffer = BytesIO()
+    Image.new('RGB', (400, 200)).save(buffer, format='JPEG')
+    assert probe_passthrough(buffer.getvalue(), 1000, None, (), None) == 'image/jpeg'
+
+
+def test_variants_of_rotated_photos():
+    variants = [{'width': 100, 'height': None, 'quality': 80},
+                {'width': 50, 'height': 50, 'quality': 80, 'fit': 'cover'}]
+
+    results = optimize_variants(make_photo(), variants, ())
+
+    sizes = []
+    for image_data, _, _ in results:
+        with Image.open(BytesIO(image_data)) as img:
+            assert 'exif' not in img.info
+            sizes.append(img.size)
+    assert sizes == [(100, 200), (50, 50)]
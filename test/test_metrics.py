@@ -0,0 +1,90 @@
+import json
+from unittest.mock import patch, MagicMock
+
+from imaginex_lambda.handler import handler
+from imaginex_lambda.lib.metrics import NULL_STAGE, StageRecorder, metric, record_stages, stage
+from test.images import make_image
+
+
+def emf_lines(output):
+    return [json.loads(line) for line in output.splitlines() if line.startswith('{"_aws"')]
+
+
+def test_stage_is_noop_when_disabled():
+    with record_stages(False) as recorder:
+        with stage('decode', bytes_in=10) as s:
+            s.bytes_out = 20
+
+    assert recorder is None
+    assert s is NULL_STAGE
+    assert s.bytes_out is None
+    assert stage('decode') is NULL_STAGE
+
+
+def test_recorder_collects_stages():
+    with record_stages(True) as recorder:
+        with stage('fetch') as s:
+            s.bytes_out = 100
+        with stage('fetch'):
+            pass
+        metric('BytesIn', 100, 'Bytes')
+
+    assert stage('fetch') is NULL_STAGE
+    assert [(s['name'], s['bytes_out']) for s in recorder.stages] == [('fetch', 100), ('fetch', None)]
+    assert recorder.server_timing().startswith('fetch;dur=')
+    assert recorder.server_timing().count('fetch;dur=') == 2
+
+    emf = recorder.emf('Test', {'content_type': 'image/webp', 'status': 200})
+    metrics = {m['Name']: m['Unit'] for m in emf['_aws']['CloudWatchMetrics'][0]['Metrics']}
+    assert emf['_aws']['CloudWatchMetrics'][0]['Namespace'] == 'Test'
+    assert metrics['fetchTime'] == 'Milliseconds'
+    assert metrics['BytesIn'] == 'Bytes'
+    assert metrics['TotalTime'] == 'Milliseconds'
+    assert emf['ContentType'] == 'image/webp'
+    assert emf['status'] == 200
+    assert emf['BytesIn'] == 100
+    assert emf['fetchTime'] == round(recorder.stages[0]['duration'], 3) + round(recorder.stages[1]['duration'], 3)
+
+
+def test_handler_server_timing_and_emf(capsys):
+    source = make_image(noise=True)
+    event = {'queryStringParameters': {'url': 'https://example.com/a.jpg', 'w': '200', 'q': '70'}}
+
+    with patch('imaginex_lambda.lib.img_lib.download_image', MagicMock(return_value=(source, {}))), \
+            patch('imaginex_lambda.handler.METRICS_ENABLED', True):
+        r = handler(event, None)
+
+    timing = [entry.split(';')[0] for entry in r['headers']['Server-Timing'].split(', ')]
+    assert timing == ['fetch', 'sniff', 'decode', 'resize', 'encode', 'base64', 'total']
+
+    [emf] = emf_lines(capsys.readouterr().out)
+    assert emf['ContentType'] == 'image/jpeg'
+    assert emf['status'] == 200
+    assert emf['url'] == 'https://example.com/a.jpg'
+    assert emf['BytesIn'] == len(source.getvalue())
+    assert emf['BytesOut'] < emf['BytesIn']
+    assert emf['PeakMemory'] > 0
+    assert {s['name']: s['bytes_out'] for s in emf['stages']}['resize'] == 200 * 150 * 3
+
+
+def test_handler_metrics_disabled(capsys):
+    event = {'queryStringParameters': {'url': 'https://example.com/a.jpg', 'w': '200'}}
+
+    with patch('imaginex_lambda.lib.img_lib.download_image', MagicMock(return_value=(make_image(noise=True), {}))), \
+            patch('imaginex_lambda.handler.METRICS_ENABLED', False), \
+            patch.object(StageRecorder, 'add') as add_mock:
+        r = handler(event, None)
+
+    assert r['statusCode'] == 200
+    assert 'Server-Timing' not in r['headers']
+    assert emf_lines(capsys.readouterr().out) == []
+    add_mock.assert_not_called()
+
+
+def test_handler_emits_metrics_for_errors(capsys):
+    with patch('imaginex_lambda.handler.METRICS_ENABLED', True):
+        r = handler({'queryStringParameters': {'url': '', 'w': '200'}}, None)
+
+    assert r['statusCode'] == 422
+    assert r['headers']['Server-Timing'].startswith('total;dur=')
+    assert emf_lines(capsys.readouterr().out)[0]['status'] == 422
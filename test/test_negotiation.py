@@ -0,0 +1,90 @@
+import base64
+from io import BytesIO
+from unittest.mock import patch, MagicMock
+
+import pytest
+from PIL import Image
+
+from imaginex_lambda.handler import handler
+from imaginex_lambda.lib.exceptions import HandlerError
+from imaginex_lambda.lib.img_lib import optimize_image
+from imaginex_lambda.lib.utils import accepted_formats, negotiate_format, get_header
+from test.images import make_image
+
+CHROME_ACCEPT = 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8'
+
+
+@pytest.mark.parametrize('accept,expected', [
+    (None, ()),
+    ('', ()),
+    ('image/png,image/*;q=0.8', ()),
+    ('image/webp,*/*', ('webp',)),
+    ('image/WebP;q=0.5, */*', ('webp',)),
+    ('image/webp;q=0,*/*', ()),
+])
+def test_accepted_formats(accept, expected):
+    with patch('imaginex_lambda.lib.utils.is_avif_supported', return_value=False):
+        assert accepted_formats(accept) == expected
+
+
+def test_accepted_formats_avif_when_supported():
+    with patch('imaginex_lambda.lib.utils.is_avif_supported', return_value=True):
+        assert accepted_formats(CHROME_ACCEPT) == ('avif', 'webp')
+    with patch('imaginex_lambda.lib.utils.is_avif_supported', return_value=False):
+        assert accepted_formats(CHROME_ACCEPT) == ('webp',)
+
+
+@pytest.mark.parametrize('extension,content_type,formats,requested,expected', [
+    ('JPEG', 'image/jpeg', ('webp',), None, ('WEBP', 'image/webp')),
+    ('PNG', 'image/png', (), None, ('PNG', 'image/png')),
+    ('GIF', 'image/gif', ('webp',), None, ('GIF', 'image/gif')),
+    ('ICO', 'image/x-icon', ('webp',), None, ('ICO', 'image/x-icon')),
+    ('GIF', 'image/gif', ('webp',), 'PNG', ('PNG', 'image/png')),
+    ('PNG', 'image/png', ('webp',), 'jpg', ('JPEG', 'image/jpeg')),
+])
+def test_negotiate_format(extension, content_type, formats, requested, expected):
+    assert negotiate_format(extension, content_type, formats, requested) == expected
+
+
+def test_negotiate_format_unsupported():
+    with pytest.raises(HandlerError):
+        negotiate_format('PNG', 'image/png', (), 'svg')
+
+
+def test_get_header_ignores_case():
+    assert get_header({'headers': {'Accept': 'image/webp'}}, 'accept') == 'image/webp'
+    assert get_header({'headers': None}, 'accept') is None
+    assert get_header({}, 'accept') is None
+
+
+@pytest.mark.parametrize('accept,f,expected_type', [
+    ('image/webp,*/*', None, 'image/webp'),
+    ('*/*', None, 'image/jpeg'),
+    ('image/webp,*/*', 'png', 'image/png'),
+])
+def test_handler_negotiates_format(accept, f, expected_type):
+    source = make_image(noise=True, blur=2)
+    qs = {'url': 'https://example.com/a.jpg', 'w': '200'}
+    if f:
+        qs['f'] = f
+
+    with patch('imaginex_lambda.lib.img_lib.download_image', MagicMock(return_value=(source, {}))):
+        r = handler({'queryStringParameters': qs, 'headers': {'Accept': accept}}, None)
+
+    assert r['statusCode'] == 200
+    assert r['headers']['Content-Type'] == expected_type
+    assert r['headers']['Vary'] == 'Accept'
+    img = Image.open(BytesIO(base64.b64decode(r['body'])))
+    assert img.get_format_mimetype() == expected_type
+    assert img.width == 200
+
+
+def test_webp_output_smaller_than_jpeg():
+    source = make_image('PNG', (1600, 1200), noise=True, blur=2)
+
+    sizes = {}
+    for ext in ('JPEG', 'WEBP'):
+        source.seek(0)
+        sizes[ext] = len(optimize_image(source, ext=ext, quality=70, width=800))
+
+    assert sizes['WEBP'] < sizes['JPEG']
@@ -0,0 +1,191 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+from datetime import datetime, timezone
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from unittest.mock import patch
+
+import pytest
+from PIL import Image
+
+from imaginex_lambda.lib.cache import LocalDerivativeStore
+from imaginex_lambda.lib.img_lib import download_and_optimize
+from imaginex_lambda.prewarm import build_variants, list_prefix, main, prewarm, read_manifest
+from test.images import make_image
+
+ACCEPTS = ['image/webp,*/*', '']
+VARIANTS = build_variants([100, 200], [75], [None])
+
+
+class FakeS3:
+    """
+    A local S3 stand-in, with just the calls the prewarm makes.
+    """
+
+    class NoSuchKey(Exception):
+        pass
+
+    def __init__(self, objects):
+        self.objects = {}
+        self.calls = []
+        self.exceptions = self
+        for key, data in objects.items():
+            self.upload(key, data)
+
+    def upload(self, key, data, etag=None):
+        self.objects[key] = {'data': data, 'etag': etag or f'"{key}-{len(data)}"',
+                             'modified': datetime(2024, 1, 1, tzinfo=timezone.utc)}
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        # Two pages, to cover pagination.
+        for page in (keys[:1], keys[1:]):
+            yield {'Contents': [{'Key': key, 'ETag': self.objects[key]['etag'],
+                                 'LastModified': self.objects[key]['modified']} for key in page]}
+
+    def get_object(self, Bucket, Key):
+        self.calls.append(('get_object', Key))
+        obj = self.objects[Key]
+        return {'Body': BytesIO(obj['data']), 'ContentType': 'image/jpeg', 'ContentLength': len(obj['data']),
+                'ETag': obj['etag'], 'LastModified': obj['modified']}
+
+
+@pytest.fixture
+def s3():
+    s3 = FakeS3({'images/a.jpg': make_image(size=(400, 300), color=(200, 10, 10)).getvalue(),
+                 'images/b.jpg': make_image(size=(400, 300), color=(10, 200, 10)).getvalue(),
+                 'images/folder/': b'', 'other/c.jpg': make_image(size=(400, 300), color=(10, 10, 200)).getvalue()})
+    with patch('imaginex_lambda.lib.img_lib.s3_client', s3):
+        yield s3
+
+
+def run(s3, tmp_path, **kwargs):
+    return prewarm(list_prefix(s3, 'bucket', 'images/', '/{key}'), VARIANTS, ACCEPTS, 'bucket',
+                   cache_dir=str(tmp_path / 'store'), **kwargs)
+
+
+def test_prewarms_every_variant_of_a_prefix(s3, tmp_path):
+    report = run(s3, tmp_path)
+
+    assert report['sources'] == report['processed'] == 2
+    assert report['written'] == 2 * len(VARIANTS) * len(ACCEPTS)
+    assert report['bytes_in'] == len(s3.objects['images/a.jpg']['data']) + len(s3.objects['images/b.jpg']['data'])
+    assert report['errors'] == 0
+    assert report['images_per_sec'] > 0 and report['mb_per_sec'] > 0
+    # Every source is downloaded once, whatever the number of variants.
+    assert sorted(s3.calls) == [('get_object', 'images/a.jpg'), ('get_object', 'images/b.jpg')]
+
+    # Requests for a prewarmed variant are derivative cache hits.
+    store = LocalDerivativeStore(str(tmp_path / 'store'))
+    details = {}
+    source = {'etag': s3.objects['images/b.jpg']['etag'], 'last_modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}
+    with patch('imaginex_lambda.lib.img_lib.head_source', return_value=source):
+        image_data, content_type, _ = download_and_optimize('/images/b.jpg', 75, 200, None, 'bucket', store=store,
+                                                            details=details, accept='image/webp,*/*')
+    assert details['cache'] == 'HIT'
+    assert content_type == 'image/webp'
+    assert Image.open(BytesIO(image_data)).size == (200, 150)
+
+
+def test_skips_up_to_date_variants(s3, tmp_path):
+    run(s3, tmp_path)
+    s3.calls.clear()
+
+    report = run(s3, tmp_path)
+
+    assert report['up_to_date'] == 2
+    assert report['written'] == 0
+    assert report['skipped'] == 2 * len(VARIANTS) * len(ACCEPTS)
+    assert s3.calls == []
+
+    # A new version of a source gets new derivatives.
+    s3.upload('images/a.jpg', make_image(size=(400, 300), color=(0, 0, 0)).getvalue(), etag='"v2"')
+    report = run(s3, tmp_path)
+    assert report['processed'] == 1
+    assert s3.calls == [('get_object', 'images/a.jpg')]
+
+
+def test_resumes_from_the_state_file(s3, tmp_path):
+    state = str(tmp_path / 'state')
+    # Written by another configuration, then cut off by an interruption.
+    with open(state, 'w') as fout:
+        fout.write('{"url": "/images/a.jpg", "etag": "x"}\n{"url": "/images/b.jpg"')
+
+    report = run(s3, tmp_path, state_path=state)
+    assert report['processed'] == 2
+
+    with patch('imaginex_lambda.prewarm.missing_variants') as missing_mock:
+        report = run(s3, tmp_path, state_path=state)
+
+    # Completed sources are skipped without even checking the store.
+    missing_mock.assert_not_called()
+    assert report['up_to_date'] == 2
+    with open(state) as fin:
+        assert [json.loads(line)['url'] for line in fin.readlines()[2:]] == ['/images/a.jpg', '/images/b.jpg']
+
+
+def test_failures_are_reported(s3, tmp_path):
+    s3.upload('images/broken.jpg', b'not an image')
+
+    report = run(s3, tmp_path, state_path=str(tmp_path / 'state'))
+
+    assert report['errors'] == 1
+    assert report['processed'] == 2
+    with open(tmp_path / 'state') as fin:
+        assert '/images/broken.jpg' not in fin.read()
+
+
+def test_manifest_on_worker_processes(tmp_path, capsys):
+    sources = tmp_path / 'sources'
+    sources.mkdir()
+    for name, color in (('a.jpg', (200, 10, 10)), ('b.png', (10, 200, 10))):
+        img_type = 'PNG' if name.endswith('png') else 'JPEG'
+        (sources / name).write_bytes(make_image(img_type, (400, 300), color).getvalue())
+
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=str(sources)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+    manifest = tmp_path / 'manifest.txt'
+    manifest.write_text(f'# sources\n{base}/a.jpg\n\n{base}/b.png\n')
+    try:
+        assert [task['url'] for task in read_manifest(str(manifest))] == [f'{base}/a.jpg', f'{base}/b.png']
+
+        args = ['--manifest', str(manifest), '--cache-dir', str(tmp_path / 'store'), '--widths', '100,200',
+                '--accept', 'image/webp,*/*', '--workers', '2', '--state', str(tmp_path / 'state')]
+        assert main(args) == 0
+        assert json.loads(capsys.readouterr().out)['written'] == 4
+        assert len([name for name in os.listdir(tmp_path / 'store') if name.endswith('.json')]) == 4
+
+        # Resumed from the state file, after checking the sources are unchanged (by Last-Modified, without ETags).
+        assert main(args) == 0
+        report = json.loads(capsys.readouterr().out)
+        assert report['up_to_date'] == 2
+        assert report['skipped'] == 4
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_import_creates_no_clients():
+    # Worker processes would inherit clients created on import.
+    env = {**os.environ, 'DERIVATIVE_CACHE_BUCKET': 'derivatives'}
+    result = subprocess.run([sys.executable, '-c', 'import sys, imaginex_lambda.prewarm\n'
+                                                   'from imaginex_lambda.lib import img_lib\n'
+                                                   'print("imaginex_lambda.handler" in sys.modules, '
+                                                   '"s3_client" in vars(img_lib))'],
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env=env,
+                            capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == 'False False'
@@ -0,0 +1,182 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from unittest.mock import patch
+
+import pytest
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+from PIL import Image
+
+from imaginex_lambda.handler import handler
+from imaginex_lambda.lib.exceptions import HandlerError
+from imaginex_lambda.lib.fetch import create_s3_client
+from imaginex_lambda.lib.img_lib import download_and_optimize, probe_source, probe_dimensions
+from test.images import make_image
+
+
+def make_animation_bytes(size=(60, 40), frames=3):
+    images = [Image.new('RGB', size, color=(i * 80, 0, 0)) for i in range(frames)]
+    buffer = BytesIO()
+    images[0].save(buffer, format='GIF', save_all=True, append_images=images[1:], duration=100)
+    return buffer.getvalue()
+
+
+FILES = {
+    '/animated.gif': make_animation_bytes(),
+    '/large.png': make_image('PNG', (600, 400), noise=True).getvalue(),
+    '/small.png': make_image('PNG', (60, 40), noise=True).getvalue(),
+    '/text.txt': b'hello world' * 1000,
+}
+
+
+@pytest.fixture(scope='module')
+def image_server():
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            data = FILES[self.path.split('?')[0]]
+            byte_range = self.headers.get('Range')
+            requests.append((self.path, byte_range))
+            if byte_range and 'no-range' not in self.path:
+                end = min(int(byte_range.split('-')[1]), len(data) - 1)
+                body = data[:end + 1]
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes 0-{end}/{len(data)}')
+            else:
+                body = data
+                self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}', requests
+    server.shutdown()
+
+
+def test_probe_source_partial(image_server):
+    base_url, _ = image_server
+
+    probe = probe_source(f'{base_url}/large.png', '', 1024)
+
+    assert len(probe['data']) == 1024
+    assert probe['complete'] is False
+    assert probe['content_size'] == len(FILES['/large.png'])
+    assert probe['etag'] == '"v1"'
+    assert probe_dimensions(probe['data']) == (600, 400)
+
+
+def test_probe_source_without_range_support(image_server):
+    base_url, _ = image_server
+
+    probe = probe_source(f'{base_url}/large.png?no-range', '', 1024)
+
+    assert probe['data'] == FILES['/large.png']
+    assert probe['complete'] is True
+
+
+def test_probe_source_without_range_support_respects_source_budget(image_server):
+    base_url, _ = image_server
+
+    with patch('imaginex_lambda.lib.limits.MAX_SOURCE_BYTES', 1000), pytest.raises(HandlerError) as exc:
+        probe_source(f'{base_url}/large.png?no-range', '', 1024)
+
+    assert exc.value.code == 413
+
+
+def test_probe_dimensions_truncated_header():
+    assert probe_dimensions(make_image(noise=True).getvalue()[:10]) is None
+
+
+def test_probe_rejects_unsupported_format(image_server):
+    base_url, requests = image_server
+    requests.clear()
+
+    with pytest.raises(HandlerError, match='Unsupported image format'):
+        download_and_optimize(f'{base_url}/text.txt', 70, 100, None, '', probe_size=1024)
+
+    assert requests == [('/text.txt', 'bytes=0-1023')]
+
+
+def test_probe_passes_small_images_through(image_server):
+    base_url, requests = image_server
+    requests.clear()
+
+    image_data, content_type, ratio = download_and_optimize(f'{base_url}/small.png', 70, 100, None, '',
+                                                            probe_size=1024)
+
+    assert image_data == FILES['/small.png']
+    assert content_type == 'image/png'
+    assert ratio == 1
+    assert requests == [('/small.png', 'bytes=0-1023'), ('/small.png', None)]
+
+
+@pytest.mark.parametrize('accept, content_type', [('image/webp,*/*', 'image/webp'), ('image/png,*/*', 'image/gif')])
+def test_probe_negotiates_animations_like_full_fetches(image_server, accept, content_type):
+    base_url, _ = image_server
+
+    for probe_size in (0, 64):
+        _, output_type, _ = download_and_optimize(f'{base_url}/animated.gif', 70, 100, None, '', accept=accept,
+                                                  probe_size=probe_size)
+        assert output_type == content_type
+
+
+def test_probe_reuses_complete_probe(image_server):
+    base_url, requests = image_server
+    requests.clear()
+
+    image_data, _, _ = download_and_optimize(f'{base_url}/large.png', 70, 100, None, '', probe_size=1024 * 1024)
+
+    assert Image.open(BytesIO(image_data)).size == (100, 66)
+    assert requests == [('/large.png', 'bytes=0-1048575')]
+
+
+def test_probe_continues_with_full_fetch(image_server):
+    base_url, requests = image_server
+    requests.clear()
+
+    image_data, _, _ = download_and_optimize(f'{base_url}/large.png', 70, 100, None, '', probe_size=1024)
+
+    assert Image.open(BytesIO(image_data)).size == (100, 66)
+    assert requests == [('/large.png', 'bytes=0-1023'), ('/large.png', None)]
+
+
+def test_probe_s3_range():
+    data = FILES['/large.png']
+    client = create_s3_client()
+    stubber = Stubber(client)
+    stubber.add_response('get_object', {
+        'Body': StreamingBody(BytesIO(data[:1024]), 1024),
+        'ContentType': 'image/png',
+        'ContentRange': f'bytes 0-1023/{len(data)}',
+        'ETag': '"v1"',
+    }, {'Bucket': 'bucket', 'Key': 'large.png', 'Range': 'bytes=0-1023'})
+
+    with stubber, patch('imaginex_lambda.lib.img_lib.s3_client', client):
+        probe = probe_source('large.png', 'bucket', 1024)
+
+    assert probe['complete'] is False
+    assert probe['content_size'] == len(data)
+    assert probe_dimensions(probe['data']) == (600, 400)
+
+
+def test_handler_info_mode(image_server):
+    base_url, requests = image_server
+    requests.clear()
+
+    r = handler({'queryStringParameters': {'url': f'{base_url}/large.png', 'info': '1'}}, None)
+
+    assert r['statusCode'] == 200
+    assert r['headers']['Content-Type'] == 'application/json'
+    assert json.loads(r['body']) == {'format': 'PNG', 'content_type': 'image/png', 'width': 600, 'height': 400,
+                                     'size': len(FILES['/large.png'])}
+    assert len(requests) == 1
@@ -0,0 +1,113 @@
+import base64
+import math
+from io import BytesIO
+from unittest.mock import patch, MagicMock
+
+import pytest
+from PIL import Image, ImageFilter
+
+from imaginex_lambda.handler import handler, parse_variants
+from imaginex_lambda.lib.img_lib import encode_image, transform_params
+from imaginex_lambda.lib.quality import Luminance, search_quality, ssim, AUTO_QUALITY_MAX, AUTO_QUALITY_MIN, \
+    AUTO_QUALITY_STEP
+from test.images import make_image
+
+
+def photo_like(size=(400, 300)):
+    return Image.effect_noise(size, 64).convert('RGB').filter(ImageFilter.GaussianBlur(2))
+
+
+def counting_encoder():
+    calls = []
+
+    def encode(img, ext, quality):
+        calls.append(quality)
+        return encode_image(img, ext, quality)
+
+    return encode, calls
+
+
+def test_ssim():
+    img = photo_like()
+    reference = Luminance(img)
+
+    assert len(reference.windows) <= 1024
+    assert ssim(reference, img) == 1.0
+    with Image.open(BytesIO(encode_image(img, 'JPEG', 90))) as good, \
+            Image.open(BytesIO(encode_image(img, 'JPEG', 5))) as bad:
+        assert 1.0 > ssim(reference, good) > ssim(reference, bad)
+
+
+def test_auto_quality_search_is_bounded():
+    encode, calls = counting_encoder()
+
+    _, quality = search_quality(photo_like(), 'JPEG', encode)
+
+    candidates = len(range(AUTO_QUALITY_MIN, AUTO_QUALITY_MAX, AUTO_QUALITY_STEP)) + 1
+    assert AUTO_QUALITY_MIN <= quality <= AUTO_QUALITY_MAX
+    assert len(calls) == len(set(calls)) <= math.ceil(math.log2(candidates)) + 1
+    # The result is one of the encodes of the search, not encoded again.
+    assert quality in calls
+
+
+def test_auto_quality_meets_the_target():
+    img = photo_like()
+    reference = Luminance(img)
+
+    with patch('imaginex_lambda.lib.quality.AUTO_QUALITY_SSIM', 0.99):
+        strict, strict_quality = search_quality(img, 'JPEG', encode_image)
+    with patch('imaginex_lambda.lib.quality.AUTO_QUALITY_SSIM', 0.9):
+        loose, loose_quality = search_quality(img, 'JPEG', encode_image)
+
+    assert strict_quality > loose_quality
+    assert len(strict) > len(loose)
+    with Image.open(BytesIO(loose)) as decoded:
+        assert ssim(reference, decoded) >= 0.9
+
+
+def test_max_bytes_picks_the_highest_quality_that_fits():
+    img = photo_like()
+    max_bytes = len(encode_image(img, 'JPEG', 60)) + 1
+
+    image_data, quality = search_quality(img, 'JPEG', encode_image, 80, max_bytes)
+
+    assert quality == 60
+    assert len(image_data) <= max_bytes
+    # Nothing fits, the smallest encode is returned anyway.
+    image_data, quality = search_quality(img, 'JPEG', encode_image, 80, 10)
+    assert quality == AUTO_QUALITY_MIN
+
+
+@pytest.mark.parametrize('img_type', ['PNG', 'JPEG2000'])
+def test_formats_without_quality_are_encoded_once(img_type):
+    encode, calls = counting_encoder()
+
+    search_quality(photo_like(), img_type, encode, None, 1000)
+
+    assert calls == [AUTO_QUALITY_MAX]
+
+
+def test_parse_quality():
+    variants = parse_variants({}, {'w': '640,750', 'q': 'auto', 'maxbytes': '5000'})
+
+    assert [(v['quality'], v['max_bytes']) for v in variants] == [(None, 5000), (None, 5000)]
+    assert transform_params('a', None, 10, None, (), None)['quality'] == 'auto'
+    assert 'max_bytes' not in transform_params('a', 70, 10, None, (), None)
+    assert transform_params('a', 70, 10, None, (), None, 5000)['max_bytes'] == 5000
+
+
+def test_handler_auto_quality_and_max_bytes():
+    def run(**params):
+        source = make_image(noise=True, blur=2, quality=95)
+        with patch('imaginex_lambda.lib.img_lib.download_image', MagicMock(return_value=(source, {}))):
+            return handler({'queryStringParameters': {'url': 'https://example.com/a.jpg', 'w': '400', **params}},
+                           None)
+
+    fixed = run(q='90')
+    auto = run(q='auto')
+    limited = run(q='90', maxbytes='10000')
+
+    assert auto['statusCode'] == limited['statusCode'] == 200
+    assert len(base64.b64decode(auto['body'])) < len(base64.b64decode(fixed['body']))
+    assert len(base64.b64decode(limited['body'])) <= 10000
+    assert run(maxbytes='0')['statusCode'] == 422
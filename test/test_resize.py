@@ -0,0 +1,137 @@
+from io import BytesIO
+
+from unittest.mock import patch
+
+import pytest
+from PIL import Image
+
+from imaginex_lambda.handler import handler
+from imaginex_lambda.lib.img_lib import optimize_image, optimize_variants, reduce_on_load
+from imaginex_lambda.lib.resize import crop_box, fit_size, reduction_size, working_mode
+from test.images import make_image
+
+
+def test_reduce_on_load_drafts_jpeg():
+    img = Image.open(make_image('JPEG', (4000, 2000)))
+
+    reduced = reduce_on_load(img, (250, 125))
+
+    assert reduced is img
+    assert img.size == (500, 250)
+
+
+@pytest.mark.parametrize('img_type', ['PNG', 'WEBP', 'TIFF'])
+def test_reduce_on_load_reduces_other_formats(img_type):
+    img = Image.open(make_image(img_type, (1000, 600)))
+
+    reduced = reduce_on_load(img, (240, 144))
+
+    assert reduced.size == (250, 150)
+
+
+def test_reduce_on_load_keeps_palette_images():
+    # A single color or a gray palette would be opened as L by some Pillow versions.
+    gradient = Image.linear_gradient('L').resize((1000, 600))
+    mirrored = gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    colors = Image.merge('RGB', (gradient, mirrored, Image.new('L', gradient.size)))
+    buffer = BytesIO()
+    colors.quantize(64).save(buffer, format='GIF')
+    img = Image.open(buffer)
+
+    assert img.mode == 'P'
+    assert reduce_on_load(img, (100, 60)) is img
+
+
+@pytest.mark.parametrize('img_type', ['JPEG', 'PNG', 'WEBP', 'GIF'])
+def test_optimize_image_exact_size_after_reduction(img_type):
+    image_data = optimize_image(make_image(img_type, (3000, 2000)), ext=img_type, quality=70, width=250)
+
+    assert Image.open(BytesIO(image_data)).size == (250, 166)
+
+
+@pytest.mark.parametrize('size, fit, expected', [
+    ((1000, 500), None, (400, 200)),
+    ((1000, 900), 'contain', (333, 300)),
+    ((1000, 500), 'cover', (400, 300)),
+    ((1000, 500), 'fill', (400, 300)),
+    # Never upscaled, cover keeps the requested aspect ratio.
+    ((200, 100), 'contain', None),
+    ((200, 100), 'cover', (133, 100)),
+    ((200, 100), 'fill', None),
+    ((200, 400), 'fill', (200, 300)),
+])
+def test_fit_size(size, fit, expected):
+    assert fit_size(size, 400, 300, fit) == expected
+
+
+def test_crop_box_and_reduction_size():
+    assert crop_box((1000, 500), (400, 300), 'cover') == pytest.approx((166.67, 0, 833.33, 500), abs=0.01)
+    assert crop_box((1000, 500), (400, 200), 'cover') is None
+    assert crop_box((1000, 500), (400, 300), 'fill') is None
+
+    # Cover reduces the whole image only as far as the cropped region allows.
+    assert reduction_size((4000, 2000), (400, 300), 'cover') == (600, 300)
+    with patch('imaginex_lambda.lib.resize.RESIZE_REDUCING_GAP', 2.0):
+        assert reduction_size((4000, 2000), (400, 200)) == (800, 400)
+    with patch('imaginex_lambda.lib.resize.RESIZE_REDUCING_GAP', 0):
+        assert reduction_size((4000, 2000), (400, 200)) == (4000, 2000)
+
+
+def test_cover_crops_the_center():
+    img = Image.new('RGB', (900, 300), color=(255, 0, 0))
+    img.paste((0, 0, 255), (300, 0, 600, 300))
+    buffer = BytesIO()
+    img.save(buffer, format='PNG')
+
+    image_data = optimize_image(buffer, ext='PNG', quality=70, width=100, height=100, fit='cover')
+
+    with Image.open(BytesIO(image_data)) as result:
+        assert result.size == (100, 100)
+        # Only the blue center is left.
+        assert result.convert('RGB').getpixel((5, 50)) == (0, 0, 255)
+
+
+@pytest.mark.parametrize('mode, ext, expected', [
+    ('RGBA', 'JPEG', 'RGB'),
+    ('LA', 'JPEG', 'L'),
+    ('P', 'PNG', 'RGB'),
+    ('P', 'GIF', None),
+    ('CMYK', 'WEBP', 'RGB'),
+    ('CMYK', 'JPEG', None),
+    ('RGB', 'PNG', None),
+])
+def test_working_mode(mode, ext, expected):
+    assert working_mode(Image.new(mode, (10, 10)), [ext]) == expected
+
+
+def test_palette_png_is_resampled_in_color_and_quantized_back():
+    img = Image.linear_gradient('L').resize((1000, 600)).convert('RGB').quantize(32)
+    buffer = BytesIO()
+    img.save(buffer, format='PNG')
+
+    image_data = optimize_image(buffer, ext='PNG', quality=70, width=100)
+
+    with Image.open(BytesIO(image_data)) as result:
+        assert result.mode == 'P'
+        assert result.size == (100, 60)
+
+
+def test_variants_with_fit_modes():
+    buffer = make_image('JPEG', (1200, 600))
+    variants = [{'width': 400, 'height': None, 'quality': 70},
+                {'width': 300, 'height': 300, 'quality': 70, 'fit': 'cover'},
+                {'width': 200, 'height': 50, 'quality': 70, 'fit': 'fill'},
+                {'width': 200, 'height': 200, 'quality': 70, 'fit': 'contain'}]
+
+    results = optimize_variants(buffer, variants, ())
+
+    assert [Image.open(BytesIO(image_data)).size for image_data, _, _ in results] == \
+        [(400, 200), (300, 300), (200, 50), (200, 100)]
+
+
+def test_handler_rejects_unknown_fit():
+    event = {'queryStringParameters': {'url': 'https://example.com/a.jpg', 'w': '100', 'h': '100', 'fit': 'crop'}}
+
+    response = handler(event, None)
+
+    assert response['statusCode'] == 422
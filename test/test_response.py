@@ -0,0 +1,148 @@
+import base64
+import json
+from unittest.mock import patch, ANY
+
+import botocore.session
+from botocore.stub import Stubber
+
+from imaginex_lambda.handler import handler
+from imaginex_lambda.lib.spillover import base64_size, spill_to_s3
+from imaginex_lambda.lib.utils import success
+from test.images import make_image
+
+IMAGE_DATA = make_image(size=(1200, 800), noise=True, quality=95).getvalue()
+
+
+def create_client():
+    # Presigning needs credentials, but never talks to AWS.
+    return botocore.session.get_session().create_client('s3', region_name='us-east-1', aws_access_key_id='key',
+                                                        aws_secret_access_key='secret')
+
+
+def test_base64_size():
+    for size in range(0, 20):
+        assert base64_size(size) == len(base64.b64encode(b'\0' * size))
+
+
+def test_binary_response_size():
+    encoded = success(IMAGE_DATA, {})
+    raw = success(IMAGE_DATA, {}, binary=True)
+
+    assert raw['isBase64Encoded'] is False
+    assert raw['body'] is IMAGE_DATA
+    assert len(encoded['body']) == base64_size(len(IMAGE_DATA)) > len(IMAGE_DATA) * 4 / 3 - 1
+
+
+def test_spill_to_s3_presigned():
+    client = create_client()
+    stubber = Stubber(client)
+    stubber.add_client_error('head_object', '404', http_status_code=404)
+    stubber.add_response('put_object', {}, {'Bucket': 'bucket', 'Key': ANY, 'Body': IMAGE_DATA,
+                                            'ContentType': 'image/jpeg'})
+
+    with stubber:
+        location = spill_to_s3(IMAGE_DATA, 'image/jpeg', client, 'bucket', 'spillover/', expires=60)
+
+    assert location.startswith('https://bucket.s3.amazonaws.com/spillover/')
+    assert 'Expires=' in location or 'X-Amz-Expires=60' in location
+    stubber.assert_no_pending_responses()
+
+
+def test_spill_to_s3_public_url():
+    client = create_client()
+    stubber = Stubber(client)
+    stubber.add_client_error('head_object', '404', http_status_code=404)
+    stubber.add_response('put_object', {}, None)
+
+    with stubber:
+        location = spill_to_s3(IMAGE_DATA, 'image/jpeg', client, 'bucket', 'spillover/', public_url='https://cdn/')
+
+    assert location.startswith('https://cdn/spillover/')
+    assert '?' not in location
+
+
+def test_spill_to_s3_reuses_spilled_images():
+    client = create_client()
+    stubber = Stubber(client)
+    stubber.add_response('head_object', {}, {'Bucket': 'bucket', 'Key': ANY})
+
+    with stubber:
+        location = spill_to_s3(IMAGE_DATA, 'image/jpeg', client, 'bucket', 'spillover/', public_url='https://cdn/')
+
+    assert location.startswith('https://cdn/spillover/')
+    stubber.assert_no_pending_responses()
+
+
+def test_handler_spills_large_responses():
+    client = create_client()
+    stubber = Stubber(client)
+    stubber.add_client_error('head_object', '404', http_status_code=404)
+    stubber.add_response('put_object', {}, None)
+    event = {'queryStringParameters': {'url': 'https://example.com/large.jpg', 'w': '1200'}}
+
+    with stubber, \
+            patch('imaginex_lambda.handler.download_and_optimize', return_value=(IMAGE_DATA, 'image/jpeg', 0.5)), \
+            patch('imaginex_lambda.lib.img_lib.s3_client', client), \
+            patch('imaginex_lambda.handler.SPILLOVER_BUCKET', 'bucket'), \
+            patch('imaginex_lambda.handler.SPILLOVER_THRESHOLD', len(IMAGE_DATA)):
+        r = handler(event, None)
+
+    assert r['statusCode'] == 302
+    assert r['body'] == ''
+    assert r['headers']['Location'].startswith('https://bucket.s3.amazonaws.com/spillover/')
+    assert r['headers']['Cache-Control'] == 'no-store'
+    stubber.assert_no_pending_responses()
+
+
+def test_handler_keeps_small_and_binary_responses_inline():
+    event = {'queryStringParameters': {'url': 'https://example.com/large.jpg', 'w': '1200'}}
+
+    with patch('imaginex_lambda.handler.download_and_optimize', return_value=(IMAGE_DATA, 'image/jpeg', 0.5)), \
+            patch('imaginex_lambda.handler.SPILLOVER_BUCKET', 'bucket'), \
+            patch('imaginex_lambda.handler.SPILLOVER_THRESHOLD', len(IMAGE_DATA)):
+        binary = handler(event, None, binary=True)
+        with patch('imaginex_lambda.handler.SPILLOVER_THRESHOLD', base64_size(len(IMAGE_DATA))):
+            inline = handler(event, None)
+
+    assert binary['statusCode'] == 200
+    assert binary['body'] == IMAGE_DATA
+    assert inline['statusCode'] == 200
+    assert base64.b64decode(inline['body']) == IMAGE_DATA
+
+
+def test_handler_spills_large_batches():
+    client = create_client()
+    stubber = Stubber(client)
+    stubber.add_client_error('head_object', '404', http_status_code=404)
+    stubber.add_response('put_object', {}, {'Bucket': 'bucket', 'Key': ANY, 'Body': IMAGE_DATA,
+                                            'ContentType': 'image/jpeg'})
+    small = make_image(size=(100, 60), noise=True, quality=95).getvalue()
+    results = [(small, 'image/jpeg', 0.5), (IMAGE_DATA, 'image/jpeg', 0.5), (small, 'image/jpeg', 0.5)]
+    event = {'queryStringParameters': {'url': 'https://example.com/large.jpg', 'w': '100,1200,101'}}
+
+    with stubber, \
+            patch('imaginex_lambda.handler.download_and_optimize_variants', return_value=results), \
+            patch('imaginex_lambda.lib.img_lib.s3_client', client), \
+            patch('imaginex_lambda.handler.SPILLOVER_BUCKET', 'bucket'), \
+            patch('imaginex_lambda.handler.SPILLOVER_THRESHOLD', len(IMAGE_DATA)):
+        r = handler(event, None)
+
+    variants = json.loads(r['body'])['variants']
+    assert r['statusCode'] == 200
+    assert [base64.b64decode(variants[i]['body']) for i in (0, 2)] == [small, small]
+    assert 'body' not in variants[1]
+    assert variants[1]['location'].startswith('https://bucket.s3.amazonaws.com/spillover/')
+    stubber.assert_no_pending_responses()
+
+
+def test_handler_rejects_large_batches_without_spillover():
+    results = [(IMAGE_DATA, 'image/jpeg', 0.5)] * 2
+    event = {'queryStringParameters': {'url': 'https://example.com/large.jpg', 'w': '1200,1201'}}
+
+    with patch('imaginex_lambda.handler.download_and_optimize_variants', return_value=results), \
+            patch('imaginex_lambda.handler.SPILLOVER_THRESHOLD', len(IMAGE_DATA)):
+        r = handler(event, None)
+        binary = handler(event, None, binary=True)
+
+    assert r['statusCode'] == 413
+    assert binary['statusCode'] == 200
@@ -0,0 +1,118 @@
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from unittest.mock import patch, MagicMock
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+from PIL import Image
+
+from imaginex_lambda.server import create_server, to_event
+from test.images import make_image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def server():
+    server = create_server('127.0.0.1', 0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_to_event():
+    event = to_event('/_next/image?url=%2Fa.jpg&w=640&q=75&w=750', {'Accept': 'image/webp'})
+
+    assert event == {'queryStringParameters': {'url': '/a.jpg', 'w': '750', 'q': '75'},
+                     'headers': {'accept': 'image/webp'}}
+    assert to_event('/other?url=a', {}) is None
+
+
+def test_serves_binary_images(server):
+    request = Request(f'{server}/_next/image?url=https://example.com/a.jpg&w=200&q=70',
+                      headers={'Accept': 'image/webp'})
+
+    with patch('imaginex_lambda.lib.img_lib.download_image', MagicMock(return_value=(make_image(), {}))), \
+            urlopen(request) as response:
+        body = response.read()
+        assert response.status == 200
+        assert response.headers['Content-Type'] == 'image/webp'
+        assert response.headers['Vary'] == 'Accept'
+        assert int(response.headers['Content-Length']) == len(body)
+
+    assert Image.open(BytesIO(body)).size == (200, 150)
+
+
+def test_errors_and_unknown_paths(server):
+    with pytest.raises(HTTPError) as exc:
+        urlopen(f'{server}/_next/image?url=https://example.com/a.jpg')
+    assert exc.value.code == 422
+    assert json.loads(exc.value.read())['error'] == 'Width or height must be defined'
+
+    with pytest.raises(HTTPError) as exc:
+        urlopen(f'{server}/favicon.ico')
+    assert exc.value.code == 404
+
+    with urlopen(f'{server}/_health') as response:
+        assert response.read() == b'ok'
+
+
+def test_concurrent_requests_are_coalesced(server):
+    release = threading.Event()
+    calls = []
+
+    def download(buffer, url, chunk_size):
+        calls.append(url)
+        release.wait(5)
+        return make_image(), {}
+
+    def request():
+        with urlopen(f'{server}/_next/image?url=https://example.com/a.jpg&w=200&q=70') as response:
+            return response.headers.get('X-Coalesced'), response.read()
+
+    with patch('imaginex_lambda.lib.img_lib.download_image', side_effect=download), \
+            ThreadPoolExecutor(max_workers=3) as pool:
+        threading.Timer(0.3, release.set).start()
+        results = list(pool.map(lambda _: request(), range(3)))
+
+    assert len(calls) == 1
+    assert len({body for _, body in results}) == 1
+    assert [coalesced for coalesced, _ in results].count('HIT') == 2
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='pre-forked workers need fork')
+def test_pre_forked_workers():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    process = subprocess.Popen([sys.executable, '-m', 'imaginex_lambda.server', '--host', '127.0.0.1', '--port',
+                                str(port), '--workers', '2'], cwd=ROOT)
+    try:
+        for _ in range(100):
+            try:
+                with urlopen(f'http://127.0.0.1:{port}/_health') as response:
+                    assert response.read() == b'ok'
+                break
+            except OSError:
+                time.sleep(0.05)
+        else:
+            pytest.fail('server did not start')
+
+        for _ in range(4):
+            with urlopen(f'http://127.0.0.1:{port}/_health') as response:
+                assert response.status == 200
+    finally:
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(timeout=10) == 0
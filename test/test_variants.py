@@ -0,0 +1,139 @@
+import base64
+import json
+from io import BytesIO
+from unittest.mock import patch, MagicMock
+
+import pytest
+from PIL import Image
+
+from imaginex_lambda.handler import handler, parse_variants
+from imaginex_lambda.lib.cache import LocalDerivativeStore, derivative_key
+from imaginex_lambda.lib.executor import create_executor
+from imaginex_lambda.lib.img_lib import download_and_optimize_variants, encode_image, optimize_variants, \
+    transform_params
+from test.images import make_image
+
+
+def test_parse_variants_from_query():
+    variants = parse_variants({}, {'w': '640,750', 'q': '60', 'f': 'webp'})
+
+    assert variants == [
+        {'width': 640, 'height': None, 'quality': 60, 'format': 'webp', 'max_bytes': None, 'fit': None},
+        {'width': 750, 'height': None, 'quality': 60, 'format': 'webp', 'max_bytes': None, 'fit': None},
+    ]
+    assert parse_variants({}, {'w': '640'}) is None
+
+
+def test_parse_variants_from_event():
+    variants = parse_variants({'variants': [{'w': 100}, {'h': '50', 'q': '40', 'f': 'png', 'url': 'b.png'}]},
+                              {'q': '60'})
+
+    assert variants == [
+        {'width': 100, 'height': None, 'quality': 60, 'format': None, 'max_bytes': None, 'fit': None, 'url': None},
+        {'width': None, 'height': 50, 'quality': 40, 'format': 'png', 'max_bytes': None, 'fit': None, 'url': 'b.png'},
+    ]
+
+
+def test_variants_download_and_decode_once(tmp_path):
+    store = LocalDerivativeStore(str(tmp_path))
+    download_image_mock = MagicMock(return_value=(make_image(size=(1600, 1000)), {'etag': '"v1"'}))
+    widths = [640, 1200, 828, 2000]
+    variants = [{'width': w, 'height': None, 'quality': 70, 'format': None} for w in widths]
+
+    with patch('imaginex_lambda.lib.img_lib.download_image', download_image_mock), \
+            patch('imaginex_lambda.lib.img_lib.Image.open', wraps=Image.open) as open_mock:
+        results = download_and_optimize_variants('https://example.com/a.jpg', variants, '', store=store)
+
+    assert download_image_mock.call_count == 1
+    assert open_mock.call_count == 1
+    assert [Image.open(BytesIO(image_data)).width for image_data, _, _ in results] == [640, 1200, 828, 1600]
+    assert all(content_type == 'image/jpeg' for _, content_type, _ in results)
+
+    # Variants are stored under the same keys as single requests.
+    params = transform_params('https://example.com/a.jpg', 70, 828, None, (), None)
+    assert store.get(derivative_key(params, {'etag': '"v1"'}))[0] == results[2][0]
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_variants_multiple_sources(workers):
+    sources = {'https://example.com/a.jpg': make_image(size=(1600, 1000)),
+               'https://example.com/b.png': make_image('PNG', (1600, 1000))}
+    download_image_mock = MagicMock(side_effect=lambda buffer, url, chunk_size: (sources[url], {}))
+    variants = [
+        {'width': 100, 'height': None, 'quality': 70},
+        {'width': 200, 'height': None, 'quality': 70, 'url': 'https://example.com/b.png'},
+        {'width': 300, 'height': None, 'quality': 70, 'format': 'webp'},
+        {'width': 400, 'height': None, 'quality': 70, 'url': 'https://example.com/b.png'},
+    ]
+
+    with patch('imaginex_lambda.lib.img_lib.download_image', download_image_mock):
+        results = download_and_optimize_variants('https://example.com/a.jpg', variants, '',
+                                                 executor=create_executor(workers))
+
+    assert download_image_mock.call_count == 2
+    assert [(Image.open(BytesIO(image_data)).width, content_type) for image_data, content_type, _ in results] == [
+        (100, 'image/jpeg'), (200, 'image/png'), (300, 'image/webp'), (400, 'image/png')]
+
+
+def test_same_size_variants_are_encoded_from_their_own_images():
+    # Larger than the source, so every variant keeps the source size and would share its image.
+    variants = [{'width': 800, 'height': None, 'quality': q, 'format': f}
+                for q, f in ((20, None), (95, None), (20, 'webp'), (95, 'webp'))]
+    source = make_image(size=(400, 300), noise=True)
+    images = []
+
+    def encode(img, *args):
+        images.append(img)
+        return encode_image(img, *args)
+
+    serial = optimize_variants(source, variants, ())
+    with patch('imaginex_lambda.lib.img_lib.encode_image', side_effect=encode):
+        concurrent = optimize_variants(source, variants, (), executor=create_executor(4))
+
+    assert len({id(img) for img in images}) == len(variants)
+    assert concurrent == serial
+
+
+@pytest.mark.parametrize('prewarm', [False, True])
+def test_handler_variants_response(prewarm):
+    qs = {'url': 'https://example.com/a.jpg', 'w': '640,750', 'q': '60'}
+    if prewarm:
+        qs['prewarm'] = '1'
+
+    source = make_image(size=(1600, 1000))
+    with patch('imaginex_lambda.lib.img_lib.download_image', MagicMock(return_value=(source, {}))):
+        r = handler({'queryStringParameters': qs, 'headers': {'accept': 'image/webp'}}, None)
+
+    assert r['statusCode'] == 200
+    assert r['headers']['Content-Type'] == 'application/json'
+    variants = json.loads(r['body'])['variants']
+    assert [(v['width'], v['quality'], v['content_type']) for v in variants] == [(640, 60, 'image/webp'),
+                                                                                (750, 60, 'image/webp')]
+    if prewarm:
+        assert all('body' not in v for v in variants)
+    else:
+        assert Image.open(BytesIO(base64.b64decode(variants[1]['body']))).width == 750
+
+
+@pytest.mark.parametrize('event', [{}, {'queryStringParameters': None}])
+def test_handler_variants_without_query_string(event):
+    # Direct invocations, like the prewarm, only send the variants.
+    event['variants'] = [{'w': 100, 'url': 'https://example.com/a.jpg'}, {'w': 200, 'url': 'https://example.com/a.jpg'}]
+
+    with patch('imaginex_lambda.lib.img_lib.download_image', MagicMock(return_value=(make_image(), {}))):
+        r = handler(event, None)
+
+    assert r['statusCode'] == 200
+    assert [v['width'] for v in json.loads(r['body'])['variants']] == [100, 200]
+
+
+def test_handler_variants_invalid_width():
+    r = handler({'queryStringParameters': {'url': 'https://example.com/a.jpg', 'w': '640,0'}}, None)
+
+    assert r['statusCode'] == 422
+    assert 'width must be greater than zero' in r['body']
+
+
+def test_create_executor_single_worker():
+    assert create_executor(1) is None
+    assert create_executor(3)._max_workers == 3